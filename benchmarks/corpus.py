@@ -0,0 +1,179 @@
+import json
+import random
+from dataclasses import dataclass
+from typing import Any, Iterator, Optional
+
+SCALES = {
+    "10k": 10_000,
+    "100k": 100_000,
+    "1m": 1_000_000,
+}
+
+_BASE_TS = 1_700_000_000
+
+_TOPICS_ZH = [
+    "预加载策略",
+    "播放器缓冲",
+    "缓存池",
+    "首帧耗时",
+    "内存泄漏",
+    "启动优化",
+    "弱网重试",
+    "数据库迁移",
+    "全文检索",
+    "会话摘要",
+]
+_TOPICS_EN = [
+    "preload",
+    "ExoPlayer",
+    "MediaSource",
+    "buffer size",
+    "cache eviction",
+    "cold start",
+    "retry backoff",
+    "schema migration",
+    "FTS5 index",
+    "session summary",
+]
+_FILES = [
+    "player/src/main/java/com/demo/player/PreloadManager.kt",
+    "player/src/main/java/com/demo/player/CachePool.kt",
+    "app/src/main/java/com/demo/app/MainActivity.kt",
+    "trae_mem/db.py",
+    "trae_mem/compress.py",
+    "scripts/build.sh",
+    "docs/design.md",
+    "tests/test_player.py",
+]
+_SYMBOLS = ["preloadNext", "CachePool.acquire", "onBufferingStart", "init_schema", "build_injection_block", "evictLru"]
+_COMMANDS = ["git status", "./gradlew assembleDebug", "python -m pytest -q", "rg preload player/", "adb logcat -d"]
+_ERRORS = [
+    "java.lang.IllegalStateException: MediaSource already prepared\n    at com.demo.player.PreloadManager.preloadNext(PreloadManager.kt:{line})",
+    "Traceback (most recent call last):\n  File \"/work/trae_mem/db.py\", line {line}, in search\nsqlite3.OperationalError: fts5: syntax error near \"-\"",
+    "FAILED tests/test_player.py::test_preload_{line} - AssertionError: expected 3 buffered segments, got 0",
+    "E/ExoPlayerImplInternal: Playback error 0x7f{line:04x} source error",
+]
+_TOOLS = ["Read", "Grep", "Bash", "Edit", "Write", "Glob"]
+
+
+@dataclass(frozen=True, slots=True)
+class CorpusObservation:
+    session_key: int
+    ts: int
+    kind: str
+    tool_name: Optional[str]
+    text: str
+
+
+@dataclass(frozen=True, slots=True)
+class CorpusSession:
+    key: int
+    project_path: str
+    started_at: int
+
+
+def _sentence(rng: random.Random) -> str:
+    zh = rng.choice(_TOPICS_ZH)
+    en = rng.choice(_TOPICS_EN)
+    templates = [
+        "我要优化{zh}，重点看 {en} 的实现",
+        "为什么 {en} 会导致{zh}变慢？",
+        "帮我检查 {file} 里的 {sym}",
+        "Refactor {sym} so that {en} no longer blocks {zh}",
+        "{zh} 回归了，对比一下 {en} 的改动",
+    ]
+    return rng.choice(templates).format(zh=zh, en=en, file=rng.choice(_FILES), sym=rng.choice(_SYMBOLS))
+
+
+def _tool_payload(rng: random.Random, tool: str) -> tuple[dict[str, Any], Any]:
+    path = rng.choice(_FILES)
+    if tool == "Read":
+        lines = "\n".join(f"{i:4d}  val {rng.choice(_SYMBOLS)} = {rng.choice(_TOPICS_EN)!r}" for i in range(rng.randint(20, 120)))
+        return {"file_path": path}, {"content": lines}
+    if tool == "Grep":
+        pattern = rng.choice(_TOPICS_EN + _SYMBOLS)
+        hits = [f"{rng.choice(_FILES)}:{rng.randint(1, 900)}: {pattern}" for _ in range(rng.randint(1, 30))]
+        return {"pattern": pattern, "path": path.split("/")[0]}, {"matches": hits}
+    if tool == "Bash":
+        cmd = rng.choice(_COMMANDS)
+        out = "\n".join(f"{rng.choice(_TOPICS_EN)} ... ok" for _ in range(rng.randint(1, 60)))
+        if rng.random() < 0.2:
+            out += "\n" + rng.choice(_ERRORS).format(line=rng.randint(1, 500))
+        return {"command": cmd}, {"stdout": out, "exit_code": 0}
+    if tool in ("Edit", "Write"):
+        return {"file_path": path, "old_string": rng.choice(_SYMBOLS), "new_string": rng.choice(_SYMBOLS)}, {"ok": True}
+    return {"pattern": f"**/*{path.rsplit('.', 1)[-1]}"}, {"files": rng.sample(_FILES, 3)}
+
+
+def _private_span(rng: random.Random) -> str:
+    return f"<private>token=sk-{rng.getrandbits(64):016x}</private>"
+
+
+def generate(total: int, seed: int = 42, session_size: int = 200) -> Iterator[tuple[CorpusSession, list[CorpusObservation]]]:
+    # 确定性语料：同一 (total, seed) 总是产出相同的会话与观测序列。
+    rng = random.Random(seed)
+    emitted = 0
+    key = 0
+    while emitted < total:
+        n = min(total - emitted, max(1, int(rng.gauss(session_size, session_size / 4))))
+        started = _BASE_TS + key * 3600
+        session = CorpusSession(key=key, project_path=f"/work/project-{key % 7}", started_at=started)
+        ts = started
+        obs: list[CorpusObservation] = []
+        for _ in range(n):
+            ts += rng.choice((0, 0, 1, 2, 5, 30))
+            r = rng.random()
+            if r < 0.15:
+                text = _sentence(rng)
+                if rng.random() < 0.1:
+                    text += " " + _private_span(rng)
+                obs.append(CorpusObservation(key, ts, "user", None, text))
+            elif r < 0.80:
+                tool = rng.choice(_TOOLS)
+                tool_input, tool_response = _tool_payload(rng, tool)
+                text = "输入=" + json.dumps(tool_input, ensure_ascii=False) + "\n输出=" + json.dumps(tool_response, ensure_ascii=False)[:4000]
+                obs.append(CorpusObservation(key, ts, "tool", tool, text))
+            elif r < 0.92:
+                obs.append(CorpusObservation(key, ts, rng.choice(("decision", "note")), None, _sentence(rng)))
+            else:
+                obs.append(CorpusObservation(key, ts, "error", None, rng.choice(_ERRORS).format(line=rng.randint(1, 500))))
+        emitted += n
+        key += 1
+        yield session, obs
+
+
+def search_queries(seed: int = 7, n: int = 50) -> list[str]:
+    rng = random.Random(seed)
+    pool = _TOPICS_ZH + _TOPICS_EN + _SYMBOLS
+    return [rng.choice(pool) for _ in range(n)]
+
+
+def fallback_queries(seed: int = 11, n: int = 50) -> list[str]:
+    # 两字中文词无法命中 trigram 索引，会落到 LIKE 全表扫描路径。
+    rng = random.Random(seed)
+    pool = ["缓存", "首帧", "重试", "迁移", "摘要", "缓冲"]
+    return [rng.choice(pool) for _ in range(n)]
+
+
+def syntax_queries(seed: int = 13, n: int = 50) -> list[str]:
+    # 含 FTS5 语法字符的真实查询（路径、冒号、引号、减号、括号），编译后应当仍然走索引。
+    rng = random.Random(seed)
+    pool = [
+        *_FILES,
+        *_SYMBOLS,
+        *_COMMANDS,
+        "test_player.py::test_preload",
+        '"syntax error near"',
+        "fts5: syntax",
+        "PreloadManager.kt:(",
+        "preload* OR evictLru",
+        "-- force",
+    ]
+    return [rng.choice(pool) for _ in range(n)]
+
+
+def entity_queries(seed: int = 17, n: int = 50) -> list[str]:
+    # 实体点查：完整路径、文件名后缀、符号、命令。
+    rng = random.Random(seed)
+    pool = [*_FILES, *(f.rsplit("/", 1)[-1] for f in _FILES), *_SYMBOLS, *_COMMANDS]
+    return [rng.choice(pool) for _ in range(n)]
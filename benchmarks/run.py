@@ -0,0 +1,216 @@
+import argparse
+import json
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Callable, Optional
+
+from trae_mem.inject import build_injection_block
+from trae_mem.compress import redact_for_ingest, summarize_session_levels
+from trae_mem.db import TraeMemDB
+
+from . import startup
+from .corpus import SCALES, entity_queries, fallback_queries, generate, search_queries, syntax_queries
+
+
+def _percentile(samples: list[float], pct: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    idx = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * (len(ordered) - 1)))))
+    return ordered[idx]
+
+
+def _latency(samples: list[float]) -> dict[str, float]:
+    return {
+        "p50_ms": round(_percentile(samples, 50) * 1000, 3),
+        "p99_ms": round(_percentile(samples, 99) * 1000, 3),
+        "mean_ms": round(sum(samples) / len(samples) * 1000, 3) if samples else 0.0,
+    }
+
+
+def _time_each(items: list[Any], fn: Callable[[Any], Any]) -> list[float]:
+    out: list[float] = []
+    for it in items:
+        t0 = time.perf_counter()
+        fn(it)
+        out.append(time.perf_counter() - t0)
+    return out
+
+
+def bench_ingest(db: TraeMemDB, total: int, seed: int) -> tuple[dict[str, Any], list[str], list[str]]:
+    session_ids: list[str] = []
+    obs_ids: list[str] = []
+    rows = 0
+    t0 = time.perf_counter()
+    for session, observations in generate(total, seed=seed):
+        sid = db.new_session(project_path=session.project_path, meta={"bench": session.key})
+        session_ids.append(sid)
+        for o in observations:
+            content, private = redact_for_ingest(o.text)
+            oid = db.add_observation(sid, kind=o.kind, content=content, tool_name=o.tool_name, private=private, ts=o.ts)
+            if len(obs_ids) < 1000 or rows % 97 == 0:
+                obs_ids.append(oid)
+            rows += 1
+    elapsed = time.perf_counter() - t0
+    return {"rows": rows, "seconds": round(elapsed, 3), "rows_per_s": round(rows / elapsed, 1)}, session_ids, obs_ids
+
+
+def bench_mcp(db_path: Path, queries: list[str]) -> dict[str, float]:
+    env = dict(os.environ, TRAE_MEM_DB=str(db_path))
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "trae_mem.mcp_server"],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        env=env,
+        text=True,
+        encoding="utf-8",
+    )
+    assert proc.stdin is not None and proc.stdout is not None
+
+    def call(msg: dict[str, Any]) -> dict[str, Any]:
+        proc.stdin.write(json.dumps(msg, ensure_ascii=False) + "\n")
+        proc.stdin.flush()
+        return json.loads(proc.stdout.readline())
+
+    try:
+        call({"jsonrpc": "2.0", "id": 0, "method": "initialize", "params": {}})
+        samples: list[float] = []
+        for i, q in enumerate(queries, start=1):
+            t0 = time.perf_counter()
+            call(
+                {
+                    "jsonrpc": "2.0",
+                    "id": i,
+                    "method": "tools/call",
+                    "params": {"name": "trae_mem_search", "arguments": {"query": q, "limit": 20}},
+                }
+            )
+            samples.append(time.perf_counter() - t0)
+        return _latency(samples)
+    finally:
+        proc.stdin.close()
+        proc.wait(timeout=30)
+
+
+def run(scale: str, seed: int, workdir: Path, with_mcp: bool = True) -> dict[str, Any]:
+    total = SCALES[scale]
+    db_path = workdir / f"bench-{scale}.sqlite3"
+    for suffix in ("", "-wal", "-shm"):
+        Path(str(db_path) + suffix).unlink(missing_ok=True)
+    db = TraeMemDB(db_path)
+    metrics: dict[str, Any] = {}
+    try:
+        db.init_schema()
+        metrics["ingest"], session_ids, obs_ids = bench_ingest(db, total, seed)
+
+        queries = search_queries()
+        metrics["search_fts"] = _latency(_time_each(queries, lambda q: db.search(q, limit=20)))
+        metrics["search_like_fallback"] = _latency(_time_each(fallback_queries(), lambda q: db.search(q, limit=20)))
+        metrics["search_syntax"] = _latency(_time_each(syntax_queries(), lambda q: db.search(q, limit=20)))
+        metrics["entity_lookup"] = _latency(_time_each(entity_queries(), lambda q: db.lookup_entity(q, limit=20)))
+
+        rng = random.Random(seed)
+        sample_obs = rng.sample(obs_ids, min(50, len(obs_ids)))
+        metrics["timeline"] = _latency(_time_each(sample_obs, lambda oid: db.timeline(oid, window=10)))
+        metrics["get_observations"] = _latency(
+            _time_each([rng.sample(obs_ids, min(20, len(obs_ids))) for _ in range(50)], db.get_observations)
+        )
+        metrics["inject"] = _latency(
+            _time_each(queries[:30], lambda q: build_injection_block(db, query=q, limit=12, project_path="/work/project-1"))
+        )
+
+        def end_session(sid: str) -> None:
+            db.end_session(sid)
+            summaries = summarize_session_levels(db.iter_session_observations(sid), {"brief": 900, "detailed": 3200})
+            for level, content in summaries.items():
+                db.add_summary(session_id=sid, level=level, content=content)
+
+        metrics["end_session"] = _latency(_time_each(rng.sample(session_ids, min(20, len(session_ids))), end_session))
+    finally:
+        db.close()
+
+    if with_mcp:
+        metrics["mcp_search_roundtrip"] = bench_mcp(db_path, search_queries(n=30))
+    metrics["startup"] = startup.measure(runs=5)
+
+    return {
+        "meta": {
+            "scale": scale,
+            "rows": total,
+            "seed": seed,
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+            "created_at": int(time.time()),
+        },
+        "metrics": metrics,
+    }
+
+
+def _flatten(metrics: dict[str, Any], prefix: str = "") -> dict[str, float]:
+    out: dict[str, float] = {}
+    for k, v in metrics.items():
+        name = f"{prefix}{k}"
+        if isinstance(v, dict):
+            out.update(_flatten(v, name + "."))
+        elif isinstance(v, (int, float)):
+            out[name] = float(v)
+    return out
+
+
+def compare(current: dict[str, Any], baseline: dict[str, Any], threshold: float) -> list[str]:
+    # *_ms 越小越好，*_per_s 越大越好；其它计数类指标不参与比较。
+    cur = _flatten(current.get("metrics") or {})
+    base = _flatten(baseline.get("metrics") or {})
+    regressions: list[str] = []
+    for name, old in sorted(base.items()):
+        new = cur.get(name)
+        if new is None or old <= 0:
+            continue
+        if name.endswith("_ms") and new > old * (1 + threshold):
+            regressions.append(f"{name}: {old:.3f} -> {new:.3f} (+{(new / old - 1) * 100:.1f}%)")
+        elif name.endswith("_per_s") and new < old * (1 - threshold):
+            regressions.append(f"{name}: {old:.1f} -> {new:.1f} (-{(1 - new / old) * 100:.1f}%)")
+    return regressions
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    p = argparse.ArgumentParser(prog="python -m benchmarks.run")
+    p.add_argument("--scale", choices=list(SCALES), default="10k")
+    p.add_argument("--seed", type=int, default=42)
+    p.add_argument("--workdir", default=None, help="where to build the benchmark db (default: a temp dir)")
+    p.add_argument("--out", default=None, help="write results JSON here (default: stdout)")
+    p.add_argument("--baseline", default=None, help="baseline results JSON to compare against")
+    p.add_argument("--threshold", type=float, default=0.2, help="allowed relative slowdown before flagging")
+    p.add_argument("--no-mcp", action="store_true")
+    args = p.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = Path(args.workdir).expanduser() if args.workdir else Path(tmp)
+        workdir.mkdir(parents=True, exist_ok=True)
+        result = run(args.scale, args.seed, workdir, with_mcp=not args.no_mcp)
+
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.out:
+        Path(args.out).write_text(text + "\n", encoding="utf-8")
+    else:
+        print(text)
+
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text(encoding="utf-8"))
+        regressions = compare(result, baseline, args.threshold)
+        for r in regressions:
+            print(f"REGRESSION {r}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,119 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Optional
+
+ENTRY_POINTS = {
+    "hooks_bridge": "trae_mem.hooks_bridge",
+    "cli": "trae_mem.cli",
+    "mcp_server": "trae_mem.mcp_server",
+}
+
+# hook 进程每次事件都会重新启动，这些模块只应在真正用到时才被导入。
+FORBIDDEN_ON_HOOK_PATH = (
+    "argparse",
+    "dataclasses",
+    "hashlib",
+    "http.client",
+    "http.server",
+    "inspect",
+    "textwrap",
+    "urllib.request",
+    "uuid",
+)
+
+DEFAULT_BUDGET_MS = 60.0
+
+_REPO_ROOT = Path(__file__).resolve().parents[1]
+
+
+def _env(pycache: str) -> dict[str, str]:
+    env = dict(os.environ)
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    env["PYTHONPYCACHEPREFIX"] = pycache
+    env["PYTHONPATH"] = os.pathsep.join(p for p in (str(_REPO_ROOT), env.get("PYTHONPATH")) if p)
+    return env
+
+
+def _importtime(module: str, env: dict[str, str]) -> tuple[float, set[str]]:
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    total_us = 0.0
+    names: set[str] = set()
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        parts = line.split("|")
+        name = parts[2].strip()
+        names.add(name)
+        if name == module:
+            total_us = float(parts[1].strip())
+    return total_us / 1000.0, names
+
+
+def measure(runs: int = 7) -> dict[str, Any]:
+    out: dict[str, Any] = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        env = _env(str(Path(tmp) / "pyc"))
+        for key, module in ENTRY_POINTS.items():
+            _importtime(module, env)
+            samples = []
+            names: set[str] = set()
+            for _ in range(runs):
+                ms, names = _importtime(module, env)
+                samples.append(ms)
+            out[f"{key}_import_ms"] = round(statistics.median(samples), 3)
+            if key == "hooks_bridge":
+                out["hooks_bridge_forbidden"] = sorted(m for m in FORBIDDEN_ON_HOOK_PATH if m in names)
+
+        hook_env = dict(env, TRAE_MEM_HOME=str(Path(tmp) / "home"))
+        hook_env.pop("TRAE_MEM_DB", None)
+        payload = json.dumps({"session_id": "bench", "cwd": tmp, "reason": "bench"})
+        samples = []
+        for _ in range(runs + 1):
+            t0 = time.perf_counter()
+            subprocess.run(
+                [sys.executable, "-m", "trae_mem.hooks_bridge", "--event", "Stop"],
+                input=payload,
+                env=hook_env,
+                cwd=tmp,
+                capture_output=True,
+                text=True,
+                check=True,
+            )
+            samples.append(time.perf_counter() - t0)
+        out["hook_stop_wall_ms"] = round(statistics.median(samples[1:]) * 1000, 3)
+    return out
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    p = argparse.ArgumentParser(prog="python -m benchmarks.startup")
+    p.add_argument("--runs", type=int, default=7)
+    p.add_argument("--budget-ms", type=float, default=DEFAULT_BUDGET_MS, help="import budget for trae_mem.hooks_bridge")
+    args = p.parse_args(argv)
+
+    result = measure(args.runs)
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    failed = False
+    if result["hooks_bridge_import_ms"] > args.budget_ms:
+        print(f"OVER BUDGET hooks_bridge import {result['hooks_bridge_import_ms']}ms > {args.budget_ms}ms", file=sys.stderr)
+        failed = True
+    if result["hooks_bridge_forbidden"]:
+        print(f"FORBIDDEN imports on hook path: {', '.join(result['hooks_bridge_forbidden'])}", file=sys.stderr)
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -1,10 +1,21 @@
+import json
 import os
+import sqlite3
+import subprocess
+import sys
 import tempfile
+import time
 import unittest
+from unittest import mock
 from pathlib import Path
 
-from trae_mem.compress import contains_private, remove_private
-from trae_mem.db import TraeMemDB
+from trae_mem.compress import bounded_json, contains_private, remove_private, summarize_session_levels
+from trae_mem.db import TraeMemDB, _observation_filters
+from trae_mem.dedup import collapse_repeats
+from trae_mem.inject import build_injection_block
+from trae_mem.metrics import REGISTRY, Registry
+from trae_mem.ranking import RankConfig
+from trae_mem import profiling
 
 
 class TraeMemBasicTests(unittest.TestCase):
@@ -37,6 +48,800 @@ class TraeMemBasicTests(unittest.TestCase):
         self.assertIn(obs1, ids)
         self.assertIn(obs2, ids)
 
+    def test_reads_do_not_wait_on_open_write_transaction(self) -> None:
+        sid = self.db.new_session(project_path="/tmp/p")
+        obs1 = self.db.add_observation(sid, kind="note", content="已提交的观测 committed")
+        with self.db._write() as conn:
+            conn.execute(
+                "INSERT INTO observations(id, session_id, ts, kind, content) VALUES ('pending', ?, 0, 'note', 'x')",
+                (sid,),
+            )
+            rows = self.db.get_observations([obs1, "pending"])
+            self.assertEqual([r["id"] for r in rows], [obs1])
+        self.assertEqual(len(self.db.get_observations([obs1, "pending"])), 2)
+        with self.assertRaises(Exception):
+            self.db._reader().execute("DELETE FROM observations")
+
+    def test_bounded_json_stops_at_budget(self) -> None:
+        big = {"file_path": "/a/b.py", "content": "x" * 2_000_000 + "END"}
+        text, meta = bounded_json(big, 400)
+        self.assertLessEqual(len(text), 400)
+        self.assertIn('"file_path": "/a/b.py"', text)
+        self.assertTrue(meta["truncated"])
+        self.assertGreater(meta["chars"], 2_000_000)
+        self.assertEqual(len(meta["sha1"]), 40)
+
+        small, meta2 = bounded_json({"a": [1, None, True]}, 400)
+        self.assertEqual(small, '{"a": [1, null, true]}')
+        self.assertFalse(meta2["truncated"])
+
+        # 字符串带长度前缀哈希：相邻字符串拼接相同的不同结构不会撞上；长度近似完整 JSON 编码（不含转义）。
+        objs = (["a", "b"], ["a, b"], {"ab": 1}, {"a": "b1"}, {"a": "b", "c": 1}, {"a": 'b", "c": 1'}, [1, "1"], [True])
+        digests = {bounded_json(obj, 400)[1]["sha1"] for obj in objs}
+        self.assertEqual(len(digests), len(objs))
+        for obj in objs:
+            self.assertEqual(bounded_json(obj, 400)[1]["chars"], len(json.dumps(obj)) - json.dumps(obj).count("\\"))
+            self.assertEqual(bounded_json(obj, 400)[1]["sha1"], bounded_json(json.loads(json.dumps(obj)), 5)[1]["sha1"])
+
+        # 多 MB 的字符串按块哈希：峰值内存与输入大小无关，也不会整段转义。
+        import tracemalloc
+
+        huge = {"stdout": "\n" * 10_000_000, "exit": 1}
+        tracemalloc.start()
+        try:
+            text, m = bounded_json(huge, 4000)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        self.assertLess(peak, 1_000_000)
+        self.assertTrue(m["truncated"])
+        self.assertLessEqual(len(text), 4000)
+        self.assertEqual(m["chars"], 10_000_000 + len('{"stdout": "", "exit": 1}'))
+        # 预算充足时长字符串不截断，预算紧张时才掐头留尾。
+        text, m = bounded_json({"cmd": "y" * 1500}, 2000)
+        self.assertFalse(m["truncated"])
+        self.assertIn("y" * 1500, text)
+        text, m = bounded_json({"cmd": "y" * 1500, "out": "z" * 1500}, 2000)
+        self.assertTrue(m["truncated"])
+        self.assertIn('"out": "zzz', text)
+
+    def test_tool_call_completes_pending_observation_in_place(self) -> None:
+        sid = self.db.new_session(project_path="/tmp/p")
+        obs_id = self.db.open_tool_call(sid, "k1", tool_name="Read", content="输入={}\n输出=（执行中）")
+        self.assertEqual(self.db.complete_tool_call("k1", content="输入={}\n输出=done marker"), obs_id)
+        self.assertIsNone(self.db.complete_tool_call("k1", content="again"))
+        rows = self.db.get_observations_by_session(sid)
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(json.loads(rows[0]["tags_json"])["status"], "done")
+        self.assertTrue(any(h.id == obs_id for h in self.db.search("done marker")))
+
+        self.db.open_tool_call(sid, "k2", tool_name="Bash", content="pending")
+        # 没有超时的挂起调用时不开写事务。
+        with mock.patch.object(self.db, "_write", side_effect=AssertionError("write")):
+            self.assertEqual(self.db.expire_tool_calls(1800), 0)
+        self.assertEqual(self.db.expire_tool_calls(-1), 1)
+        self.assertIsNone(self.db.complete_tool_call("k2", content="late"))
+
+        # 没有 tool_use_id 的两次相同调用共用一个键：先开始的先完成，两条都不会停在 pending。
+        first = self.db.open_tool_call(sid, "h:same", tool_name="Bash", content="输入=ls\n输出=（执行中）")
+        second = self.db.open_tool_call(sid, "h:same", tool_name="Bash", content="输入=ls\n输出=（执行中）")
+        self.assertNotEqual(first, second)
+        self.assertEqual(self.db.complete_tool_call("h:same", content="输入=ls\n输出=a"), first)
+        self.assertEqual(self.db.complete_tool_call("h:same", content="输入=ls\n输出=b"), second)
+        self.assertIsNone(self.db.complete_tool_call("h:same", content="again"))
+        status = {r.id: json.loads(r["tags_json"])["status"] for r in self.db.get_observations([first, second])}
+        self.assertEqual(status, {first: "done", second: "done"})
+
+    def test_preview_and_bucket_backfilled_for_legacy_rows(self) -> None:
+        legacy = Path(self.tmpdir.name) / "legacy.sqlite3"
+        conn = sqlite3.connect(str(legacy))
+        conn.executescript(
+            """
+            CREATE TABLE sessions (id TEXT PRIMARY KEY, started_at INTEGER NOT NULL, ended_at INTEGER,
+              project_path TEXT, meta_json TEXT);
+            CREATE TABLE observations (id TEXT PRIMARY KEY, session_id TEXT NOT NULL, ts INTEGER NOT NULL,
+              kind TEXT NOT NULL, tool_name TEXT, content TEXT NOT NULL, private INTEGER NOT NULL DEFAULT 0,
+              tags_json TEXT);
+            CREATE VIRTUAL TABLE observations_fts USING fts5(id UNINDEXED, session_id UNINDEXED, kind, tool_name, content);
+            INSERT INTO sessions VALUES ('s1', 0, NULL, NULL, '{}');
+            INSERT INTO observations VALUES ('o1', 's1', 1, 'note', NULL, '决定\n  使用<private>k</private>缓存', 0, '{}');
+            INSERT INTO observations_fts VALUES ('o1', 's1', 'note', '', '决定 使用缓存');
+            """
+        )
+        conn.commit()
+        conn.close()
+
+        db = TraeMemDB(legacy)
+        try:
+            db.init_schema()
+            row = db.get_observations(["o1"])[0]
+            self.assertEqual(row["preview"], "决定 使用 缓存")
+            self.assertEqual(row["bucket"], "decision")
+            self.assertEqual(row.seq, 1)
+            fts_rowid = db._conn.execute("SELECT fts_rowid FROM observations WHERE id='o1'").fetchone()[0]
+            self.assertIsNotNone(fts_rowid)
+        finally:
+            db.close()
+
+    def test_iter_session_observations_pages_without_dropping_rows(self) -> None:
+        sid = self.db.new_session(project_path="/tmp/p")
+        for i in range(7):
+            self.db.add_observation(sid, kind="user", content=f"msg {i}", ts=100 + i)
+        self.db.add_observation(sid, kind="note", content="<private>x</private>", private=True, ts=200)
+        got = list(self.db.iter_session_observations(sid, batch_size=3))
+        self.assertEqual([o.preview for o in got], [f"msg {i}" for i in range(7)])
+        self.assertEqual(len(list(self.db.iter_session_observations(sid, include_private=True))), 8)
+
+        summary = summarize_session_levels(self.db.iter_session_observations(sid), {"brief": 900, "detailed": 3200})
+        self.assertEqual(set(summary), {"brief", "detailed"})
+        self.assertIn("msg 0", summary["brief"])
+
+    def test_metrics_registry_renders_prometheus_text(self) -> None:
+        reg = Registry(buckets=(0.01, 0.1), enabled=True)
+        reg.observe("op_seconds", 0.005, op="search")
+        reg.observe("op_seconds", 0.05, op="search")
+        reg.inc("calls_total", op="search")
+        text = reg.render_prometheus()
+        self.assertIn('op_seconds_bucket{op="search",le="0.01"} 1', text)
+        self.assertIn('op_seconds_bucket{op="search",le="+Inf"} 2', text)
+        self.assertIn('op_seconds_count{op="search"} 2', text)
+        self.assertIn('calls_total{op="search"} 1', text)
+
+        before = REGISTRY.snapshot()
+        sid = self.db.new_session()
+        self.db.add_observation(sid, kind="note", content="metrics probe")
+        self.db.search("metrics probe")
+        after = {(h["name"], h["labels"].get("op")): h["count"] for h in REGISTRY.snapshot()["histograms"]}
+        prev = {(h["name"], h["labels"].get("op")): h["count"] for h in before["histograms"]}
+        key = ("trae_mem_db_seconds", "search")
+        self.assertEqual(after[key], prev.get(key, 0) + 1)
+
+        # 每个 op 标签只对应自己的方法，一次调用记一次。
+        obs_id = self.db.add_observation(sid, kind="note", content="改了 trae_mem/db.py")
+        before = {(h["name"], h["labels"].get("op")): h["count"] for h in REGISTRY.snapshot()["histograms"]}
+        self.db.timeline(obs_id)
+        self.db.lookup_entity("trae_mem/db.py")
+        self.db.lookup_entity("trae_mem/db.py")
+        after = {(h["name"], h["labels"].get("op")): h["count"] for h in REGISTRY.snapshot()["histograms"]}
+        for op, n in (("timeline", 1), ("lookup_entity", 2)):
+            key = ("trae_mem_db_seconds", op)
+            self.assertEqual(after[key] - before.get(key, 0), n)
+
+    def test_slow_query_log_captures_plan_and_redacts_params(self) -> None:
+        db = TraeMemDB(Path(self.tmpdir.name) / "slow.sqlite3", slow_query_ms=0)
+        try:
+            db.init_schema()
+            sid = db.new_session()
+            db.add_observation(sid, kind="note", content="secret-ish content")
+            db.search("zz")
+            entries = db.slow_queries(limit=500)
+            like = [e for e in entries if "LIKE" in e.sql]
+            self.assertTrue(like)
+            self.assertIn("SCAN", like[0].plan)
+            self.assertNotIn("secret", " ".join(e.params_json for e in entries))
+            self.assertIn("str[4]", like[0].params_json)
+        finally:
+            db.close()
+
+    def test_profiled_writes_one_file_per_invocation_and_merges(self) -> None:
+        prof_dir = Path(self.tmpdir.name) / "profiles"
+        with mock.patch.dict(os.environ, {"TRAE_MEM_PROFILE": str(prof_dir)}):
+            for _ in range(2):
+                with profiling.profiled("hook-PostToolUse"):
+                    with profiling.profiled("nested-is-ignored"):
+                        self.db.search("anything")
+        self.assertEqual(len(profiling.profile_files(prof_dir)), 2)
+        text = profiling.report(prof_dir, top=5, match="hook-PostToolUse")
+        self.assertIn("merged 2 profile(s)", text)
+        self.assertEqual(profiling.clear(prof_dir), 2)
+
+    def test_hook_entry_point_does_not_import_heavy_modules(self) -> None:
+        code = (
+            "import sys, trae_mem.hooks_bridge; "
+            "print(','.join(m for m in ('urllib.request', 'http.server', 'argparse', 'dataclasses', 'textwrap') "
+            "if m in sys.modules))"
+        )
+        root = str(Path(__file__).resolve().parents[1])
+        out = subprocess.run([sys.executable, "-c", code], cwd=root, capture_output=True, text=True, check=True)
+        self.assertEqual(out.stdout.strip(), "")
+
+    def test_search_filters_are_pushed_into_sql(self) -> None:
+        a = self.db.new_session(project_path="/proj/a")
+        b = self.db.new_session(project_path="/proj/b")
+        in_a = self.db.add_observation(a, kind="error", content="buffer underrun detected", ts=1000)
+        self.db.add_observation(a, kind="note", content="buffer underrun noted", ts=2000)
+        self.db.add_observation(b, kind="error", content="buffer underrun elsewhere", ts=1000)
+
+        hits = self.db.search("buffer underrun", project="/proj/a", kinds=["error"])
+        self.assertEqual([h.id for h in hits], [in_a])
+        self.assertEqual(len(self.db.search("buffer underrun", since=1500)), 1)
+        self.assertEqual(len(self.db.search("underrun", session_id=b, kinds="error")), 1)
+        plan = " ".join(
+            str(r[-1])
+            for r in self.db._conn.execute(
+                "EXPLAIN QUERY PLAN SELECT id FROM observations o WHERE o.kind IN ('error') ORDER BY o.ts DESC"
+            )
+        )
+        self.assertIn("idx_observations_kind_ts", plan)
+
+    def test_seq_orders_same_second_bursts_and_pages_by_cursor(self) -> None:
+        sid = self.db.new_session()
+        ids = [self.db.add_observation(sid, kind="note", content=f"burst step {i}", ts=5000) for i in range(7)]
+
+        rows = self.db.get_observations_by_session(sid)
+        self.assertEqual([r.id for r in rows], ids)
+        self.assertEqual([r.seq for r in rows], list(range(1, 8)))
+
+        seen: list[str] = []
+        after = None
+        while True:
+            page = self.db.get_observations_by_session(sid, limit=3, after_seq=after)
+            if not page:
+                break
+            seen += [r.id for r in page]
+            after = page[-1].seq
+        self.assertEqual(seen, ids)
+
+        first = self.db.timeline(ids[3], window=1, limit=4)
+        self.assertEqual([r.id for r in first], ids[1:5])
+        self.assertEqual([r.id for r in self.db.timeline(ids[3], limit=4, after_seq=first[-1].seq)], ids[5:])
+        self.assertEqual([r.id for r in self.db.timeline(ids[3], limit=4, before_seq=first[0].seq)], ids[:1])
+
+        # transcript 补录的行 seq 排在最后、ts 却在中间：timeline 按 (ts, seq) 选取与排序，翻页不重不漏。
+        other = self.db.new_session()
+        early, anchor, late = (self.db.add_observation(other, kind="note", content=f"at {ts}", ts=ts) for ts in (1000, 1060, 1120))
+        self.db.bulk_ingest(other, [("note", "backfilled from transcript", None, None, False, 1030)])
+        backfilled = self.db.get_observations_by_session(other)[-1].id
+        self.assertEqual([r.id for r in self.db.timeline(anchor, window=5)], [early, backfilled, anchor, late])
+        page = self.db.timeline(anchor, window=5, limit=2)
+        self.assertEqual([r.id for r in page], [backfilled, anchor])
+        self.assertEqual([r.id for r in self.db.timeline(anchor, window=5, limit=2, after_seq=page[-1].seq)], [late])
+        self.assertEqual([r.id for r in self.db.timeline(anchor, window=5, limit=2, before_seq=page[0].seq)], [early])
+
+        for query, path in (("burst step", "f:"), ("ep", "l:")):
+            got: list[str] = []
+            cursor = None
+            while True:
+                hits, cursor = self.db.search_page(query, limit=2, cursor=cursor)
+                self.assertTrue(cursor is None or cursor.startswith(path))
+                got += [h.id for h in hits]
+                if cursor is None:
+                    break
+            self.assertEqual(sorted(got), sorted(ids))
+
+    def test_fts_query_compiler_keeps_syntax_heavy_queries_on_index(self) -> None:
+        sid = self.db.new_session()
+        target = self.db.add_observation(
+            sid, kind="error", content='File "trae_mem/db.py", line 12: fts5: syntax error near "-" (NEAR)'
+        )
+        self.db.add_observation(sid, kind="note", content="preloadNext evicts CachePool entries")
+        REGISTRY.reset()
+        for q in ("trae_mem/db.py", "fts5: syntax", '"error near"', "(NEAR)", 'near "-"', "db.py OR zzzz"):
+            self.assertEqual([h.id for h in self.db.search(q)], [target], q)
+        self.assertEqual(len(self.db.search("preload* OR syntax")), 2)
+        snap = REGISTRY.snapshot()["counters"]
+        self.assertFalse([c for c in snap if c["name"] == "trae_mem_search_fallback_total"])
+
+        with self.assertRaises(ValueError):
+            self.db.search("NEAR(", advanced=True)
+        self.assertEqual([h.id for h in self.db.search("syntax AND error", advanced=True)], [target])
+
+    def test_ranking_blends_recency_kind_and_access(self) -> None:
+        now = int(time.time())
+        sid = self.db.new_session()
+        old = self.db.add_observation(sid, kind="note", content="evict cache pool entry", ts=now - 90 * 86400)
+        new = self.db.add_observation(sid, kind="note", content="evict cache pool entry", ts=now)
+        decision = self.db.add_observation(sid, kind="decision", content="evict cache pool entry", ts=now - 90 * 86400)
+        self.assertEqual(self.db.search("evict cache")[0].id, new)
+
+        self.db.rank = RankConfig(recency_weight=0.0)
+        self.assertEqual(self.db.search("evict cache")[0].id, decision)
+
+        self.db.rank = RankConfig(recency_weight=0.0, kind_weights={})
+        for _ in range(20):
+            self.db.get_observations([old])
+        self.db.timeline(old)
+        self.db.close()
+        self.db = TraeMemDB(self.db_path, rank=RankConfig(recency_weight=0.0, kind_weights={}))
+        self.assertEqual(self.db.access_counts([old, new]), {old: 21})
+        self.assertEqual(self.db.search("evict cache")[0].id, old)
+
+        self.db.rank = RankConfig(enabled=False)
+        self.assertEqual([h.score < 0 for h in self.db.search("evict cache")], [True] * 3)
+
+        env = {"TRAE_MEM_RANK_RECENCY_WEIGHT": "0", "TRAE_MEM_RANK_ACCESS_WEIGHT": "0.5", "TRAE_MEM_RANK_POOL": "40"}
+        with mock.patch.dict(os.environ, env):
+            cfg = RankConfig.from_env()
+        self.assertEqual((cfg.recency_weight, cfg.access_weight, cfg.pool), (0.0, 0.5, 40))
+
+    def test_mcp_timeline_tool_call_collapses_repeats(self) -> None:
+        sid = self.db.new_session()
+        out = "FAILED tests/test_player.py::test_preload_{n} - AssertionError: expected 3 buffered segments, got 0"
+        first = self.db.add_observation(sid, kind="tool", tool_name="Bash", content=out.format(n=1))
+        self.db.add_observation(sid, kind="tool", tool_name="Bash", content=out.format(n=2))
+        msgs = [
+            {"jsonrpc": "2.0", "id": 1, "method": "initialize", "params": {}},
+            {"jsonrpc": "2.0", "method": "notifications/initialized"},
+            {
+                "jsonrpc": "2.0",
+                "id": 2,
+                "method": "tools/call",
+                "params": {"name": "trae_mem_timeline", "arguments": {"observation_id": first}},
+            },
+        ]
+        proc = subprocess.run(
+            [sys.executable, "-m", "trae_mem.mcp_server"],
+            input="".join(json.dumps(m) + "\n" for m in msgs),
+            capture_output=True,
+            text=True,
+            timeout=30,
+            env={**os.environ, "TRAE_MEM_DB": str(self.db_path)},
+            cwd=str(Path(__file__).resolve().parent.parent),
+        )
+        replies = {r["id"]: r for r in map(json.loads, proc.stdout.splitlines())}
+        self.assertNotIn("error", replies[2])
+        items = replies[2]["result"]["structuredContent"]["items"]
+        self.assertEqual([(r["id"], r["repeat_count"]) for r in items], [(first, 2)])
+
+    def test_ranked_search_pages_past_candidate_pool(self) -> None:
+        now = int(time.time())
+        sid = self.db.new_session()
+        ids = [
+            self.db.add_observation(sid, kind="note", content=f"paging marker row {i}", ts=now - i * 3600)
+            for i in range(250)
+        ]
+        self.assertEqual(self.db.rank.pool, 100)
+        for query, path, rank in (("paging marker", "f:", True), ("ag", "l:", True), ("paging marker", "f:", False)):
+            self.db.rank = RankConfig(enabled=rank)
+            got: list[str] = []
+            cursor = None
+            while True:
+                hits, cursor = self.db.search_page(query, limit=30, cursor=cursor)
+                self.assertTrue(cursor is None or cursor.startswith(path))
+                got += [h.id for h in hits]
+                # 翻页期间访问次数变化（打分随之改变）也不会重复或漏行。
+                self.db.get_observations(ids[len(got) % 250 :][:40])
+                with self.db._write():
+                    pass
+                if cursor is None:
+                    break
+            self.assertEqual(len(got), 250)
+            self.assertEqual(sorted(got), sorted(ids))
+        with self.assertRaises(ValueError):
+            self.db.search_page("paging marker", cursor="f:x:y:z")
+
+    def test_near_duplicate_tool_output_collapses_to_canonical(self) -> None:
+        sid = self.db.new_session()
+        out = "FAILED tests/test_player.py::test_preload_{n} - AssertionError: expected 3 buffered segments, got 0"
+        first = self.db.add_observation(sid, kind="tool", tool_name="Bash", content=out.format(n=1))
+        self.db.add_observation(sid, kind="note", content="switch preload to LRU eviction")
+        second = self.db.add_observation(sid, kind="tool", tool_name="Bash", content=out.format(n=27))
+        self.db.open_tool_call(sid, "id:t1", "Bash", "输入=pytest\n输出=（执行中）")
+        third = self.db.complete_tool_call("id:t1", out.format(n=903))
+        other = self.db.add_observation(sid, kind="tool", tool_name="Read", content=out.format(n=1))
+
+        rows = {r.id: r for r in self.db.get_observations_by_session(sid)}
+        self.assertEqual(rows[first].repeat_count, 3)
+        self.assertEqual((rows[second].canonical_id, rows[third].canonical_id), (first, first))
+        self.assertIsNone(rows[other].canonical_id)
+        hits = self.db.search("buffered segments", tool_name="Bash")
+        self.assertEqual([(h.id, h.repeat_count) for h in hits], [(first, 3)])
+        self.assertRegex(hits[0].snippet, r"\[[^]]+\]")
+        # 重复记录也在索引里：只出现在它身上的数字仍能搜到，每组只返回一条。
+        self.assertEqual([h.id for h in self.db.search("test_preload_903")], [third])
+        self.assertEqual([h.id for h in self.db.search("test_preload_27", tool_name="Bash")], [second])
+
+        items = collapse_repeats(self.db.timeline(first))
+        self.assertEqual([(r.id, r.repeat_count) for r in items if r.tool_name == "Bash"], [(first, 3)])
+        self.assertEqual(len(items), 3)
+        self.assertEqual(sum(1 for o in self.db.iter_session_observations(sid) if o.tool_name == "Bash"), 1)
+
+    def test_entity_index_answers_file_symbol_and_command_point_queries(self) -> None:
+        sid = self.db.new_session(project_path="/work/player")
+        self.db.open_tool_call(sid, "id:e1", "Read", '输入={"file_path": "/work/player/src/cache/preload.py"}\n输出=（执行中）')
+        read = self.db.complete_tool_call(
+            "id:e1", '输入={"file_path": "/work/player/src/cache/preload.py"}\n输出=class SegmentCache:\n    def evict_lru(self):'
+        )
+        run = self.db.add_observation(
+            sid,
+            kind="tool",
+            tool_name="Bash",
+            content='输入={"command": "cd /work/player && python -m pytest -q tests/test_preload.py"}\n'
+            "输出=FAILED tests/test_preload.py::test_evict - SegmentCache.evict_lru raised KeyError",
+        )
+        self.db.add_observation(sid, kind="user", content="preload.py 里的 SegmentCache 有问题")
+
+        self.assertEqual([h.id for h in self.db.lookup_entity("preload.py")], [read])
+        self.assertEqual([h.id for h in self.db.lookup_entity("./src/cache/preload.py", kind="file")], [read])
+        self.assertEqual({h.id for h in self.db.lookup_entity("SegmentCache")}, {read, run})
+        self.assertEqual([h.id for h in self.db.lookup_entity("python -m pytest")], [run])
+        self.assertEqual([h.id for h in self.db.lookup_entity("test_preload.py", project="/work/player")], [run])
+        self.assertEqual(self.db.lookup_entity("test_preload.py", project="/elsewhere"), [])
+        self.assertEqual(self.db.lookup_entity("SegmentCache", kind="command"), [])
+        # 工具输出改写后重建实体，PreToolUse 阶段的 "执行中" 内容不残留。
+        self.assertEqual(self.db.lookup_entity("evict_lru", kind="symbol")[0].entity_kind, "symbol")
+
+    def test_error_fingerprints_aggregate_failures_across_sessions(self) -> None:
+        trace = (
+            "Traceback (most recent call last):\n"
+            '  File "/home/{user}/player/trae_mem/db.py", line {line}, in search\n'
+            'sqlite3.OperationalError: fts5: syntax error near "-"'
+        )
+        first = self.db.new_session(project_path="/work/player")
+        self.db.add_observation(first, kind="error", content=trace.format(user="ci", line=120), ts=1_700_000_000)
+        self.db.add_observation(first, kind="decision", content="修复：查询先经 compile_query 加引号再 MATCH", ts=1_700_000_100)
+        second = self.db.new_session(project_path="/work/player")
+        self.db.open_tool_call(second, "id:f1", "Bash", '输入={"command": "pytest"}\n输出=（执行中）')
+        self.db.complete_tool_call(
+            "id:f1", '输入={"command": "pytest"}\n输出=' + json.dumps({"stdout": trace.format(user="dev", line=98)})
+        )
+        self.db.add_observation(second, kind="tool", tool_name="Read", content='输出={"content": "raise ValueError(x)"}')
+        other = self.db.new_session(project_path="/work/other")
+        self.db.add_observation(other, kind="error", content="E/ExoPlayerImplInternal: Playback error 0x7f01 source error")
+
+        [failure] = self.db.recurring_failures(project="/work/player")
+        self.assertEqual((failure.count, failure.session_count), (2, 2))
+        self.assertEqual(failure.title, 'sqlite3.OperationalError: fts5: syntax error near "-"')
+        self.assertEqual(self.db.recurring_failures(project="/work/other"), [])
+        looked_up = self.db.lookup_failure(error=trace.format(user="me", line=7))
+        self.assertEqual(looked_up.fingerprint if looked_up else None, failure.fingerprint)
+        self.assertEqual({s.session_id for s in self.db.failure_sessions(failure.fingerprint)}, {first, second})
+        self.assertEqual([o.kind for o in self.db.failure_followups(failure.fingerprint)], ["decision"])
+        self.assertIn("反复出现的错误", build_injection_block(self.db, query="", project_path="/work/player"))
+
+    def test_tag_filters_use_observation_tags_index(self) -> None:
+        sid = self.db.new_session()
+        main = self.db.add_observation(sid, kind="note", content="preload 改成 LRU", tags={"branch": "main", "task": "T-12"})
+        dev = self.db.add_observation(sid, kind="note", content="preload 回滚试验", tags={"branch": "dev", "task": "T-12"})
+        self.db.open_tool_call(sid, "id:g1", "Bash", "输入=make\n输出=（执行中）", tags={"branch": "main"})
+        tool = self.db.complete_tool_call("id:g1", "输入=make\n输出=preload ok", tags={"retry": 2})
+
+        self.assertEqual([h.id for h in self.db.search("preload", tags={"branch": "dev"})], [dev])
+        self.assertEqual({h.id for h in self.db.search("preload", tags={"task": "T-12"})}, {main, dev})
+        self.assertEqual(self.db.search("preload", tags={"branch": "main", "task": "T-99"}), [])
+        rows = self.db.get_observations_by_session(sid, tags={"branch": "main"})
+        self.assertEqual([r.id for r in rows], [main, tool])
+        self.assertEqual([r.id for r in self.db.timeline(main, tags={"status": "done", "retry": "2"})], [tool])
+        self.assertEqual(self.db.get_observations_by_session(sid, tags={"status": "pending"}), [])
+
+        pred, params = _observation_filters("o", tags={"branch": "main"})
+        plan = " ".join(
+            r[3] for r in self.db._reader().execute(f"EXPLAIN QUERY PLAN SELECT o.id FROM observations o WHERE 1{pred}", params)
+        )
+        self.assertIn("observation_tags USING PRIMARY KEY", plan)
+
+    def test_session_end_backfills_missed_events_from_transcript(self) -> None:
+        from trae_mem import hooks_bridge
+        from trae_mem.transcript import ingest_transcript
+
+        env = {"TRAE_MEM_DB": str(self.db_path), "TRAE_MEM_SESSION_MAP": str(Path(self.tmpdir.name) / "map.json")}
+        base = {"session_id": "t-1", "cwd": "/work/player"}
+        lines = [
+            {"type": "user", "timestamp": "2026-10-01T08:00:00Z", "message": {"role": "user", "content": "修一下预加载"}},
+            {"type": "assistant", "message": {"content": [{"type": "tool_use", "id": "tu1", "name": "Bash", "input": {"command": "pytest"}}]}},
+            {"type": "user", "message": {"content": [{"type": "tool_result", "tool_use_id": "tu1", "content": "3 passed"}]}},
+            {"type": "assistant", "message": {"content": [{"type": "tool_use", "id": "tu2", "name": "Read", "input": {"file_path": "a.py"}}]}},
+            {"type": "user", "message": {"content": [{"type": "tool_result", "tool_use_id": "tu2", "content": "print(1)"}]}},
+            {"type": "user", "timestamp": "2026-10-01T08:05:00Z", "message": {"role": "user", "content": "修一下预加载"}},
+        ]
+        transcript = Path(self.tmpdir.name) / "t.jsonl"
+        # 末尾是仍在写入的半行，不应被消费。
+        body = "\n".join(json.dumps(x, ensure_ascii=False) for x in lines) + '\n{"type": "us'
+        transcript.write_text(body, encoding="utf-8")
+        with mock.patch.dict(os.environ, env):
+            hooks_bridge.handle_user_prompt_submit({**base, "prompt": "修一下预加载"})
+            hooks_bridge.handle_pre_tool_use({**base, "tool_use_id": "tu1", "tool_name": "Bash", "tool_input": {"command": "pytest"}})
+            hooks_bridge.handle_session_end({**base, "reason": "exit", "transcript_path": str(transcript)})
+            sid = hooks_bridge._lookup_session(self.db, "t-1", "/work/player")
+
+        rows = self.db.get_observations_by_session(sid or "")
+        self.assertEqual(
+            [(r.kind, r.tool_name) for r in rows],
+            [("user", None), ("tool", "Bash"), ("tool", "Read"), ("user", None), ("note", None)],
+        )
+        bash, read = json.loads(rows[1].tags_json), json.loads(rows[2].tags_json)
+        self.assertEqual((bash["status"], bash["source"]), ("done", "transcript"))
+        self.assertIn("3 passed", rows[1].content)
+        self.assertEqual((read["source"], read["transcript_line"]), ("transcript", 4))
+        self.assertEqual(self.db.get_observations_by_session(sid or "", tags={"source": "transcript"})[-1].ts, 1790841900)
+        self.assertIsNotNone(self.db.get_latest_summary(sid or ""))
+        self.assertEqual(ingest_transcript(self.db, sid or "", str(transcript)), 0)
+
+    def test_change_feed_cursor_and_long_poll(self) -> None:
+        import threading
+        import urllib.request
+        from http.server import ThreadingHTTPServer
+
+        from trae_mem.api import _Handler
+
+        start = self.db.latest_change()
+        sid = self.db.new_session(project_path="/tmp/p")
+        obs = self.db.open_tool_call(sid, "c1", "Bash", "输入=pytest")
+        self.db.complete_tool_call("c1", "输入=pytest\n输出=ok")
+        changes = self.db.changes(start)
+        self.assertEqual(
+            [(c.op, c.entity, c.entity_id) for c in changes],
+            [("insert", "session", sid), ("insert", "observation", obs), ("update", "observation", obs)],
+        )
+        cursor = changes[-1].seq
+        self.assertEqual(self.db.changes(cursor), [])
+        self.assertEqual(self.db.changes(start, limit=1, entity="observation")[0].entity_id, obs)
+
+        class Handler(_Handler):
+            pass
+
+        Handler.db = self.db
+        readers = len(self.db._readers)
+        httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        try:
+            timer = threading.Timer(0.2, lambda: self.db.add_summary(sid, "brief", "摘要"))
+            timer.start()
+            t0 = time.monotonic()
+            url = f"http://127.0.0.1:{httpd.server_address[1]}/changes?since={cursor}&wait=10"
+            with urllib.request.urlopen(url, timeout=10) as resp:
+                body = json.loads(resp.read())
+            timer.join()
+            # 同进程写入提交即唤醒，不必等到超时。
+            self.assertLess(time.monotonic() - t0, 5)
+            self.assertEqual([(c["op"], c["entity"]) for c in body["changes"]], [("insert", "summary")])
+            self.assertEqual(body["cursor"], body["changes"][-1]["seq"])
+            # 处理线程的只读连接在请求结束时关闭，不随请求数累积。
+            for _ in range(5):
+                with urllib.request.urlopen(url.replace("wait=10", "wait=0"), timeout=10) as resp:
+                    resp.read()
+            deadline = time.monotonic() + 2
+            while len(self.db._readers) > readers and time.monotonic() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(len(self.db._readers), readers)
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+
+    def test_sync_exchanges_only_new_rows_and_converges_on_conflict(self) -> None:
+        from trae_mem import sync
+
+        shared = str(Path(self.tmpdir.name) / "shared")
+        other = TraeMemDB(Path(self.tmpdir.name) / "other.sqlite3")
+        other.init_schema()
+        try:
+            sid = self.db.new_session(project_path="/work/player")
+            self.db.add_observation(sid, kind="user", content="修一下 PreloadManager 的缓存")
+            self.db.open_tool_call(sid, "c1", "Bash", '输入={"command": "pytest"}')
+            self.db.complete_tool_call("c1", '输入={"command": "pytest"}\n输出={"stdout": "ValueError: bad size 42"}')
+            self.db.add_observation(sid, kind="note", content="<private>token</private>", private=True)
+            self.assertEqual(sync.push(self.db, shared)["rows"], 3)
+            self.assertEqual(sync.push(self.db, shared)["rows"], 0)
+
+            self.assertEqual(sync.pull(other, shared)["applied"], 3)
+            rows = other.get_observations_by_session(sid)
+            self.assertEqual([r.kind for r in rows], ["user", "tool"])
+            self.assertEqual(json.loads(rows[1].tags_json)["status"], "done")
+            # 派生索引在接收端增量重建：全文检索、实体索引、失败聚合。
+            self.assertTrue(other.search("缓存", limit=5))
+            self.assertTrue(other.lookup_entity("pytest", kind="command"))
+            self.assertIsNotNone(other.lookup_failure(error="ValueError: bad size 7"))
+            # 导入的记录不会被推回；重复拉取不做任何事。
+            self.assertEqual(sync.push(other, shared)["rows"], 0)
+            self.assertEqual(sync.pull(other, shared)["segments"], 0)
+
+            # 两边各自结束同一会话：修改时间较新的一方胜出，交换后两边一致。
+            with mock.patch("trae_mem.db.time.time", return_value=2_000_000_000.0):
+                self.db.end_session(sid)
+            with mock.patch("trae_mem.db.time.time", return_value=2_000_000_100.0):
+                other.end_session(sid)
+            sync.push(self.db, shared)
+            sync.push(other, shared)
+            sync.pull(self.db, shared)
+            sync.pull(other, shared)
+            self.assertEqual(self.db.get_session(sid).ended_at, 2_000_000_100)
+            self.assertEqual(other.get_session(sid).ended_at, 2_000_000_100)
+        finally:
+            other.close()
+
+    def test_online_backup_rotates_and_restore_verifies_integrity(self) -> None:
+        import gzip
+
+        from trae_mem import backup
+
+        sid = self.db.new_session(project_path="/tmp/p")
+        self.db.add_observation(sid, kind="note", content="备份前的记录 before_backup")
+        out = Path(self.tmpdir.name) / "backups"
+        first = backup.create_backup(self.db_path, out, keep=2, pages=1)
+        self.assertGreater(first["steps"], 1)
+        self.assertEqual(backup.verify_backup(Path(first["path"])), [])
+        backup.create_backup(self.db_path, out, keep=2)
+        third = backup.create_backup(self.db_path, out, keep=2)
+        self.assertEqual(len(backup.list_backups(out)), 2)
+        self.assertIn(Path(first["path"]).name, third["removed"])
+
+        self.db.add_observation(sid, kind="note", content="备份之后的记录 after_backup")
+        backup.restore_backup(Path(third["path"]), self.db_path)
+        self.assertTrue(self.db.search("before_backup"))
+        self.assertFalse(self.db.search("after_backup"))
+
+        # 损坏的备份：校验失败，目标库保持原样。
+        bad = out / f"{backup.BACKUP_PREFIX}bad{backup.BACKUP_SUFFIX}"
+        raw = bytearray(gzip.decompress(Path(third["path"]).read_bytes()))
+        raw[4096 * 2 : 4096 * 2 + 512] = b"\xff" * 512
+        bad.write_bytes(gzip.compress(bytes(raw)))
+        with self.assertRaises(ValueError):
+            backup.restore_backup(bad, self.db_path)
+        self.assertTrue(backup.verify_backup(bad))
+        self.assertTrue(self.db.search("before_backup"))
+
+    def test_multi_tenant_server_routes_and_bounds_open_databases(self) -> None:
+        import threading
+        import urllib.error
+        import urllib.request
+        from http.server import ThreadingHTTPServer
+
+        from trae_mem.api import _Handler
+        from trae_mem.pool import DEFAULT_TENANT, DBPool, TenantBusy, tenants_path_resolver
+
+        root = Path(self.tmpdir.name) / "tenants"
+        for name in ("alice", "bob"):
+            db = TraeMemDB(root / name / "trae_mem.sqlite3")
+            db.init_schema()
+            db.add_observation(db.new_session(), kind="note", content=f"{name} 的预加载笔记 marker_{name}")
+            db.close()
+        pool = DBPool(tenants_path_resolver(root), max_open=2, idle_s=60, max_concurrency=1, queue_s=0.2)
+        pool.register(DEFAULT_TENANT, self.db)
+        # default 常驻 + 上限 2：打开 bob 时淘汰最久未用的 alice。
+        pool.acquire("alice").close()
+        pool.acquire("bob").close()
+        self.assertEqual(pool.open_tenants(), [DEFAULT_TENANT, "bob"])
+
+        class Handler(_Handler):
+            pass
+
+        Handler.db = self.db
+        Handler.pool = pool
+        httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        base = f"http://127.0.0.1:{httpd.server_address[1]}"
+
+        def get(path: str, tenant: str = "") -> tuple[int, dict]:
+            req = urllib.request.Request(base + path, headers={"X-Trae-Mem-Tenant": tenant} if tenant else {})
+            try:
+                with urllib.request.urlopen(req, timeout=5) as resp:
+                    return resp.status, json.loads(resp.read())
+            except urllib.error.HTTPError as e:
+                return e.code, {}
+
+        try:
+            status, body = get("/t/alice/search?q=marker_alice")
+            self.assertEqual((status, len(body["results"])), (200, 1))
+            status, body = get("/search?q=marker_alice", tenant="bob")
+            self.assertEqual((status, body["results"]), (200, []))
+            self.assertEqual(get("/t/mallory/health")[0], 404)
+            self.assertEqual(get("/t/..%2Fx/health")[0], 404)
+
+            lease = pool.acquire("bob")
+            try:
+                with self.assertRaises(TenantBusy):
+                    pool.acquire("bob")
+                self.assertEqual(get("/health", tenant="bob")[0], 429)
+                self.assertEqual(get("/health")[0], 200)
+            finally:
+                lease.close()
+            pool.idle_s = 0
+            self.assertGreaterEqual(pool.evict_idle(), 1)
+            self.assertEqual(pool.open_tenants(), [DEFAULT_TENANT])
+            text = REGISTRY.render_prometheus()
+            self.assertIn('trae_mem_pool_evictions_total{reason="lru",tenant="alice"}', text)
+            self.assertIn('trae_mem_tenant_rejected_total{tenant="bob"}', text)
+            # 不存在的租户名不进入指标标签，统一记为 unknown。
+            self.assertIn('path="/search",tenant="alice"', text)
+            self.assertIn('path="/health",tenant="unknown"', text)
+            self.assertNotIn("mallory", text)
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+            pool.close()
+
+
+    def test_http_responses_project_compress_and_revalidate(self) -> None:
+        import gzip
+        import threading
+        import urllib.error
+        import urllib.request
+        from email.message import Message
+        from http.server import ThreadingHTTPServer
+
+        from trae_mem.api import _Handler
+        from trae_mem.mcp_server import _tool_json_result
+
+        sid = self.db.new_session()
+        for i in range(20):
+            self.db.add_observation(sid, kind="note", content=f"响应整形 marker_shape 第 {i} 条 " + "x" * 80)
+        failing = self.db.new_session()
+        self.db.add_observation(failing, kind="error", content="ValueError: preload window must be positive")
+        self.db.add_observation(failing, kind="decision", content="修复：窗口下限设为 1")
+        [failure] = self.db.recurring_failures(min_count=1)
+
+        class Handler(_Handler):
+            pass
+
+        Handler.db = self.db
+        httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        base = f"http://127.0.0.1:{httpd.server_address[1]}"
+
+        def get(path: str, **headers: str) -> tuple[int, Message, bytes]:
+            req = urllib.request.Request(base + path, headers=headers)
+            try:
+                with urllib.request.urlopen(req, timeout=5) as resp:
+                    return resp.status, resp.headers, resp.read()
+            except urllib.error.HTTPError as e:
+                return e.code, e.headers, e.read()
+
+        try:
+            status, _, body = get("/search?q=marker_shape&limit=5&fields=id,kind&compact=1")
+            self.assertEqual(status, 200)
+            hits = json.loads(body)["results"]
+            self.assertEqual([sorted(h) for h in hits], [["id", "kind"]] * 5)
+            self.assertNotIn(b", ", body)
+            self.assertEqual(get("/search?q=marker_shape&fields=nope")[0], 400)
+            # fields 只作用于路由的主结果；同一响应里其它记录（sessions、followups）保持完整。
+            status, _, body = get(f"/failures?fingerprint={failure.fingerprint}&fields=title")
+            self.assertEqual(status, 200)
+            payload = json.loads(body)
+            self.assertEqual(payload["failure"], {"title": failure.title})
+            self.assertEqual(payload["sessions"][0]["session_id"], failing)
+            self.assertEqual([o["kind"] for o in payload["followups"]], ["decision"])
+
+            status, headers, body = get("/session_observations?session_id=" + sid, **{"Accept-Encoding": "gzip"})
+            self.assertEqual(headers.get("Content-Encoding"), "gzip")
+            self.assertEqual(len(json.loads(gzip.decompress(body))["items"]), 20)
+            # Accept-Encoding 按编码列表与 q 值解析，不做子串匹配。
+            for accept, gzipped in (
+                ("gzip;q=0", False),
+                ("x-gzip-foo", False),
+                ("br, gzip;q=0.5", True),
+                ("*;q=0.1", True),
+                ("gzip;q=0, *", False),
+                ("identity", False),
+            ):
+                headers = get("/session_observations?session_id=" + sid, **{"Accept-Encoding": accept})[1]
+                self.assertEqual(headers.get("Content-Encoding") == "gzip", gzipped, accept)
+
+            status, headers, _ = get("/inject?q=marker_shape")
+            etag = headers["ETag"]
+            self.assertEqual(get("/inject?q=marker_shape", **{"If-None-Match": etag})[:1], (304,))
+            self.db.add_observation(sid, kind="note", content="新的写入 marker_shape")
+            status, headers, _ = get("/inject?q=marker_shape", **{"If-None-Match": etag})
+            self.assertEqual(status, 200)
+            self.assertNotEqual(headers["ETag"], etag)
+
+            # ETag 区分请求变体；If-None-Match 按列表解析、弱比较，不做子串匹配。
+            etag = get("/search?q=marker_shape&limit=3")[1]["ETag"]
+            other = get("/search?q=marker&limit=3")[1]["ETag"]
+            self.assertNotEqual(etag, other)
+            self.assertNotEqual(get("/search?q=marker_shape&limit=3&fields=id")[1]["ETag"], etag)
+            self.assertEqual(get("/search?limit=3&q=marker_shape", **{"If-None-Match": f'"x", {etag}'})[0], 304)
+            self.assertEqual(get("/search?q=marker_shape&limit=3", **{"If-None-Match": etag[2:]})[0], 304)
+            self.assertEqual(get("/search?q=marker_shape&limit=3", **{"If-None-Match": etag[:-1] + '0"'})[0], 200)
+            self.assertEqual(get("/search?q=marker&limit=3", **{"If-None-Match": etag})[0], 200)
+            self.assertEqual(get("/timeline?observation_id=x", **{"If-None-Match": "*"})[0], 304)
+            # 访问计数落盘会改变排序，排序结果的 ETag 随之变化。
+            self.db.get_observations([self.db.search("marker_shape")[-1].id])
+            with self.db._write():
+                pass
+            self.assertEqual(get("/search?q=marker_shape&limit=3", **{"If-None-Match": etag})[0], 200)
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+
+        rows = self.db.get_observations_by_session(sid, limit=3)
+        with mock.patch.dict(os.environ, {"TRAE_MEM_MCP_TEXT": "none"}):
+            res = _tool_json_result({"items": rows}, rows)
+        self.assertLess(len(res["content"][0]["text"]), 40)
+        self.assertEqual(len(res["structuredContent"]["items"]), 3)
+        with mock.patch.dict(os.environ, {"TRAE_MEM_MCP_TEXT": "compact"}):
+            text = _tool_json_result({"items": rows}, rows)["content"][0]["text"]
+        self.assertEqual(len(json.loads(text)), 3)
+        self.assertNotIn("\n", text)
 
 if __name__ == "__main__":
     unittest.main()
@@ -1,15 +1,104 @@
 import json
+import re
+import threading
+import time
 import urllib.parse
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
 from typing import Any, Optional
 
-from .db import TraeMemDB
+from .backup import backup_interval_from_env, start_backup_scheduler
+from .db import TraeMemDB, to_json
+from .dedup import collapse_repeats
+from .entities import ENTITY_KINDS
+from .inject import build_injection_block
+from .metrics import REGISTRY
+from .pool import DEFAULT_TENANT, DBPool, Lease, TenantBusy, UnknownTenant, tenants_path_resolver
+from .profiling import profiled
+from .tags import parse_tag_filter
+
+
+def _project(payload: Any, fields: list[str], primary: Optional[str]) -> Any:
+    # 只投影路由的主结果（一条记录或记录列表）；游标、查询词以及同一响应里的其它记录（如 /failures 的
+    # sessions、followups）原样保留。
+    def one(r: Any) -> Any:
+        if not hasattr(r, "as_dict"):
+            return r
+        unknown = [f for f in fields if f not in r.keys()]
+        if unknown:
+            raise ValueError(f"unknown fields: {', '.join(unknown)}")
+        return {f: r[f] for f in fields}
+
+    if primary is None or not isinstance(payload, dict) or primary not in payload:
+        return payload
+    v = payload[primary]
+    return {**payload, primary: [one(x) for x in v] if isinstance(v, list) else one(v)}
+
+
+def _json_response(handler: BaseHTTPRequestHandler, status: int, payload: Any, primary: Optional[str] = None) -> None:
+    # 响应整形（fields 投影、compact 编码、gzip、ETag）由请求参数决定，见 _Handler._dispatch；
+    # primary 是 fields 作用的主结果键。
+    fields = getattr(handler, "fields", None)
+    if fields and status == 200:
+        try:
+            payload = _project(payload, fields, primary)
+        except ValueError as e:
+            status, payload = 400, {"error": str(e)}
+    body = to_json(payload, compact=bool(getattr(handler, "compact", False))).encode("utf-8")
+    handler.send_response(status)
+    handler.send_header("content-type", "application/json; charset=utf-8")
+    etag = getattr(handler, "etag", None)
+    if etag and status == 200:
+        handler.send_header("etag", etag)
+        handler.send_header("cache-control", "no-cache")
+    handler.send_header("vary", "accept-encoding, x-trae-mem-tenant")
+    if len(body) >= _GZIP_MIN_BYTES and _accepts_gzip(handler.headers.get("accept-encoding") or ""):
+        import gzip
+
+        body = gzip.compress(body, compresslevel=5)
+        handler.send_header("content-encoding", "gzip")
+    handler.send_header("content-length", str(len(body)))
+    handler.end_headers()
+    handler.wfile.write(body)
 
 
-def _json_response(handler: BaseHTTPRequestHandler, status: int, payload: Any) -> None:
-    body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+def _accepts_gzip(header: str) -> bool:
+    # Accept-Encoding 是带 q 值的编码列表：gzip（x-gzip 为同义词）或 * 的 q>0 才压缩；显式列出的 gzip 优先于 *。
+    explicit: Optional[float] = None
+    wildcard: Optional[float] = None
+    for item in header.split(","):
+        coding, _, params = item.partition(";")
+        coding = coding.strip().lower()
+        q = 1.0
+        for param in params.split(";"):
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value.strip())
+                except ValueError:
+                    q = 0.0
+        if coding in ("gzip", "x-gzip"):
+            explicit = q if explicit is None else max(explicit, q)
+        elif coding == "*":
+            wildcard = q
+    if explicit is not None:
+        return explicit > 0
+    return wildcard is not None and wildcard > 0
+
+
+def _etag_matches(header: str, etag: str) -> bool:
+    # If-None-Match 是逗号分隔的实体标签列表，"*" 匹配任意；按弱比较，忽略 W/ 前缀。
+    opaque = etag[2:] if etag.startswith("W/") else etag
+    for tag in _ETAG_RE.findall(header):
+        if tag == "*" or (tag[2:] if tag.startswith("W/") else tag) == opaque:
+            return True
+    return False
+
+
+def _text_response(handler: BaseHTTPRequestHandler, status: int, text: str, content_type: str) -> None:
+    body = text.encode("utf-8")
     handler.send_response(status)
-    handler.send_header("content-type", "application/json; charset=utf-8")
+    handler.send_header("content-type", content_type)
     handler.send_header("content-length", str(len(body)))
     handler.end_headers()
     handler.wfile.write(body)
@@ -23,17 +112,142 @@ def _read_json(handler: BaseHTTPRequestHandler) -> Any:
     return json.loads(raw.decode("utf-8"))
 
 
-def _row_to_dict(row) -> dict[str, Any]:
-    return {k: row[k] for k in row.keys()}
+def _since_cursor(raw: Optional[str], db: TraeMemDB) -> int:
+    # "now" 表示只订阅之后的变更。
+    if raw == "now":
+        return db.latest_change()
+    return int(raw or "0")
+
+
+def _int_or_none(v: Optional[str]) -> Optional[int]:
+    return int(v) if v not in (None, "") else None
+
+
+def _search_filters(qs: dict[str, list[str]]) -> dict[str, Any]:
+    kinds = [k for v in qs.get("kind") or [] for k in v.split(",") if k]
+    return {
+        "project": (qs.get("project") or [None])[0],
+        "kinds": kinds or None,
+        "tool_name": (qs.get("tool_name") or [None])[0],
+        "session_id": (qs.get("session_id") or [None])[0],
+        "since": _int_or_none((qs.get("since") or [None])[0]),
+        "until": _int_or_none((qs.get("until") or [None])[0]),
+        "tags": parse_tag_filter(qs.get("tags")),
+    }
+
+
+_GZIP_MIN_BYTES = 1024
+_GET_ROUTES = ("/health", "/metrics", "/search", "/timeline", "/session_observations", "/entity", "/failures", "/changes", "/inject")
+_POST_ROUTES = ("/get_observations",)
+# 结果只取决于库内容的读接口：带 ETag，If-None-Match 命中时不执行查询直接 304。
+# ETag = 请求变体（租户、路径、规范化后的查询参数、是否 gzip）的哈希 + 写入代数；排序的结果（/search、
+# 带 q 的 /inject）再加上访问计数代数与时间桶，时间衰减的 now 取桶起点，同一个 ETag 对应的结果确定不变。
+_CACHEABLE_ROUTES = ("/search", "/timeline", "/session_observations", "/entity", "/failures", "/inject")
+_RANK_NOW_BUCKET_S = 300
+_ETAG_RE = re.compile(r'(?:W/)?"[^"]*"|\*')
+# 租户可由路径前缀 /t/<name>/... 或请求头 X-Trae-Mem-Tenant 指定，前者优先；都没有时为 default（--db 库）。
+_TENANT_PREFIX_RE = re.compile(r"^/t/([^/]+)(/.*)$")
+_CHANGES_MAX_LIMIT = 1000
+_CHANGES_MAX_WAIT = 60.0
+_SSE_KEEPALIVE_S = 15.0
 
 
 class _Handler(BaseHTTPRequestHandler):
     db: TraeMemDB
+    pool: Optional[DBPool] = None
+    _lease: Optional[Lease] = None
+    fields: Optional[list[str]] = None
+    compact = False
+    etag: Optional[str] = None
+    rank_now: Optional[float] = None
 
     def log_message(self, format: str, *args: Any) -> None:
         return
 
     def do_GET(self) -> None:
+        self._dispatch("GET", _GET_ROUTES, self._get)
+
+    def do_POST(self) -> None:
+        self._dispatch("POST", _POST_ROUTES, self._post)
+
+    def _dispatch(self, method: str, routes: tuple[str, ...], handle: Any) -> None:
+        parsed = urllib.parse.urlparse(self.path)
+        path = parsed.path
+        tenant = (self.headers.get("x-trae-mem-tenant") or "").strip() or DEFAULT_TENANT
+        m = _TENANT_PREFIX_RE.match(path)
+        if m:
+            tenant, path = m.group(1), m.group(2)
+            self.path = path + (f"?{parsed.query}" if parsed.query else "")
+        route = path if path in routes else "other"
+        qs = urllib.parse.parse_qs(parsed.query)
+        self.fields = [f for v in qs.get("fields") or [] for f in v.split(",") if f] or None
+        self.compact = (qs.get("compact") or ["0"])[0].lower() in ("1", "true", "yes")
+        self.etag = None
+        self.rank_now = None
+
+        def run() -> None:
+            if method == "GET" and path in _CACHEABLE_ROUTES:
+                self.etag = self._etag(tenant, path, parsed.query, qs)
+                if _etag_matches(self.headers.get("if-none-match") or "", self.etag):
+                    return self._not_modified()
+            handle()
+
+        # 租户名来自请求头或路径，未经校验前不能作为指标标签（否则序列数无上限）：确认租户存在后才换上真实名字。
+        with profiled(f"http-{method}{route}"), REGISTRY.timer(
+            "trae_mem_http_seconds", method=method, path=route, tenant="unknown"
+        ) as labels:
+            if self.pool is None:
+                if tenant != DEFAULT_TENANT:
+                    return _json_response(self, 404, {"error": "unknown_tenant"})
+                labels["tenant"] = tenant
+                # 每个连接一个线程：请求结束即关闭本线程的只读连接，否则连接与文件句柄随线程数累积。
+                try:
+                    return run()
+                finally:
+                    self.db.release_reader()
+            try:
+                lease = self.pool.acquire(tenant)
+            except UnknownTenant:
+                return _json_response(self, 404, {"error": "unknown_tenant"})
+            except TenantBusy:
+                self.send_response(429)
+                self.send_header("retry-after", "1")
+                self.send_header("content-length", "0")
+                self.end_headers()
+                return
+            labels["tenant"] = tenant
+            self.db, self._lease = lease.db, lease
+            try:
+                run()
+            finally:
+                self._lease = None
+                lease.close()
+
+    def _etag(self, tenant: str, path: str, query: str, qs: dict[str, list[str]]) -> str:
+        import hashlib
+
+        gzip_ok = _accepts_gzip(self.headers.get("accept-encoding") or "")
+        variant = to_json([tenant, path, sorted(urllib.parse.parse_qsl(query, keep_blank_values=True)), gzip_ok])
+        tag = f"{hashlib.blake2b(variant.encode('utf-8'), digest_size=8).hexdigest()}-{self.db.write_generation()}"
+        ranked = path == "/search" or (path == "/inject" and (qs.get("q") or [""])[0].strip())
+        if ranked and self.db.rank.enabled:
+            bucket = int(time.time() // _RANK_NOW_BUCKET_S)
+            self.rank_now = float(bucket * _RANK_NOW_BUCKET_S)
+            tag += f"-{self.db.access_generation()}-{bucket:x}"
+        return f'W/"{tag}"'
+
+    def _not_modified(self) -> None:
+        REGISTRY.inc("trae_mem_http_not_modified_total")
+        self.send_response(304)
+        self.send_header("etag", self.etag or "")
+        self.end_headers()
+
+    def _release_slot(self) -> None:
+        # 长轮询 / SSE 在等待期间不占租户的并发名额。
+        if self._lease is not None:
+            self._lease.release_slot()
+
+    def _get(self) -> None:
         parsed = urllib.parse.urlparse(self.path)
         path = parsed.path
         qs = urllib.parse.parse_qs(parsed.query)
@@ -41,46 +255,153 @@ class _Handler(BaseHTTPRequestHandler):
         if path == "/health":
             return _json_response(self, 200, {"ok": True})
 
+        if path == "/metrics":
+            return _text_response(self, 200, REGISTRY.render_prometheus(), "text/plain; version=0.0.4; charset=utf-8")
+
         if path == "/search":
             q = (qs.get("q") or [""])[0]
             limit = int((qs.get("limit") or ["20"])[0])
-            hits = self.db.search(q, limit=limit)
+            cursor = (qs.get("cursor") or [None])[0]
+            advanced = (qs.get("advanced") or ["0"])[0].lower() in ("1", "true", "yes")
+            try:
+                hits, next_cursor = self.db.search_page(
+                    q, limit=limit, cursor=cursor, advanced=advanced, now=self.rank_now, **_search_filters(qs)
+                )
+            except ValueError as e:
+                return _json_response(self, 400, {"error": str(e)})
+            return _json_response(self, 200, {"query": q, "results": hits, "next_cursor": next_cursor}, "results")
+
+        if path == "/timeline":
+            observation_id = (qs.get("observation_id") or [""])[0]
+            window = int((qs.get("window") or ["10"])[0])
+            limit = int((qs.get("limit") or ["200"])[0])
+            try:
+                tags = parse_tag_filter(qs.get("tags"))
+            except ValueError as e:
+                return _json_response(self, 400, {"error": str(e)})
+            rows = self.db.timeline(
+                observation_id,
+                window=window,
+                limit=limit,
+                after_seq=_int_or_none((qs.get("after") or [None])[0]),
+                before_seq=_int_or_none((qs.get("before") or [None])[0]),
+                tags=tags,
+            )
+            collapse = (qs.get("collapse") or ["1"])[0].lower() not in ("0", "false", "no")
             return _json_response(
                 self,
                 200,
                 {
-                    "query": q,
-                    "results": [
-                        {
-                            "id": h.id,
-                            "ts": h.ts,
-                            "kind": h.kind,
-                            "tool_name": h.tool_name,
-                            "session_id": h.session_id,
-                            "snippet": h.snippet,
-                            "score": h.score,
-                        }
-                        for h in hits
-                    ],
+                    "observation_id": observation_id,
+                    "prev_cursor": rows[0].seq if rows else None,
+                    "next_cursor": rows[-1].seq if len(rows) >= limit else None,
+                    "items": collapse_repeats(rows) if collapse else rows,
                 },
+                "items",
             )
 
-        if path == "/timeline":
-            observation_id = (qs.get("observation_id") or [""])[0]
-            window = int((qs.get("window") or ["10"])[0])
-            rows = self.db.timeline(observation_id, window=window)
-            return _json_response(self, 200, {"observation_id": observation_id, "items": [_row_to_dict(r) for r in rows]})
+        if path == "/session_observations":
+            session_id = (qs.get("session_id") or [""])[0]
+            limit = int((qs.get("limit") or ["500"])[0])
+            after = _int_or_none((qs.get("after") or [None])[0])
+            try:
+                tags = parse_tag_filter(qs.get("tags"))
+            except ValueError as e:
+                return _json_response(self, 400, {"error": str(e)})
+            rows = self.db.get_observations_by_session(session_id, limit=limit, after_seq=after, tags=tags)
+            return _json_response(
+                self,
+                200,
+                {
+                    "session_id": session_id,
+                    "items": rows,
+                    "next_cursor": rows[-1].seq if len(rows) >= limit else None,
+                },
+                "items",
+            )
+
+        if path == "/entity":
+            name = (qs.get("name") or [""])[0]
+            kind = (qs.get("kind") or [None])[0]
+            project = (qs.get("project") or [None])[0]
+            limit = int((qs.get("limit") or ["50"])[0])
+            if kind and kind not in ENTITY_KINDS:
+                return _json_response(self, 400, {"error": f"kind must be one of {', '.join(ENTITY_KINDS)}"})
+            hits = self.db.lookup_entity(name, kind=kind, project=project, limit=limit)
+            return _json_response(self, 200, {"entity": name, "kind": kind, "results": hits}, "results")
+
+        if path == "/failures":
+            fingerprint = (qs.get("fingerprint") or [None])[0]
+            error = (qs.get("error") or [None])[0]
+            limit = int((qs.get("limit") or ["10"])[0])
+            if fingerprint or error:
+                failure = self.db.lookup_failure(fingerprint=fingerprint, error=error)
+                if failure is None:
+                    return _json_response(self, 404, {"error": "not_found"})
+                return _json_response(
+                    self,
+                    200,
+                    {
+                        "failure": failure,
+                        "sessions": self.db.failure_sessions(failure.fingerprint, limit=limit),
+                        "followups": self.db.failure_followups(failure.fingerprint, limit=limit),
+                    },
+                    "failure",
+                )
+            project = (qs.get("project") or [None])[0]
+            min_count = int((qs.get("min_count") or ["2"])[0])
+            rows = self.db.recurring_failures(project=project, limit=limit, min_count=min_count)
+            return _json_response(self, 200, {"results": rows}, "results")
+
+        if path == "/changes":
+            entity = (qs.get("entity") or [None])[0]
+            session_id = (qs.get("session_id") or [None])[0]
+            limit = min(int((qs.get("limit") or ["100"])[0]), _CHANGES_MAX_LIMIT)
+            try:
+                since = _since_cursor(self.headers.get("last-event-id") or (qs.get("since") or [None])[0], self.db)
+            except ValueError as e:
+                return _json_response(self, 400, {"error": str(e)})
+            stream = (qs.get("stream") or ["0"])[0].lower() in ("1", "true", "yes")
+            if stream or "text/event-stream" in (self.headers.get("accept") or ""):
+                self._release_slot()
+                return self._stream_changes(since, limit, entity, session_id)
+            wait = min(float((qs.get("wait") or ["0"])[0]), _CHANGES_MAX_WAIT)
+            if wait > 0:
+                self._release_slot()
+            rows = self.db.wait_changes(since, timeout=wait, limit=limit, entity=entity, session_id=session_id)
+            return _json_response(self, 200, {"changes": rows, "cursor": rows[-1].seq if rows else since}, "changes")
 
         if path == "/inject":
             q = (qs.get("q") or [""])[0]
             limit = int((qs.get("limit") or ["12"])[0])
             project = (qs.get("project") or [None])[0]
-            text = build_injection_block(self.db, query=q, limit=limit, project_path=project)
+            text = build_injection_block(self.db, query=q, limit=limit, project_path=project, now=self.rank_now)
             return _json_response(self, 200, {"query": q, "context": text})
 
         return _json_response(self, 404, {"error": "not_found"})
 
-    def do_POST(self) -> None:
+    def _stream_changes(self, since: int, limit: int, entity: Optional[str], session_id: Optional[str]) -> None:
+        # Server-Sent Events：每条变更一个 event，id 即游标，断线重连时浏览器会带上 Last-Event-ID。
+        # 空闲时定期发注释行保活，也借此发现客户端已断开。
+        self.send_response(200)
+        self.send_header("content-type", "text/event-stream; charset=utf-8")
+        self.send_header("cache-control", "no-cache")
+        self.end_headers()
+        try:
+            while True:
+                rows = self.db.wait_changes(
+                    since, timeout=_SSE_KEEPALIVE_S, limit=limit, entity=entity, session_id=session_id
+                )
+                if not rows:
+                    self.wfile.write(b": keepalive\n\n")
+                for r in rows:
+                    self.wfile.write(f"id: {r.seq}\nevent: change\ndata: {to_json(r)}\n\n".encode("utf-8"))
+                    since = r.seq
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            return
+
+    def _post(self) -> None:
         parsed = urllib.parse.urlparse(self.path)
         path = parsed.path
 
@@ -90,70 +411,46 @@ class _Handler(BaseHTTPRequestHandler):
             if not isinstance(ids, list):
                 return _json_response(self, 400, {"error": "ids must be a list"})
             rows = self.db.get_observations([str(i) for i in ids])
-            return _json_response(self, 200, {"items": [_row_to_dict(r) for r in rows]})
+            return _json_response(self, 200, {"items": rows}, "items")
 
         return _json_response(self, 404, {"error": "not_found"})
 
 
-def build_injection_block(db: TraeMemDB, query: str, limit: int = 12, project_path: Optional[str] = None) -> str:
-    hits = db.search(query, limit=limit) if query.strip() else []
-    ids = [h.id for h in hits]
-    obs_rows = db.get_observations(ids)
-    sessions = db.get_recent_sessions(project_path=project_path, limit=5)
-
-    lines: list[str] = []
-    lines.append("【trae-mem 注入上下文】")
-
-    if query.strip():
-        lines.append(f"查询：{query.strip()}")
-
-    if sessions:
-        lines.append("")
-        lines.append("最近会话：")
-        for s in sessions[:5]:
-            started = s["started_at"]
-            ended = s["ended_at"]
-            lines.append(f"- session={s['id']} started_at={started} ended_at={ended}")
-            summary = db.get_latest_summary(session_id=s["id"], level="brief")
-            if summary and summary["content"]:
-                content = str(summary["content"]).strip()
-                if len(content) > 800:
-                    content = content[:799] + "…"
-                lines.append(f"  摘要：{content}")
-
-    if hits:
-        lines.append("")
-        lines.append("相关观测（索引级）：")
-        for h in hits:
-            tn = f"/{h.tool_name}" if h.tool_name else ""
-            lines.append(f"- {h.id} [{h.kind}{tn}] {h.snippet}")
-
-    if obs_rows:
-        lines.append("")
-        lines.append("相关观测（细节级，截断）：")
-        for r in obs_rows[: min(len(obs_rows), 20)]:
-            tool = f"/{r['tool_name']}" if r["tool_name"] else ""
-            content = (r["content"] or "").strip()
-            if len(content) > 500:
-                content = content[:499] + "…"
-            lines.append(f"- {r['id']} [{r['kind']}{tool}] {content}")
-
-    return "\n".join(lines).strip()
-
-
-def serve(db_path: Optional[str], host: str, port: int) -> None:
-    db = TraeMemDB(None if db_path is None else __import__("pathlib").Path(db_path))
+def serve(
+    db_path: Optional[str],
+    host: str,
+    port: int,
+    tenants_dir: Optional[str] = None,
+    max_open: int = 16,
+    idle_s: float = 300.0,
+    tenant_concurrency: int = 4,
+) -> None:
+    db = TraeMemDB(None if db_path is None else Path(db_path))
     db.init_schema()
+    pool = DBPool(
+        tenants_path_resolver(None if tenants_dir is None else Path(tenants_dir).expanduser()),
+        max_open=max_open,
+        idle_s=idle_s,
+        max_concurrency=tenant_concurrency,
+    )
+    pool.register(DEFAULT_TENANT, db)
 
     class Handler(_Handler):
         pass
 
     Handler.db = db
-    httpd = HTTPServer((host, port), Handler)
+    Handler.pool = pool
+    httpd = ThreadingHTTPServer((host, port), Handler)
+    stop = threading.Event()
+    interval = backup_interval_from_env()
+    if interval is not None:
+        start_backup_scheduler(db.db_path, interval, stop)
+    pool.start_janitor()
     try:
         httpd.serve_forever()
     finally:
-        db.close()
+        stop.set()
+        pool.close()
 
 
 def main() -> None:
@@ -163,8 +460,20 @@ def main() -> None:
     p.add_argument("--host", default="127.0.0.1")
     p.add_argument("--port", type=int, default=37777)
     p.add_argument("--db", default=None)
+    p.add_argument("--tenants-dir", dest="tenants_dir", default=None)
+    p.add_argument("--max-open", dest="max_open", type=int, default=16)
+    p.add_argument("--idle-s", dest="idle_s", type=float, default=300.0)
+    p.add_argument("--tenant-concurrency", dest="tenant_concurrency", type=int, default=4)
     args = p.parse_args()
-    serve(db_path=args.db, host=args.host, port=args.port)
+    serve(
+        db_path=args.db,
+        host=args.host,
+        port=args.port,
+        tenants_dir=args.tenants_dir,
+        max_open=args.max_open,
+        idle_s=args.idle_s,
+        tenant_concurrency=args.tenant_concurrency,
+    )
 
 
 if __name__ == "__main__":
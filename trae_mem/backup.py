@@ -0,0 +1,178 @@
+import gzip
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Optional
+
+from .metrics import REGISTRY, inc
+
+# 在线备份：用 SQLite backup API 按页分批拷贝，批间主动让出，hook 的写入不需要停。
+# 源连接先开一个读事务钉住 WAL 快照：备份期间其他连接的提交不会让 backup 从头重来，
+# 而 WAL 下读事务也不阻塞写入。拷贝完成后做 integrity_check，gzip 压缩，按数量轮转。
+BACKUP_PREFIX = "trae_mem-"
+BACKUP_SUFFIX = ".sqlite3.gz"
+DEFAULT_KEEP = 7
+DEFAULT_PAGES = 256
+DEFAULT_SLEEP_S = 0.005
+
+
+def backup_dir_from_env(db_path: Path) -> Path:
+    raw = (os.environ.get("TRAE_MEM_BACKUP_DIR") or "").strip()
+    return Path(raw).expanduser() if raw else db_path.parent / "backups"
+
+
+def backup_keep_from_env() -> int:
+    try:
+        return max(int(os.environ.get("TRAE_MEM_BACKUP_KEEP") or DEFAULT_KEEP), 1)
+    except ValueError:
+        return DEFAULT_KEEP
+
+
+def backup_interval_from_env() -> Optional[float]:
+    # 服务端定时备份间隔（小时）；未设置或 <=0 时不启用。
+    try:
+        hours = float((os.environ.get("TRAE_MEM_BACKUP_INTERVAL_HOURS") or "").strip() or 0)
+    except ValueError:
+        return None
+    return hours * 3600 if hours > 0 else None
+
+
+def _copy_online(src_path: Path, dst_path: Path, pages: int, sleep_s: float) -> int:
+    src = sqlite3.connect(str(src_path), timeout=30)
+    dst = sqlite3.connect(str(dst_path))
+    steps = 0
+
+    def progress(status: int, remaining: int, total: int) -> None:
+        nonlocal steps
+        steps += 1
+        if remaining and sleep_s > 0:
+            time.sleep(sleep_s)
+
+    try:
+        src.execute("BEGIN")
+        src.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchall()
+        src.backup(dst, pages=pages, progress=progress)
+        src.rollback()
+        # 备份文件单独使用，不需要 WAL。
+        dst.execute("PRAGMA journal_mode=DELETE")
+    finally:
+        dst.close()
+        src.close()
+    return steps
+
+
+def integrity_errors(path: Path) -> list[str]:
+    conn = sqlite3.connect(str(path), timeout=30)
+    try:
+        rows = [str(r[0]) for r in conn.execute("PRAGMA integrity_check").fetchall()]
+    except sqlite3.DatabaseError as e:
+        # 损坏严重时 integrity_check 本身就会报错（database disk image is malformed）。
+        return [str(e)]
+    finally:
+        conn.close()
+    return [] if rows == ["ok"] else rows
+
+
+def list_backups(directory: Path) -> list[Path]:
+    if not directory.is_dir():
+        return []
+    return sorted(
+        p for p in directory.iterdir() if p.name.startswith(BACKUP_PREFIX) and p.name.endswith(BACKUP_SUFFIX)
+    )
+
+
+def create_backup(
+    db_path: Path,
+    directory: Path,
+    keep: int = DEFAULT_KEEP,
+    pages: int = DEFAULT_PAGES,
+    sleep_s: float = DEFAULT_SLEEP_S,
+) -> dict[str, Any]:
+    directory.mkdir(parents=True, exist_ok=True)
+    stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime())
+    # 同一秒内的多份靠定长序号区分，文件名的字典序即时间顺序，轮转按它删最旧的。
+    n = 1
+    out = directory / f"{BACKUP_PREFIX}{stamp}-{n:03d}{BACKUP_SUFFIX}"
+    while out.exists():
+        n += 1
+        out = directory / f"{BACKUP_PREFIX}{stamp}-{n:03d}{BACKUP_SUFFIX}"
+    raw = directory / f".{out.name[: -len('.gz')]}.tmp"
+    tmp = directory / f".{out.name}.tmp"
+    with REGISTRY.timer("trae_mem_backup_seconds"):
+        try:
+            steps = _copy_online(db_path, raw, pages, sleep_s)
+            errors = integrity_errors(raw)
+            if errors:
+                raise ValueError(f"备份校验失败：{'; '.join(errors[:5])}")
+            with raw.open("rb") as f_in, gzip.open(tmp, "wb", compresslevel=6) as f_out:
+                shutil.copyfileobj(f_in, f_out, 1 << 20)
+            size = raw.stat().st_size
+            os.replace(tmp, out)
+        except BaseException:
+            inc("trae_mem_backup_errors_total")
+            tmp.unlink(missing_ok=True)
+            raise
+        finally:
+            raw.unlink(missing_ok=True)
+    inc("trae_mem_backups_total")
+    removed = [p.name for p in list_backups(directory)[: -max(keep, 1)]]
+    for name in removed:
+        (directory / name).unlink(missing_ok=True)
+    return {"path": str(out), "bytes": out.stat().st_size, "db_bytes": size, "steps": steps, "removed": removed}
+
+
+def _unpack(backup: Path, directory: Path) -> Path:
+    raw = directory / f".{backup.name}.restore.tmp"
+    with gzip.open(backup, "rb") as f_in, raw.open("wb") as f_out:
+        shutil.copyfileobj(f_in, f_out, 1 << 20)
+    return raw
+
+
+def verify_backup(backup: Path) -> list[str]:
+    raw = _unpack(backup, backup.parent)
+    try:
+        return integrity_errors(raw)
+    finally:
+        raw.unlink(missing_ok=True)
+
+
+def restore_backup(backup: Path, db_path: Path, pages: int = DEFAULT_PAGES) -> dict[str, Any]:
+    # 先解压并 integrity_check，通过后同样经 backup API 写回目标库：写入走 SQLite 的锁，
+    # 其他进程上的连接不需要关闭，下次读取即看到恢复后的内容（不做文件替换，不会和 -wal 错配）。
+    raw = _unpack(backup, db_path.parent)
+    try:
+        errors = integrity_errors(raw)
+        if errors:
+            raise ValueError(f"备份校验失败，未恢复：{'; '.join(errors[:5])}")
+        src = sqlite3.connect(str(raw))
+        dst = sqlite3.connect(str(db_path), timeout=30)
+        try:
+            src.backup(dst, pages=pages)
+        finally:
+            dst.close()
+            src.close()
+    finally:
+        raw.unlink(missing_ok=True)
+    errors = integrity_errors(db_path)
+    if errors:
+        raise ValueError(f"恢复后校验失败：{'; '.join(errors[:5])}")
+    return {"restored": str(backup), "db": str(db_path)}
+
+
+def start_backup_scheduler(db_path: Path, interval_s: float, stop: threading.Event) -> threading.Thread:
+    # HTTP 服务里的定时备份；失败只计数，下个周期重试。
+    def loop() -> None:
+        directory = backup_dir_from_env(db_path)
+        keep = backup_keep_from_env()
+        while not stop.wait(interval_s):
+            try:
+                create_backup(db_path, directory, keep=keep)
+            except (OSError, sqlite3.Error, ValueError):
+                continue
+
+    t = threading.Thread(target=loop, name="trae-mem-backup", daemon=True)
+    t.start()
+    return t
@@ -1,12 +1,16 @@
 import argparse
+import contextlib
 import json
 import sys
 from pathlib import Path
-from typing import Optional
+from typing import Any, Optional
 
-from .api import serve as serve_http
-from .compress import ObservationLike, contains_private, remove_private, summarize_session
-from .db import TraeMemDB
+from .compress import redact_for_ingest, summarize_session_levels
+from .db import TraeMemDB, to_json
+from .dedup import collapse_repeats
+from .entities import ENTITY_KINDS
+from .profiling import default_profile_dir, profile_dir, profiled
+from .tags import parse_tag_filter
 
 
 def _read_text_arg(text: Optional[str]) -> str:
@@ -34,22 +38,11 @@ def cmd_end_session(db: TraeMemDB, args: argparse.Namespace) -> int:
     session_id = args.session
     db.end_session(session_id)
 
-    rows = db.get_observations_by_session(session_id, limit=5000)
-    obs = [
-        ObservationLike(
-            ts=int(r["ts"]),
-            kind=str(r["kind"]),
-            tool_name=str(r["tool_name"]) if r["tool_name"] else None,
-            content=str(r["content"]),
-        )
-        for r in rows
-        if int(r["private"]) == 0
-    ]
-
-    brief = summarize_session(obs, max_chars=900)
-    detailed = summarize_session(obs, max_chars=3200)
-    db.add_summary(session_id=session_id, level="brief", content=brief)
-    db.add_summary(session_id=session_id, level="detailed", content=detailed)
+    summaries = summarize_session_levels(
+        db.iter_session_observations(session_id), {"brief": 900, "detailed": 3200}
+    )
+    for level, content in summaries.items():
+        db.add_summary(session_id=session_id, level=level, content=content)
 
     print(session_id)
     return 0
@@ -60,11 +53,7 @@ def cmd_log(db: TraeMemDB, args: argparse.Namespace) -> int:
     if not raw:
         return 0
 
-    has_priv = contains_private(raw)
-    content = remove_private(raw) if has_priv else raw
-    private = bool(has_priv and not content)
-    if not content and private:
-        content = "[PRIVATE]"
+    content, private = redact_for_ingest(raw)
 
     tags = {}
     if args.tags_json:
@@ -82,48 +71,206 @@ def cmd_log(db: TraeMemDB, args: argparse.Namespace) -> int:
     return 0
 
 
+def _print_next_cursor(cursor: Optional[object]) -> None:
+    # stdout 保持纯 JSON 列表，翻页游标写到 stderr。
+    if cursor is not None:
+        print(f"next_cursor: {cursor}", file=sys.stderr)
+
+
 def cmd_search(db: TraeMemDB, args: argparse.Namespace) -> int:
-    hits = db.search(args.query, limit=args.limit)
-    payload = [
-        {
-            "id": h.id,
-            "ts": h.ts,
-            "kind": h.kind,
-            "tool_name": h.tool_name,
-            "session_id": h.session_id,
-            "snippet": h.snippet,
-            "score": h.score,
-        }
-        for h in hits
-    ]
-    print(json.dumps(payload, ensure_ascii=False, indent=2))
+    hits, next_cursor = db.search_page(
+        args.query,
+        limit=args.limit,
+        cursor=args.cursor,
+        advanced=args.advanced,
+        project=args.project,
+        kinds=args.kind,
+        tool_name=args.tool_name,
+        session_id=args.session,
+        since=args.since,
+        until=args.until,
+        tags=parse_tag_filter(args.tag),
+    )
+    print(to_json(hits, indent=2))
+    _print_next_cursor(next_cursor)
     return 0
 
 
 def cmd_timeline(db: TraeMemDB, args: argparse.Namespace) -> int:
-    rows = db.timeline(args.observation_id, window=args.window)
-    payload = [{k: r[k] for k in r.keys()} for r in rows]
-    print(json.dumps(payload, ensure_ascii=False, indent=2))
+    rows = db.timeline(
+        args.observation_id,
+        window=args.window,
+        limit=args.limit,
+        after_seq=args.after,
+        before_seq=args.before,
+        tags=parse_tag_filter(args.tag),
+    )
+    next_cursor = rows[-1].seq if len(rows) >= args.limit else None
+    if not args.no_collapse:
+        rows = collapse_repeats(rows)
+    print(to_json(rows, indent=2))
+    _print_next_cursor(next_cursor)
+    return 0
+
+
+def cmd_session_observations(db: TraeMemDB, args: argparse.Namespace) -> int:
+    rows = db.get_observations_by_session(
+        args.session, limit=args.limit, after_seq=args.after, tags=parse_tag_filter(args.tag)
+    )
+    print(to_json(rows, indent=2))
+    _print_next_cursor(rows[-1].seq if len(rows) >= args.limit else None)
+    return 0
+
+
+def cmd_entity(db: TraeMemDB, args: argparse.Namespace) -> int:
+    hits = db.lookup_entity(args.name, kind=args.kind, project=args.project, limit=args.limit)
+    print(to_json(hits, indent=2))
+    return 0
+
+
+def cmd_failures(db: TraeMemDB, args: argparse.Namespace) -> int:
+    if args.fingerprint or args.error is not None:
+        error = sys.stdin.read() if args.error == "-" else args.error
+        failure = db.lookup_failure(fingerprint=args.fingerprint, error=error)
+        if failure is None:
+            print("未找到该错误的记录", file=sys.stderr)
+            return 1
+        payload = {
+            "failure": failure,
+            "sessions": db.failure_sessions(failure.fingerprint, limit=args.limit),
+            "followups": db.failure_followups(failure.fingerprint, limit=args.limit),
+        }
+        print(to_json(payload, indent=2))
+        return 0
+    print(to_json(db.recurring_failures(project=args.project, limit=args.limit, min_count=args.min_count), indent=2))
+    return 0
+
+
+def cmd_ingest_transcript(db: TraeMemDB, args: argparse.Namespace) -> int:
+    from .transcript import ingest_transcript
+
+    print(ingest_transcript(db, args.session, args.path))
+    return 0
+
+
+def cmd_changes(db: TraeMemDB, args: argparse.Namespace) -> int:
+    # --follow 持续输出（每行一条 JSON），Ctrl-C 退出。
+    since = db.latest_change() if args.since == "now" else int(args.since)
+    try:
+        while True:
+            rows = db.wait_changes(since, timeout=30.0 if args.follow else 0.0, limit=args.limit, entity=args.entity)
+            for r in rows:
+                print(to_json(r), flush=True)
+                since = r.seq
+            if not args.follow:
+                return 0
+    except KeyboardInterrupt:
+        return 0
+
+
+def cmd_sync(db: TraeMemDB, args: argparse.Namespace) -> int:
+    from . import sync
+
+    directory = args.dir or sync.sync_dir_from_env()
+    if not directory:
+        print("请用 --dir 或 $TRAE_MEM_SYNC_DIR 指定共享目录", file=sys.stderr)
+        return 2
+    result: dict[str, Any] = {"replica": db.replica_id()}
+    # both：先拉后推；拉到的记录不会被再推回共享目录。
+    if args.action in ("pull", "both"):
+        result["pull"] = sync.pull(db, directory)
+    if args.action in ("push", "both"):
+        result["push"] = sync.push(db, directory, full=args.full)
+    print(to_json(result, indent=2))
+    return 0
+
+
+def cmd_backup(db: TraeMemDB, args: argparse.Namespace) -> int:
+    from . import backup
+
+    directory = Path(args.dir).expanduser() if args.dir else backup.backup_dir_from_env(db.db_path)
+    if args.action == "create":
+        keep = args.keep if args.keep is not None else backup.backup_keep_from_env()
+        print(to_json(backup.create_backup(db.db_path, directory, keep=keep), indent=2))
+        return 0
+    backups = backup.list_backups(directory)
+    if args.action == "list":
+        for p in backups:
+            print(f"{p}\t{p.stat().st_size}")
+        return 0
+    target = Path(args.file).expanduser() if args.file else (backups[-1] if backups else None)
+    if target is None:
+        print(f"没有可用的备份：{directory}", file=sys.stderr)
+        return 1
+    if args.action == "verify":
+        errors = backup.verify_backup(target)
+        print(to_json({"backup": str(target), "ok": not errors, "errors": errors}, indent=2))
+        return 1 if errors else 0
+    if not args.file:
+        print("恢复需要用 --file 指定备份文件", file=sys.stderr)
+        return 2
+    try:
+        print(to_json(backup.restore_backup(target, db.db_path), indent=2))
+    except ValueError as e:
+        print(str(e), file=sys.stderr)
+        return 1
     return 0
 
 
 def cmd_get_observations(db: TraeMemDB, args: argparse.Namespace) -> int:
     rows = db.get_observations(args.ids)
-    payload = [{k: r[k] for k in r.keys()} for r in rows]
-    print(json.dumps(payload, ensure_ascii=False, indent=2))
+    print(to_json(rows, indent=2))
     return 0
 
 
 def cmd_inject(db: TraeMemDB, args: argparse.Namespace) -> int:
-    from .api import build_injection_block
+    from .inject import build_injection_block
 
     text = build_injection_block(db, query=args.query, limit=args.limit, project_path=args.project)
     print(text)
     return 0
 
 
+def cmd_slowlog(db: TraeMemDB, args: argparse.Namespace) -> int:
+    if args.clear:
+        db.clear_slow_queries()
+        return 0
+    rows = db.slow_queries(limit=args.limit)
+    if args.json:
+        print(to_json(rows, indent=2))
+        return 0
+    for r in rows:
+        print(f"#{r.id} ts={int(r.ts)} {r.duration_ms:.1f}ms")
+        print(f"  sql: {r.sql}")
+        print(f"  params: {r.params_json}")
+        for ln in (r.plan or "").splitlines():
+            print(f"  plan: {ln}")
+    return 0
+
+
+def cmd_profile(_db: TraeMemDB, args: argparse.Namespace) -> int:
+    from . import profiling
+
+    directory = Path(args.dir).expanduser() if args.dir else (profile_dir() or default_profile_dir())
+    if args.action == "clear":
+        print(profiling.clear(directory, match=args.match))
+        return 0
+    print(profiling.report(directory, top=args.top, sort=args.sort, match=args.match))
+    return 0
+
+
 def cmd_serve(_db: TraeMemDB, args: argparse.Namespace) -> int:
-    serve_http(db_path=args.db, host=args.host, port=args.port)
+    from .api import serve as serve_http
+
+    serve_http(
+        db_path=args.db,
+        host=args.host,
+        port=args.port,
+        tenants_dir=args.tenants_dir,
+        max_open=args.max_open,
+        idle_s=args.idle_s,
+        tenant_concurrency=args.tenant_concurrency,
+    )
     return 0
 
 
@@ -139,6 +286,15 @@ def main(argv: Optional[list[str]] = None) -> int:
     p_serve = sub.add_parser("serve")
     p_serve.add_argument("--host", default="127.0.0.1")
     p_serve.add_argument("--port", type=int, default=37777)
+    p_serve.add_argument(
+        "--tenants-dir",
+        dest="tenants_dir",
+        default=None,
+        help="serve <dir>/<name>/trae_mem.sqlite3 for /t/<name>/... or the X-Trae-Mem-Tenant header",
+    )
+    p_serve.add_argument("--max-open", dest="max_open", type=int, default=16, help="open databases kept in the LRU pool")
+    p_serve.add_argument("--idle-s", dest="idle_s", type=float, default=300.0, help="close databases idle this long")
+    p_serve.add_argument("--tenant-concurrency", dest="tenant_concurrency", type=int, default=4)
     p_serve.set_defaults(fn=cmd_serve)
 
     p_start = sub.add_parser("start-session")
@@ -161,13 +317,74 @@ def main(argv: Optional[list[str]] = None) -> int:
     p_search = sub.add_parser("search")
     p_search.add_argument("--query", required=True)
     p_search.add_argument("--limit", type=int, default=20)
+    p_search.add_argument("--project", default=None)
+    p_search.add_argument("--kind", action="append", default=None, help="repeatable")
+    p_search.add_argument("--tool-name", dest="tool_name", default=None)
+    p_search.add_argument("--session", default=None)
+    p_search.add_argument("--since", type=int, default=None, help="unix ts, inclusive")
+    p_search.add_argument("--until", type=int, default=None, help="unix ts, inclusive")
+    p_search.add_argument("--cursor", default=None, help="next_cursor from the previous page")
+    p_search.add_argument("--advanced", action="store_true", help="pass --query to FTS5 MATCH verbatim")
+    p_search.add_argument("--tag", action="append", default=None, help="key=value, repeatable (AND)")
     p_search.set_defaults(fn=cmd_search)
 
     p_tl = sub.add_parser("timeline")
     p_tl.add_argument("--observation-id", required=True)
     p_tl.add_argument("--window", type=int, default=10)
+    p_tl.add_argument("--limit", type=int, default=200)
+    p_tl.add_argument("--after", type=int, default=None, help="seq cursor: page after this seq")
+    p_tl.add_argument("--before", type=int, default=None, help="seq cursor: page before this seq")
+    p_tl.add_argument("--no-collapse", action="store_true", help="keep near-duplicate rows")
+    p_tl.add_argument("--tag", action="append", default=None, help="key=value, repeatable (AND)")
     p_tl.set_defaults(fn=cmd_timeline)
 
+    p_so = sub.add_parser("session-observations")
+    p_so.add_argument("--session", required=True)
+    p_so.add_argument("--limit", type=int, default=500)
+    p_so.add_argument("--after", type=int, default=None, help="seq cursor: page after this seq")
+    p_so.add_argument("--tag", action="append", default=None, help="key=value, repeatable (AND)")
+    p_so.set_defaults(fn=cmd_session_observations)
+
+    p_ent = sub.add_parser("entity", help="observations that touched a file / symbol / command / url")
+    p_ent.add_argument("--name", required=True, help="e.g. db.py, trae_mem/db.py, TraeMemDB, 'git status'")
+    p_ent.add_argument("--kind", choices=list(ENTITY_KINDS), default=None)
+    p_ent.add_argument("--project", default=None)
+    p_ent.add_argument("--limit", type=int, default=50)
+    p_ent.set_defaults(fn=cmd_entity)
+
+    p_fail = sub.add_parser("failures", help="recurring failures aggregated by error fingerprint")
+    p_fail.add_argument("--project", default=None)
+    p_fail.add_argument("--limit", type=int, default=10)
+    p_fail.add_argument("--min-count", dest="min_count", type=int, default=2)
+    p_fail.add_argument("--fingerprint", default=None, help="show one failure with its sessions and follow-ups")
+    p_fail.add_argument("--error", default=None, help="look up by pasted error text ('-' reads stdin)")
+    p_fail.set_defaults(fn=cmd_failures)
+
+    p_tr = sub.add_parser("ingest-transcript", help="backfill events the hooks missed from a JSONL transcript")
+    p_tr.add_argument("--session", required=True)
+    p_tr.add_argument("--path", required=True)
+    p_tr.set_defaults(fn=cmd_ingest_transcript)
+
+    p_chg = sub.add_parser("changes", help="change feed: inserts / updates after a cursor")
+    p_chg.add_argument("--since", default="0", help="cursor (seq) from a previous line, or 'now'")
+    p_chg.add_argument("--limit", type=int, default=100)
+    p_chg.add_argument("--entity", choices=["observation", "session", "summary"], default=None)
+    p_chg.add_argument("--follow", action="store_true", help="keep waiting for new changes")
+    p_chg.set_defaults(fn=cmd_changes)
+
+    p_sync = sub.add_parser("sync", help="exchange new activity with other machines through a shared directory")
+    p_sync.add_argument("action", choices=["push", "pull", "both"])
+    p_sync.add_argument("--dir", default=None, help="shared directory (default: $TRAE_MEM_SYNC_DIR)")
+    p_sync.add_argument("--full", action="store_true", help="also push rows written before the change log existed")
+    p_sync.set_defaults(fn=cmd_sync)
+
+    p_bak = sub.add_parser("backup", help="online backup (SQLite backup API, gzip, rotation) and verified restore")
+    p_bak.add_argument("action", nargs="?", choices=["create", "list", "verify", "restore"], default="create")
+    p_bak.add_argument("--dir", default=None, help="backup directory (default: $TRAE_MEM_BACKUP_DIR or <db dir>/backups)")
+    p_bak.add_argument("--keep", type=int, default=None, help="backups to keep (default: $TRAE_MEM_BACKUP_KEEP or 7)")
+    p_bak.add_argument("--file", default=None, help="backup to verify (default: newest) or restore (required)")
+    p_bak.set_defaults(fn=cmd_backup)
+
     p_get = sub.add_parser("get-observations")
     p_get.add_argument("ids", nargs="+")
     p_get.set_defaults(fn=cmd_get_observations)
@@ -178,18 +395,34 @@ def main(argv: Optional[list[str]] = None) -> int:
     p_inject.add_argument("--project", default=None)
     p_inject.set_defaults(fn=cmd_inject)
 
+    p_slow = sub.add_parser("slowlog", help="print captured slow queries (enable with $TRAE_MEM_SLOW_QUERY_MS)")
+    p_slow.add_argument("--limit", type=int, default=50)
+    p_slow.add_argument("--json", action="store_true")
+    p_slow.add_argument("--clear", action="store_true")
+    p_slow.set_defaults(fn=cmd_slowlog)
+
+    p_prof = sub.add_parser("profile", help="merge per-invocation profiles written under $TRAE_MEM_PROFILE")
+    p_prof.add_argument("action", choices=["report", "clear"])
+    p_prof.add_argument("--dir", default=None)
+    p_prof.add_argument("--top", type=int, default=30)
+    p_prof.add_argument("--sort", default="cumulative", choices=["cumulative", "tottime", "calls", "ncalls"])
+    p_prof.add_argument("--match", default=None, help="only profiles whose label starts with this, e.g. hook-PostToolUse")
+    p_prof.set_defaults(fn=cmd_profile)
+
     args = parser.parse_args(argv)
 
     db_path = None
     if args.db:
         db_path = Path(args.db).expanduser()
 
-    db = TraeMemDB(db_path=db_path)
-    try:
-        db.init_schema()
-        return int(args.fn(db, args))
-    finally:
-        db.close()
+    scope = contextlib.nullcontext() if args.cmd in ("serve", "profile") else profiled(f"cli-{args.cmd}")
+    with scope:
+        db = TraeMemDB(db_path=db_path)
+        try:
+            db.init_schema()
+            return int(args.fn(db, args))
+        finally:
+            db.close()
 
 
 if __name__ == "__main__":
@@ -1,10 +1,10 @@
 import json
 import os
 import re
-import textwrap
-import urllib.request
-from dataclasses import dataclass
-from typing import Iterable, Optional
+from typing import Any, Iterable, Optional
+
+from .failures import normalize_line
+from .metrics import inc, timer
 
 
 _PRIVATE_RE = re.compile(r"<private>[\s\S]*?</private>", re.IGNORECASE)
@@ -22,6 +22,179 @@ def remove_private(text: str) -> str:
     return _PRIVATE_RE.sub("", text).strip()
 
 
+def redact_for_ingest(text: str) -> tuple[str, bool]:
+    cleaned, n = _PRIVATE_RE.subn("", text)
+    if not n:
+        return text, False
+    cleaned = cleaned.strip()
+    if cleaned:
+        return cleaned, False
+    return "[PRIVATE]", True
+
+
+class _BoundedJSON:
+    # 按预算截断的 JSON 编码，分两遍：预览写满 budget 即停止，只转义实际写出的部分；哈希与长度另走一遍
+    # 整个对象，不生成 JSON。字符串带长度前缀（s<长度>:），不同结构不会拼出同一串字节；长字符串按固定
+    # 大小分块直接哈希原文，不整段转义或复制，内存占用与输入大小无关。size 近似完整 JSON 编码的长度
+    # （字符串按原长加两个引号计入，不含转义）。
+    _CHUNK = 1 << 16
+
+    def __init__(self, budget: int, str_limit: int = 600) -> None:
+        self.budget = budget
+        self.str_limit = str_limit
+        self.parts: list[str] = []
+        self.used = 0
+        self.size = 0
+        self.truncated = False
+        import hashlib
+
+        self._hash = hashlib.sha1()
+        self._pending: list[str] = []
+
+    def _put(self, s: str) -> None:
+        if self.used >= self.budget:
+            self.truncated = True
+            return
+        room = self.budget - self.used
+        if len(s) > room:
+            s = s[:room]
+            self.truncated = True
+        self.parts.append(s)
+        self.used += len(s)
+
+    def _full(self) -> bool:
+        if self.used >= self.budget:
+            self.truncated = True
+        return self.truncated
+
+    def _string(self, s: str) -> None:
+        if self._full():
+            return
+        # 放得下就整段保留；放不下时才按 str_limit 掐头留尾，给后面的字段留出预算。
+        room = self.budget - self.used
+        limit = min(self.str_limit, max(16, room))
+        if len(s) + 2 > room and len(s) > limit:
+            head = s[: limit * 2 // 3]
+            tail = s[len(s) - limit // 3 :]
+            self._put(json.dumps(f"{head}…[+{len(s) - len(head) - len(tail)} chars]…{tail}", ensure_ascii=False))
+            self.truncated = True
+        else:
+            self._put(json.dumps(s, ensure_ascii=False))
+
+    def _preview(self, obj: Any) -> None:
+        if isinstance(obj, str):
+            self._string(obj)
+        elif obj is None or isinstance(obj, (bool, int, float)):
+            self._put(json.dumps(obj))
+        elif isinstance(obj, dict):
+            self._put("{")
+            for i, (k, v) in enumerate(obj.items()):
+                if self._full():
+                    return
+                self._put(", " if i else "")
+                self._string(str(k))
+                self._put(": ")
+                self._preview(v)
+            self._put("}")
+        elif isinstance(obj, (list, tuple)):
+            self._put("[")
+            for i, v in enumerate(obj):
+                if self._full():
+                    return
+                self._put(", " if i else "")
+                self._preview(v)
+            self._put("]")
+        else:
+            self._string(str(obj))
+
+    def _flush(self) -> None:
+        self.size += sum(map(len, self._pending))
+        self._hash.update("".join(self._pending).encode("utf-8", "surrogatepass"))
+        self._pending.clear()
+
+    def _digest_walk(self, obj: Any) -> None:
+        out = self._pending
+        if isinstance(obj, str):
+            n = len(obj)
+            prefix = f"s{n}:"
+            self.size += 2 - len(prefix)
+            out.append(prefix)
+            if n <= self._CHUNK:
+                out.append(obj)
+            else:
+                self._flush()
+                self.size += n
+                for i in range(0, n, self._CHUNK):
+                    self._hash.update(obj[i : i + self._CHUNK].encode("utf-8", "surrogatepass"))
+        elif obj is None or obj is True or obj is False:
+            out.append("null" if obj is None else "true" if obj else "false")
+        elif isinstance(obj, int):
+            out.append(int.__repr__(obj))
+        elif isinstance(obj, float):
+            out.append(json.dumps(obj))
+        elif isinstance(obj, dict):
+            out.append("{")
+            for i, (k, v) in enumerate(obj.items()):
+                if i:
+                    out.append(", ")
+                self._digest_walk(str(k))
+                out.append(": ")
+                self._digest_walk(v)
+            out.append("}")
+        elif isinstance(obj, (list, tuple)):
+            out.append("[")
+            for i, v in enumerate(obj):
+                if i:
+                    out.append(", ")
+                self._digest_walk(v)
+            out.append("]")
+        else:
+            self._digest_walk(str(obj))
+        if len(out) >= 4096:
+            self._flush()
+
+    def encode(self, obj: Any) -> None:
+        self._preview(obj)
+        self._digest_walk(obj)
+        self._flush()
+
+    def text(self) -> str:
+        out = "".join(self.parts)
+        if not self.truncated:
+            return out
+        return out[: max(0, self.budget - 1)] + "…"
+
+    def digest(self) -> str:
+        return self._hash.hexdigest()
+
+
+def bounded_json(obj: Any, budget: int) -> tuple[str, dict[str, Any]]:
+    enc = _BoundedJSON(budget)
+    enc.encode(obj)
+    return enc.text(), {"chars": enc.size, "sha1": enc.digest(), "truncated": enc.truncated}
+
+
+_PREVIEW_RE = re.compile(r"\s*<private>[\s\S]*?</private>\s*|\s+", re.IGNORECASE)
+PREVIEW_CHARS = 220
+
+_KIND_BUCKETS = {
+    "user": "user",
+    "tool": "tool",
+    "decision": "decision",
+    "note": "decision",
+    "error": "error",
+    "exception": "error",
+}
+
+
+def one_line_preview(text: str, max_len: int = PREVIEW_CHARS) -> str:
+    return _clip(_PREVIEW_RE.sub(" ", text).strip(), max_len)
+
+
+def kind_bucket(kind: str) -> str:
+    return _KIND_BUCKETS.get(kind, "other")
+
+
 def _dedupe_preserve_order(items: Iterable[str]) -> list[str]:
     seen: set[str] = set()
     out: list[str] = []
@@ -54,68 +227,91 @@ def _as_bullets(lines: list[str], max_chars: int) -> str:
     return "\n".join(out_lines).strip()
 
 
-@dataclass(frozen=True)
 class ObservationLike:
-    ts: int
-    kind: str
-    tool_name: Optional[str]
-    content: str
-
-
-def heuristic_session_summary(observations: list[ObservationLike], max_chars: int) -> str:
-    user_msgs: list[str] = []
-    tool_actions: list[str] = []
-    decisions: list[str] = []
-    errors: list[str] = []
-
-    for o in observations:
-        c = remove_private(o.content)
+    # 手写 __slots__ 类而非 dataclass：本模块在每次 hook 进程启动时都会被导入，dataclasses 会连带导入 inspect。
+    __slots__ = ("ts", "kind", "tool_name", "content", "preview", "bucket")
+
+    def __init__(
+        self,
+        ts: int,
+        kind: str,
+        tool_name: Optional[str],
+        content: str,
+        preview: Optional[str] = None,
+        bucket: Optional[str] = None,
+    ) -> None:
+        self.ts = ts
+        self.kind = kind
+        self.tool_name = tool_name
+        self.content = content
+        self.preview = preview
+        self.bucket = bucket
+
+    def __repr__(self) -> str:
+        return f"ObservationLike(ts={self.ts!r}, kind={self.kind!r}, tool_name={self.tool_name!r})"
+
+
+class _HeuristicCollector:
+    # 流式收集：每个分区只保留去重后的前 N 条，内存与会话长度无关。
+    _CAPS = {"user": 4, "decision": 6, "tool": 8, "error": 6}
+
+    def __init__(self) -> None:
+        self._sections: dict[str, list[str]] = {k: [] for k in self._CAPS}
+        self._seen: dict[str, set[str]] = {k: set() for k in self._CAPS}
+
+    def add(self, o: ObservationLike) -> None:
+        bucket = o.bucket or kind_bucket(o.kind)
+        items = self._sections.get(bucket)
+        if items is None or len(items) >= self._CAPS[bucket]:
+            return
+        c = o.preview if o.preview is not None else one_line_preview(o.content)
         if not c:
-            continue
-
-        if o.kind == "user":
-            user_msgs.append(_clip(re.sub(r"\s+", " ", c), 180))
-            continue
-
-        if o.kind == "tool":
-            base = o.tool_name or "tool"
-            one_line = _clip(re.sub(r"\s+", " ", c), 220)
-            tool_actions.append(f"{base}: {one_line}")
-            continue
-
-        if o.kind in ("decision", "note"):
-            decisions.append(_clip(re.sub(r"\s+", " ", c), 220))
-            continue
-
-        if o.kind in ("error", "exception"):
-            errors.append(_clip(re.sub(r"\s+", " ", c), 220))
-            continue
-
-    user_msgs = _dedupe_preserve_order(user_msgs)
-    tool_actions = _dedupe_preserve_order(tool_actions)
-    decisions = _dedupe_preserve_order(decisions)
-    errors = _dedupe_preserve_order(errors)
-
-    lines: list[str] = []
-    if user_msgs:
-        lines.append("用户意图/输入")
-        for m in (user_msgs[:3] + (["…"] if len(user_msgs) > 3 else [])):
-            lines.append(f"  {m}")
-    if decisions:
-        lines.append("关键结论/决策")
-        for d in decisions[:6]:
-            lines.append(f"  {d}")
-    if tool_actions:
-        lines.append("工具动作/线索")
-        for a in tool_actions[:8]:
-            lines.append(f"  {a}")
-    if errors:
-        lines.append("错误/风险")
-        for e in errors[:6]:
-            lines.append(f"  {e}")
-
-    flat = _dedupe_preserve_order(lines)
-    return _as_bullets([ln.rstrip() for ln in flat], max_chars=max_chars)
+            return
+        if bucket == "user":
+            c = _clip(c, 180)
+        elif bucket == "tool":
+            c = f"{o.tool_name or 'tool'}: {c}"
+        k = c.strip()
+        # 报错按归一化后的文本去重：只差行号 / 地址 / 时间戳的同一种错误只占一个名额。
+        seen_key = normalize_line(k) if bucket == "error" else k
+        if not k or seen_key in self._seen[bucket]:
+            return
+        self._seen[bucket].add(seen_key)
+        items.append(k)
+
+    def render(self, max_chars: int) -> str:
+        user_msgs = self._sections["user"]
+        decisions = self._sections["decision"]
+        tool_actions = self._sections["tool"]
+        errors = self._sections["error"]
+
+        lines: list[str] = []
+        if user_msgs:
+            lines.append("用户意图/输入")
+            for m in (user_msgs[:3] + (["…"] if len(user_msgs) > 3 else [])):
+                lines.append(f"  {m}")
+        if decisions:
+            lines.append("关键结论/决策")
+            for d in decisions[:6]:
+                lines.append(f"  {d}")
+        if tool_actions:
+            lines.append("工具动作/线索")
+            for a in tool_actions[:8]:
+                lines.append(f"  {a}")
+        if errors:
+            lines.append("错误/风险")
+            for e in errors[:6]:
+                lines.append(f"  {e}")
+
+        flat = _dedupe_preserve_order(lines)
+        return _as_bullets([ln.rstrip() for ln in flat], max_chars=max_chars)
+
+
+def heuristic_session_summary(observations: Iterable[ObservationLike], max_chars: int) -> str:
+    collector = _HeuristicCollector()
+    for o in observations:
+        collector.add(o)
+    return collector.render(max_chars)
 
 
 def _llm_provider() -> str:
@@ -123,6 +319,8 @@ def _llm_provider() -> str:
 
 
 def _anthropic_summarize(prompt: str, max_tokens: int) -> str:
+    import urllib.request
+
     api_key = os.environ.get("ANTHROPIC_API_KEY")
     if not api_key:
         raise RuntimeError("ANTHROPIC_API_KEY is not set")
@@ -150,6 +348,8 @@ def _anthropic_summarize(prompt: str, max_tokens: int) -> str:
 
 
 def _openai_summarize(prompt: str, max_tokens: int) -> str:
+    import urllib.request
+
     api_key = os.environ.get("OPENAI_API_KEY")
     if not api_key:
         raise RuntimeError("OPENAI_API_KEY is not set")
@@ -179,13 +379,17 @@ def _openai_summarize(prompt: str, max_tokens: int) -> str:
     return "\n".join(texts).strip()
 
 
-def llm_session_summary(observations: list[ObservationLike], max_chars: int) -> str:
+def _llm_raw_line(o: ObservationLike) -> Optional[str]:
+    text = remove_private(o.content)
+    if not text:
+        return None
+    return f"[{o.ts}] {o.kind}{'/' + o.tool_name if o.tool_name else ''}\n{text}"
+
+
+def _llm_summary_from_raw(raw: str, max_chars: int) -> str:
+    import textwrap
+
     provider = _llm_provider()
-    raw = "\n\n".join(
-        f"[{o.ts}] {o.kind}{'/' + o.tool_name if o.tool_name else ''}\n{remove_private(o.content)}"
-        for o in observations
-        if remove_private(o.content)
-    )
     prompt = textwrap.dedent(
         f"""
         你是一个“会话记忆压缩器”。请把下面的会话日志压缩成可注入到下次会话的上下文，要求：
@@ -209,12 +413,40 @@ def llm_session_summary(observations: list[ObservationLike], max_chars: int) ->
     raise RuntimeError(f"Unsupported summarizer provider: {provider}")
 
 
-def summarize_session(observations: list[ObservationLike], max_chars: int) -> str:
-    provider = _llm_provider()
-    if provider == "none":
-        return heuristic_session_summary(observations, max_chars=max_chars)
-    try:
-        return llm_session_summary(observations, max_chars=max_chars)
-    except Exception:
-        return heuristic_session_summary(observations, max_chars=max_chars)
+def llm_session_summary(observations: Iterable[ObservationLike], max_chars: int) -> str:
+    raw = "\n\n".join(line for line in map(_llm_raw_line, observations) if line)
+    return _llm_summary_from_raw(raw, max_chars)
+
 
+def summarize_session(observations: Iterable[ObservationLike], max_chars: int) -> str:
+    return summarize_session_levels(observations, {"summary": max_chars})["summary"]
+
+
+def summarize_session_levels(observations: Iterable[ObservationLike], levels: dict[str, int]) -> dict[str, str]:
+    # 单次遍历观测流，同时喂给启发式收集器与（可选的）LLM 日志；LLM 失败时回退到启发式结果。
+    collector = _HeuristicCollector()
+    provider = _llm_provider()
+    with timer("trae_mem_summarize_seconds", provider=provider):
+        if provider == "none":
+            for o in observations:
+                collector.add(o)
+            inc("trae_mem_summaries_total", len(levels), provider=provider, fallback="false")
+            return {level: collector.render(n) for level, n in levels.items()}
+
+        raw_lines: list[str] = []
+        for o in observations:
+            collector.add(o)
+            line = _llm_raw_line(o)
+            if line:
+                raw_lines.append(line)
+        raw = "\n\n".join(raw_lines)
+        out: dict[str, str] = {}
+        for level, n in levels.items():
+            try:
+                out[level] = _llm_summary_from_raw(raw, max_chars=n)
+                inc("trae_mem_summaries_total", provider=provider, fallback="false")
+            except Exception as e:
+                inc("trae_mem_summaries_total", provider=provider, fallback="true")
+                inc("trae_mem_summarizer_errors_total", provider=provider, error=type(e).__name__)
+                out[level] = collector.render(n)
+        return out
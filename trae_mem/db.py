@@ -1,11 +1,21 @@
 import json
 import os
 import sqlite3
+import threading
 import time
-import uuid
-from dataclasses import dataclass
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Any, Iterable, Optional
+from typing import Any, Callable, Iterable, Iterator, Optional, TypeVar
+
+from .compress import ObservationLike, kind_bucket, one_line_preview
+from .dedup import DEDUP_BUCKETS, MAX_DISTANCE, band_keys, dedup_enabled_from_env, distance, simhash, to_signed
+from .entities import ENTITY_BUCKETS, extract_entities, normalize_entity
+from .failures import FAILURE_BUCKETS, failure_of
+from .ftsquery import FtsQuery, compile_query, like_escape
+from .metrics import inc, timed
+from .ranking import RankConfig
+from .slowlog import SlowQueryLog, TracedConnection, slow_query_threshold_from_env
+from .tags import tag_rows
 
 
 def _default_db_path() -> Path:
@@ -21,23 +31,416 @@ def _default_db_path() -> Path:
     return Path.cwd() / ".trae-mem" / "trae_mem.sqlite3"
 
 
+def _new_id() -> str:
+    return os.urandom(16).hex()
+
+
 def _ensure_parent_dir(db_path: Path) -> None:
     db_path.parent.mkdir(parents=True, exist_ok=True)
 
 
-@dataclass(frozen=True)
-class SearchHit:
-    id: str
-    ts: int
-    kind: str
-    tool_name: Optional[str]
-    session_id: str
-    snippet: str
-    score: float
+class _Record:
+    # 只读结果记录的公共基类：__slots__ 存储，兼容 row["col"] 访问，序列化走 to_json。
+    # 子类手写 __init__（不用 dataclasses），hook 进程启动时不必导入 dataclasses/inspect。
+    __slots__ = ()
+
+    def __getitem__(self, key: str) -> Any:
+        return getattr(self, key)
+
+    def keys(self) -> tuple[str, ...]:
+        return self.__slots__  # type: ignore[attr-defined]
+
+    def as_dict(self) -> dict[str, Any]:
+        return {k: getattr(self, k) for k in self.__slots__}  # type: ignore[attr-defined]
+
+    def _values(self) -> tuple[Any, ...]:
+        return tuple(getattr(self, k) for k in self.__slots__)  # type: ignore[attr-defined]
+
+    def __eq__(self, other: object) -> bool:
+        if type(other) is not type(self):
+            return NotImplemented
+        return self._values() == other._values()  # type: ignore[attr-defined]
+
+    def __hash__(self) -> int:
+        return hash(self._values())
+
+    def __repr__(self) -> str:
+        inner = ", ".join(f"{k}={getattr(self, k)!r}" for k in self.__slots__)  # type: ignore[attr-defined]
+        return f"{type(self).__name__}({inner})"
+
+
+class SearchHit(_Record):
+    __slots__ = ("id", "ts", "kind", "tool_name", "session_id", "snippet", "score", "repeat_count")
+
+    def __init__(
+        self,
+        id: str,
+        ts: int,
+        kind: str,
+        tool_name: Optional[str],
+        session_id: str,
+        snippet: str,
+        score: float,
+        repeat_count: int,
+    ) -> None:
+        self.id = id
+        self.ts = ts
+        self.kind = kind
+        self.tool_name = tool_name
+        self.session_id = session_id
+        self.snippet = snippet
+        self.score = score
+        self.repeat_count = repeat_count
+
+
+class EntityHit(_Record):
+    __slots__ = ("id", "ts", "kind", "tool_name", "session_id", "preview", "repeat_count", "entity", "entity_kind")
+
+    def __init__(
+        self,
+        id: str,
+        ts: int,
+        kind: str,
+        tool_name: Optional[str],
+        session_id: str,
+        preview: Optional[str],
+        repeat_count: int,
+        entity: str,
+        entity_kind: str,
+    ) -> None:
+        self.id = id
+        self.ts = ts
+        self.kind = kind
+        self.tool_name = tool_name
+        self.session_id = session_id
+        self.preview = preview
+        self.repeat_count = repeat_count
+        self.entity = entity
+        self.entity_kind = entity_kind
+
+
+class ObservationRecord(_Record):
+    __slots__ = (
+        "id",
+        "session_id",
+        "ts",
+        "kind",
+        "tool_name",
+        "content",
+        "private",
+        "tags_json",
+        "preview",
+        "bucket",
+        "seq",
+        "canonical_id",
+        "repeat_count",
+    )
+
+    def __init__(
+        self,
+        id: str,
+        session_id: str,
+        ts: int,
+        kind: str,
+        tool_name: Optional[str],
+        content: str,
+        private: int,
+        tags_json: Optional[str],
+        preview: Optional[str],
+        bucket: Optional[str],
+        seq: Optional[int],
+        canonical_id: Optional[str],
+        repeat_count: int,
+    ) -> None:
+        self.id = id
+        self.session_id = session_id
+        self.ts = ts
+        self.kind = kind
+        self.tool_name = tool_name
+        self.content = content
+        self.private = private
+        self.tags_json = tags_json
+        self.preview = preview
+        self.bucket = bucket
+        self.seq = seq
+        self.canonical_id = canonical_id
+        self.repeat_count = repeat_count
+
+
+class SessionRecord(_Record):
+    __slots__ = ("id", "started_at", "ended_at", "project_path", "meta_json")
+
+    def __init__(
+        self,
+        id: str,
+        started_at: int,
+        ended_at: Optional[int],
+        project_path: Optional[str],
+        meta_json: Optional[str],
+    ) -> None:
+        self.id = id
+        self.started_at = started_at
+        self.ended_at = ended_at
+        self.project_path = project_path
+        self.meta_json = meta_json
+
+
+class SummaryRecord(_Record):
+    __slots__ = ("id", "session_id", "created_at", "level", "content")
+
+    def __init__(self, id: str, session_id: str, created_at: int, level: str, content: str) -> None:
+        self.id = id
+        self.session_id = session_id
+        self.created_at = created_at
+        self.level = level
+        self.content = content
+
+
+class FailureRecord(_Record):
+    __slots__ = ("fingerprint", "title", "first_seen", "last_seen", "count", "session_count", "last_observation_id")
+
+    def __init__(
+        self,
+        fingerprint: str,
+        title: str,
+        first_seen: int,
+        last_seen: int,
+        count: int,
+        session_count: int,
+        last_observation_id: Optional[str],
+    ) -> None:
+        self.fingerprint = fingerprint
+        self.title = title
+        self.first_seen = first_seen
+        self.last_seen = last_seen
+        self.count = count
+        self.session_count = session_count
+        self.last_observation_id = last_observation_id
+
+
+class FailureSessionRecord(_Record):
+    __slots__ = ("fingerprint", "session_id", "first_seen", "last_seen", "count", "last_observation_id")
+
+    def __init__(
+        self,
+        fingerprint: str,
+        session_id: str,
+        first_seen: int,
+        last_seen: int,
+        count: int,
+        last_observation_id: str,
+    ) -> None:
+        self.fingerprint = fingerprint
+        self.session_id = session_id
+        self.first_seen = first_seen
+        self.last_seen = last_seen
+        self.count = count
+        self.last_observation_id = last_observation_id
+
+
+class ChangeRecord(_Record):
+    __slots__ = ("seq", "ts", "op", "entity", "entity_id", "session_id")
+
+    def __init__(self, seq: int, ts: float, op: str, entity: str, entity_id: str, session_id: Optional[str]) -> None:
+        self.seq = seq
+        self.ts = ts
+        self.op = op
+        self.entity = entity
+        self.entity_id = entity_id
+        self.session_id = session_id
+
+
+class SlowQueryRecord(_Record):
+    __slots__ = ("id", "ts", "duration_ms", "sql", "params_json", "plan")
+
+    def __init__(self, id: int, ts: float, duration_ms: float, sql: str, params_json: str, plan: str) -> None:
+        self.id = id
+        self.ts = ts
+        self.duration_ms = duration_ms
+        self.sql = sql
+        self.params_json = params_json
+        self.plan = plan
+
+
+_R = TypeVar("_R", bound=_Record)
+
+
+def _columns_of(cls: type[_Record], alias: str = "") -> str:
+    prefix = f"{alias}." if alias else ""
+    return ", ".join(prefix + name for name in cls.__slots__)  # type: ignore[attr-defined]
+
+
+def _record_factory(cls: type[_R]) -> Callable[[sqlite3.Cursor, tuple], _R]:
+    return lambda _cur, row: cls(*row)
+
+
+def _collapse_window(rows: list[Any], grp: int, dup: int) -> list[int]:
+    # 近重复与 canonical 都在索引里：窗口内每组（canonical 及其重复）只保留一条，canonical 命中时优先，
+    # 否则取组内原生顺序最靠前的重复记录。rows 按原生顺序排列，返回保留行的位置。
+    keep: dict[Any, int] = {}
+    for i, row in enumerate(rows):
+        j = keep.get(row[grp])
+        if j is None or (rows[j][dup] and not row[dup]):
+            keep[row[grp]] = i
+    return sorted(keep.values())
+
+
+def _native_after(path: str, boundary: Optional[tuple[float, str]]) -> tuple[str, tuple[Any, ...]]:
+    if boundary is None:
+        return "", ()
+    if path == "f":
+        return "WHERE score > ? OR (score = ? AND id > ?)", (boundary[0], boundary[0], boundary[1])
+    return "WHERE ts < ? OR (ts = ? AND id < ?)", (int(boundary[0]), int(boundary[0]), boundary[1])
+
+
+_OBS_COLS = _columns_of(ObservationRecord)
+_SESSION_COLS = _columns_of(SessionRecord)
+_SUMMARY_COLS = _columns_of(SummaryRecord)
+_FAILURE_COLS = _columns_of(FailureRecord)
+
+
+def _observation_filters(
+    alias: str,
+    project: Optional[str] = None,
+    kinds: Optional[Iterable[str]] = None,
+    tool_name: Optional[str] = None,
+    session_id: Optional[str] = None,
+    since: Optional[int] = None,
+    until: Optional[int] = None,
+    tags: Optional[dict[str, str]] = None,
+) -> tuple[str, list[Any]]:
+    # 结构化过滤条件统一下推为 SQL 谓词，由 observations(kind, ts) / (tool_name, ts) /
+    # (session_id, ts)、sessions(project_path, started_at) 与 observation_tags 主键支撑。
+    where: list[str] = []
+    params: list[Any] = []
+    if project:
+        where.append(f"{alias}.session_id IN (SELECT id FROM sessions WHERE project_path=?)")
+        params.append(project)
+    if kinds:
+        kind_list = [kinds] if isinstance(kinds, str) else list(kinds)
+        where.append(f"{alias}.kind IN ({','.join('?' for _ in kind_list)})")
+        params.extend(kind_list)
+    if tool_name:
+        where.append(f"{alias}.tool_name=?")
+        params.append(tool_name)
+    if session_id:
+        where.append(f"{alias}.session_id=?")
+        params.append(session_id)
+    if since is not None:
+        where.append(f"{alias}.ts >= ?")
+        params.append(int(since))
+    if until is not None:
+        where.append(f"{alias}.ts <= ?")
+        params.append(int(until))
+    for key, value in (tags or {}).items():
+        where.append(f"{alias}.id IN (SELECT observation_id FROM observation_tags WHERE key=? AND value=?)")
+        params.extend((key, value))
+    return "".join(f" AND {w}" for w in where), params
+
+
+class _SearchCursor:
+    # "<path>:<原生排序键>:<id>" 或 "<path>:<窗口起点键>:<id>:<now>:<窗口大小>:<已返回位图>"。
+    # 按原生顺序切成固定大小的候选窗口，窗口内折叠近重复，开启排序时再按 trae_rank() 重排；起点是上一窗口
+    # 最后一行的原生键（第一个窗口为空），位图记本窗口内已返回的原生位置。翻页期间访问次数变化只会改变窗口内
+    # 剩余行的先后，不会重复或漏掉；now 沿用第一页的值（未排序时为空），时间衰减在整个翻页过程中不变。
+    __slots__ = ("path", "boundary", "now", "window", "mask")
+
+    def __init__(
+        self,
+        path: str,
+        boundary: Optional[tuple[float, str]],
+        now: Optional[float] = None,
+        window: int = 0,
+        mask: int = 0,
+    ) -> None:
+        self.path = path
+        self.boundary = boundary
+        self.now = now
+        self.window = window
+        self.mask = mask
+
+    def __str__(self) -> str:
+        key, id_ = (repr(self.boundary[0]), self.boundary[1]) if self.boundary else ("", "")
+        if self.now is None and not self.mask:
+            return f"{self.path}:{key}:{id_}"
+        now = "" if self.now is None else repr(self.now)
+        return f"{self.path}:{key}:{id_}:{now}:{self.window}:{self.mask:x}"
+
+
+def _parse_search_cursor(cursor: Optional[str]) -> Optional[_SearchCursor]:
+    if not cursor:
+        return None
+    parts = cursor.split(":")
+    try:
+        if parts[0] in ("f", "l") and len(parts) in (3, 6):
+            boundary = (float(parts[1]), parts[2]) if parts[1] else None
+            if len(parts) == 3:
+                if boundary is None:
+                    raise ValueError(cursor)
+                return _SearchCursor(parts[0], boundary)
+            window, mask = int(parts[4]), int(parts[5], 16)
+            if window > 0 and mask >= 0:
+                now = float(parts[3]) if parts[3] else None
+                return _SearchCursor(parts[0], boundary, now, window, mask)
+    except ValueError:
+        pass
+    raise ValueError(f"invalid search cursor: {cursor!r}")
+
+
+# 参与同步的表与列。preview / bucket / fts_rowid 以及标签、实体、失败等派生索引在接收端按本地规则重建；
+# 私有观测不离开本机。
+_SYNC_TABLES = {
+    "session": ("sessions", ("id", "started_at", "ended_at", "project_path", "meta_json")),
+    "observation": (
+        "observations",
+        (
+            "id",
+            "session_id",
+            "ts",
+            "kind",
+            "tool_name",
+            "content",
+            "tags_json",
+            "seq",
+            "simhash",
+            "canonical_id",
+            "repeat_count",
+        ),
+    ),
+    "summary": ("summaries", ("id", "session_id", "created_at", "level", "content")),
+}
+
+
+def row_hash(row: dict[str, Any]) -> str:
+    import hashlib
+
+    raw = json.dumps(row, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.blake2b(raw.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def _json_default(obj: Any) -> Any:
+    if isinstance(obj, _Record):
+        return obj.as_dict()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def _json_default_compact(obj: Any) -> Any:
+    if isinstance(obj, _Record):
+        return {k: v for k, v in zip(obj.keys(), obj._values()) if v is not None}
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def to_json(payload: Any, indent: Optional[int] = None, compact: bool = False) -> str:
+    # compact：去掉分隔符后的空格，记录里值为 null 的字段省略。
+    if compact:
+        return json.dumps(payload, ensure_ascii=False, separators=(",", ":"), default=_json_default_compact)
+    return json.dumps(payload, ensure_ascii=False, indent=indent, default=_json_default)
 
 
 class TraeMemDB:
-    def __init__(self, db_path: Optional[Path] = None) -> None:
+    def __init__(
+        self, db_path: Optional[Path] = None, slow_query_ms: Optional[float] = None, rank: Optional[RankConfig] = None
+    ) -> None:
         if db_path is None:
             chosen = _default_db_path()
             try:
@@ -49,16 +452,111 @@ class TraeMemDB:
         else:
             self.db_path = db_path
             _ensure_parent_dir(self.db_path)
-        self._conn = sqlite3.connect(str(self.db_path))
+        if slow_query_ms is None:
+            slow_query_ms = slow_query_threshold_from_env()
+        self._slowlog = SlowQueryLog(slow_query_ms) if slow_query_ms is not None else None
+        self.rank = rank if rank is not None else RankConfig.from_env()
+        self.dedup = dedup_enabled_from_env()
+        # 读路径只在内存里累加访问次数，随下一次写事务（或攒够一批 / close）批量 upsert。
+        self._access_pending: dict[str, int] = {}
+        self._access_lock = threading.Lock()
+        # 单一写连接（加锁串行化）+ 每线程一个只读快照连接：WAL 下读不会被写事务阻塞。
+        self._conn = self._connect(str(self.db_path))
         self._conn.row_factory = sqlite3.Row
         self._conn.execute("PRAGMA journal_mode=WAL;")
         self._conn.execute("PRAGMA synchronous=NORMAL;")
         self._conn.execute("PRAGMA foreign_keys=ON;")
+        self._write_lock = threading.RLock()
+        self._local = threading.local()
+        self._readers: list[sqlite3.Connection] = []
+        self._readers_lock = threading.Lock()
+        self._tokenizer: Optional[str] = None
+        # 本进程内的写入提交后唤醒等待变更的长轮询；其他进程（hook）的写入靠短间隔轮询发现。
+        self._changes_cond = threading.Condition()
+        self._changes_dirty = False
+        # 应用同步分段时置为 (来源副本, 来源修改时间)，期间写入的变更日志沿用来源的版本，且不会再被推送出去。
+        self._sync_origin: Optional[tuple[str, float]] = None
+
+    def _connect(self, target: str, uri: bool = False) -> sqlite3.Connection:
+        if self._slowlog is None:
+            conn = sqlite3.connect(target, uri=uri, check_same_thread=False)
+        else:
+            conn = sqlite3.connect(target, uri=uri, check_same_thread=False, factory=TracedConnection)
+            conn.slowlog = self._slowlog
+        conn.create_function("trae_rank", 5, self._rank_score, deterministic=True)
+        return conn
+
+    def _rank_score(self, bm25: float, ts: int, kind: str, hits: int, now: float) -> float:
+        return self.rank.score(bm25, ts, kind, hits, now)
 
     def close(self) -> None:
+        if self._slowlog is not None or self._access_pending:
+            try:
+                with self._write():
+                    pass
+            except sqlite3.Error:
+                pass
+        with self._readers_lock:
+            readers, self._readers = self._readers, []
+        for conn in readers:
+            conn.close()
+        self._local = threading.local()
         self._conn.close()
 
+    @contextmanager
+    def _write(self) -> Iterator[sqlite3.Connection]:
+        with self._write_lock:
+            try:
+                yield self._conn
+                if self._slowlog is not None:
+                    try:
+                        self._slowlog.flush(self._conn)
+                    except sqlite3.OperationalError:
+                        pass
+                if self._access_pending:
+                    self._flush_access(self._conn)
+            except BaseException:
+                self._conn.rollback()
+                raise
+            self._conn.commit()
+            if self._changes_dirty:
+                self._changes_dirty = False
+                with self._changes_cond:
+                    self._changes_cond.notify_all()
+
+    def _reader(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            return conn
+        uri = self.db_path.resolve().as_uri() + "?mode=ro"
+        try:
+            conn = self._connect(uri, uri=True)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA query_only=ON;")
+        except sqlite3.OperationalError:
+            return self._conn
+        with self._readers_lock:
+            self._readers.append(conn)
+        self._local.conn = conn
+        return conn
+
+    def release_reader(self) -> None:
+        # 短命线程（HTTP 服务每个连接一个线程）用完归还本线程的只读连接，长期运行时文件句柄不随线程数累积。
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            return
+        self._local.conn = None
+        with self._readers_lock:
+            if conn in self._readers:
+                self._readers.remove(conn)
+        conn.close()
+
+    @timed("trae_mem_db_seconds", op="init_schema")
     def init_schema(self) -> None:
+        with self._write_lock:
+            self._init_schema()
+
+    def _init_schema(self) -> None:
         cur = self._conn.cursor()
         cur.executescript(
             """
@@ -100,6 +598,10 @@ class TraeMemDB:
         )
         self._conn.commit()
 
+        self._ensure_fts()
+        self._migrate()
+
+    def _ensure_fts(self) -> None:
         existing = self._conn.execute(
             "SELECT 1 FROM sqlite_master WHERE type='table' AND name='observations_fts'"
         ).fetchone()
@@ -136,73 +638,854 @@ class TraeMemDB:
             )
             self._conn.commit()
 
+    def _migrate(self) -> None:
+        version = int(self._conn.execute("PRAGMA user_version").fetchone()[0])
+        steps = [
+            (1, self._migrate_v1_tool_calls),
+            (2, self._migrate_v2_preview),
+            (3, self._migrate_v3_slow_queries),
+            (4, self._migrate_v4_filter_indexes),
+            (5, self._migrate_v5_seq),
+            (6, self._migrate_v6_access),
+            (7, self._migrate_v7_dedup),
+            (8, self._migrate_v8_entities),
+            (9, self._migrate_v9_failures),
+            (10, self._migrate_v10_tags),
+            (11, self._migrate_v11_transcript_offsets),
+            (12, self._migrate_v12_changes),
+            (13, self._migrate_v13_sync),
+            (14, self._migrate_v14_duplicate_fts),
+        ]
+        for target, step in steps:
+            if version >= target:
+                continue
+            try:
+                step()
+                self._conn.execute(f"PRAGMA user_version={target}")
+            except BaseException:
+                self._conn.rollback()
+                raise
+            self._conn.commit()
+            version = target
+
+    def _columns(self, table: str) -> set[str]:
+        return {r["name"] for r in self._conn.execute(f"PRAGMA table_info({table})")}
+
+    def _migrate_v1_tool_calls(self) -> None:
+        # fts_rowid 记录观测在 observations_fts 中的 rowid，原地更新内容时可按 rowid 点更新 FTS。
+        if "fts_rowid" not in self._columns("observations"):
+            self._conn.execute("ALTER TABLE observations ADD COLUMN fts_rowid INTEGER")
+            self._conn.executemany(
+                "UPDATE observations SET fts_rowid=? WHERE id=?",
+                ((r[0], r[1]) for r in self._conn.execute("SELECT rowid, id FROM observations_fts").fetchall()),
+            )
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS tool_calls (
+              call_key TEXT PRIMARY KEY,
+              observation_id TEXT NOT NULL,
+              session_id TEXT NOT NULL,
+              started_at REAL NOT NULL,
+              FOREIGN KEY(observation_id) REFERENCES observations(id) ON DELETE CASCADE
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_tool_calls_started ON tool_calls(started_at)")
+
+    def _migrate_v2_preview(self) -> None:
+        # 入库时预先算好单行预览与 kind 分桶，摘要阶段只做列投影，不再重复跑正则。
+        cols = self._columns("observations")
+        if "preview" not in cols:
+            self._conn.execute("ALTER TABLE observations ADD COLUMN preview TEXT")
+        if "bucket" not in cols:
+            self._conn.execute("ALTER TABLE observations ADD COLUMN bucket TEXT")
+        last = 0
+        while True:
+            rows = self._conn.execute(
+                "SELECT rowid, kind, content FROM observations WHERE rowid > ? ORDER BY rowid LIMIT 1000",
+                (last,),
+            ).fetchall()
+            if not rows:
+                break
+            self._conn.executemany(
+                "UPDATE observations SET preview=?, bucket=? WHERE rowid=?",
+                ((one_line_preview(r["content"] or ""), kind_bucket(r["kind"]), r[0]) for r in rows),
+            )
+            last = rows[-1][0]
+
+    def _migrate_v3_slow_queries(self) -> None:
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS slow_queries (
+              id INTEGER PRIMARY KEY AUTOINCREMENT,
+              ts REAL NOT NULL,
+              duration_ms REAL NOT NULL,
+              sql TEXT NOT NULL,
+              params_json TEXT,
+              plan TEXT
+            )
+            """
+        )
+
+    def _migrate_v4_filter_indexes(self) -> None:
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_observations_kind_ts ON observations(kind, ts)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_observations_tool_ts ON observations(tool_name, ts)")
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_sessions_project_started ON sessions(project_path, started_at)"
+        )
+
+    def _migrate_v5_seq(self) -> None:
+        # seq：会话内单调递增序号。ts 只有秒级精度，同一秒内的多条 hook 事件靠 seq 保持写入顺序，
+        # 也作为 timeline / 会话分页的 keyset 游标。存量数据按 (ts, rowid) 回填。
+        if "seq" not in self._columns("observations"):
+            self._conn.execute("ALTER TABLE observations ADD COLUMN seq INTEGER")
+        self._conn.execute("CREATE TEMP TABLE IF NOT EXISTS _seq_backfill (r INTEGER PRIMARY KEY, seq INTEGER NOT NULL)")
+        self._conn.execute(
+            """
+            INSERT INTO _seq_backfill(r, seq)
+            SELECT rowid, ROW_NUMBER() OVER (PARTITION BY session_id ORDER BY ts, rowid)
+            FROM observations
+            """
+        )
+        self._conn.execute(
+            "UPDATE observations SET seq=(SELECT seq FROM _seq_backfill WHERE r=observations.rowid)"
+        )
+        self._conn.execute("DROP TABLE _seq_backfill")
+        self._conn.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS idx_observations_session_seq ON observations(session_id, seq)"
+        )
+
+    def _migrate_v6_access(self) -> None:
+        # 访问计数单独成表：读路径的计数写入不会改写 observations 大行，也不触发 FTS 更新。
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS observation_access (
+              observation_id TEXT PRIMARY KEY,
+              hits INTEGER NOT NULL DEFAULT 0,
+              last_at INTEGER NOT NULL,
+              FOREIGN KEY(observation_id) REFERENCES observations(id) ON DELETE CASCADE
+            ) WITHOUT ROWID
+            """
+        )
+
+    def _migrate_v7_dedup(self) -> None:
+        # 近重复折叠：canonical_id 指向同会话内首条相似观测，repeat_count 记在 canonical 上。
+        # lsh_buckets 只收录 canonical 的 SimHash 分段；存量数据不回填，视为各自独立的 canonical。
+        cols = self._columns("observations")
+        if "simhash" not in cols:
+            self._conn.execute("ALTER TABLE observations ADD COLUMN simhash INTEGER")
+        if "canonical_id" not in cols:
+            self._conn.execute("ALTER TABLE observations ADD COLUMN canonical_id TEXT")
+        if "repeat_count" not in cols:
+            self._conn.execute("ALTER TABLE observations ADD COLUMN repeat_count INTEGER NOT NULL DEFAULT 1")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS lsh_buckets (
+              session_id TEXT NOT NULL,
+              bucket INTEGER NOT NULL,
+              observation_id TEXT NOT NULL,
+              PRIMARY KEY(session_id, bucket, observation_id),
+              FOREIGN KEY(observation_id) REFERENCES observations(id) ON DELETE CASCADE
+            ) WITHOUT ROWID
+            """
+        )
+
+    def _migrate_v8_entities(self) -> None:
+        # 实体倒排索引：entity -> observation。主键以 (entity, ts) 打头，点查按时间倒序直接沿主键扫描，
+        # 不需要额外的排序或二级索引；session_id 冗余存一份，按项目过滤时不用先回表 observations。
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS entities (
+              entity TEXT NOT NULL,
+              kind TEXT NOT NULL,
+              observation_id TEXT NOT NULL,
+              session_id TEXT NOT NULL,
+              ts INTEGER NOT NULL,
+              PRIMARY KEY(entity, ts, observation_id, kind),
+              FOREIGN KEY(observation_id) REFERENCES observations(id) ON DELETE CASCADE
+            ) WITHOUT ROWID
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_entities_observation ON entities(observation_id)")
+        buckets = ",".join("?" for _ in ENTITY_BUCKETS)
+        last = 0
+        while True:
+            rows = self._conn.execute(
+                f"""
+                SELECT rowid, id, session_id, ts, content FROM observations
+                WHERE rowid > ? AND private=0 AND canonical_id IS NULL AND bucket IN ({buckets})
+                ORDER BY rowid LIMIT 1000
+                """,
+                (last, *ENTITY_BUCKETS),
+            ).fetchall()
+            if not rows:
+                break
+            for r in rows:
+                self._index_entities(self._conn, r["id"], r["session_id"], r["ts"], r["content"] or "")
+            last = rows[-1][0]
+
+    def _index_entities(self, conn: sqlite3.Connection, obs_id: str, session_id: str, ts: int, content: str) -> None:
+        conn.executemany(
+            "INSERT OR IGNORE INTO entities(entity, kind, observation_id, session_id, ts) VALUES (?, ?, ?, ?, ?)",
+            ((entity, kind, obs_id, session_id, ts) for entity, kind in extract_entities(content)),
+        )
+
+    def _migrate_v9_failures(self) -> None:
+        # 失败聚合：同一指纹一行，入库时增量维护计数与首末次时间；failure_sessions 记录出现过的会话。
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS failures (
+              fingerprint TEXT PRIMARY KEY,
+              title TEXT NOT NULL,
+              first_seen INTEGER NOT NULL,
+              last_seen INTEGER NOT NULL,
+              count INTEGER NOT NULL DEFAULT 0,
+              session_count INTEGER NOT NULL DEFAULT 0,
+              last_observation_id TEXT
+            ) WITHOUT ROWID
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_failures_last_seen ON failures(last_seen)")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS failure_sessions (
+              fingerprint TEXT NOT NULL,
+              session_id TEXT NOT NULL,
+              first_seen INTEGER NOT NULL,
+              last_seen INTEGER NOT NULL,
+              count INTEGER NOT NULL DEFAULT 0,
+              last_observation_id TEXT NOT NULL,
+              PRIMARY KEY(fingerprint, session_id)
+            ) WITHOUT ROWID
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_failure_sessions_session ON failure_sessions(session_id)")
+        buckets = ",".join("?" for _ in FAILURE_BUCKETS)
+        last = 0
+        while True:
+            rows = self._conn.execute(
+                f"""
+                SELECT rowid, id, session_id, ts, bucket, content FROM observations
+                WHERE rowid > ? AND private=0 AND bucket IN ({buckets})
+                ORDER BY rowid LIMIT 1000
+                """,
+                (last, *FAILURE_BUCKETS),
+            ).fetchall()
+            if not rows:
+                break
+            for r in rows:
+                self._record_failure(self._conn, r["id"], r["session_id"], r["ts"], r["bucket"], r["content"] or "")
+            last = rows[-1][0]
+
+    def _migrate_v10_tags(self) -> None:
+        # tags_json 仍是原样存档；observation_tags 是它的可查询投影，(key, value) 打头的主键支撑等值过滤。
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS observation_tags (
+              key TEXT NOT NULL,
+              value TEXT NOT NULL,
+              observation_id TEXT NOT NULL,
+              PRIMARY KEY(key, value, observation_id),
+              FOREIGN KEY(observation_id) REFERENCES observations(id) ON DELETE CASCADE
+            ) WITHOUT ROWID
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_observation_tags_observation ON observation_tags(observation_id)")
+        last = 0
+        while True:
+            rows = self._conn.execute(
+                """
+                SELECT rowid, id, tags_json FROM observations
+                WHERE rowid > ? AND tags_json IS NOT NULL AND tags_json NOT IN ('', '{}')
+                ORDER BY rowid LIMIT 1000
+                """,
+                (last,),
+            ).fetchall()
+            if not rows:
+                break
+            for r in rows:
+                try:
+                    tags = json.loads(r["tags_json"])
+                except ValueError:
+                    continue
+                if isinstance(tags, dict):
+                    self._index_tags(self._conn, r["id"], tags)
+            last = rows[-1][0]
+
+    def _migrate_v11_transcript_offsets(self) -> None:
+        # 每个会话的 transcript 已读到的字节偏移与行号；重复的 SessionEnd 或续接会话只解析新增部分。
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS transcript_offsets (
+              session_id TEXT NOT NULL,
+              path TEXT NOT NULL,
+              offset INTEGER NOT NULL,
+              line INTEGER NOT NULL,
+              PRIMARY KEY(session_id, path)
+            ) WITHOUT ROWID
+            """
+        )
+
+    def _migrate_v12_changes(self) -> None:
+        # 只追加的变更日志：seq 用 AUTOINCREMENT，删行后也不会复用，可直接当订阅游标。
+        # 只记 (操作, 对象, id)，内容按 id 回查；存量数据不回填，订阅者从迁移之后的变更开始。
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS changes (
+              seq INTEGER PRIMARY KEY AUTOINCREMENT,
+              ts REAL NOT NULL,
+              op TEXT NOT NULL,
+              entity TEXT NOT NULL,
+              entity_id TEXT NOT NULL,
+              session_id TEXT
+            )
+            """
+        )
+
+    def _migrate_v13_sync(self) -> None:
+        # origin：由同步导入的变更记来源副本（本机写入为 NULL），推送时跳过，避免在副本间来回转发。
+        # sync_state 存本库的副本 id 与各共享目录的推送 / 拉取游标。
+        if "origin" not in self._columns("changes"):
+            self._conn.execute("ALTER TABLE changes ADD COLUMN origin TEXT")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sync_state (key TEXT PRIMARY KEY, value TEXT NOT NULL) WITHOUT ROWID"
+        )
+
+    def _migrate_v14_duplicate_fts(self) -> None:
+        # 近重复也进 FTS：折叠只发生在展示时（search 每组只返回一条），只出现在重复记录里的内容
+        # （不同的退出码、端口、行号）仍能搜到。补齐此前折叠时删掉的 FTS 行。
+        last = 0
+        while True:
+            rows = self._conn.execute(
+                """
+                SELECT rowid, id, session_id, kind, tool_name, content FROM observations
+                WHERE rowid > ? AND private=0 AND canonical_id IS NOT NULL AND fts_rowid IS NULL
+                ORDER BY rowid LIMIT 1000
+                """,
+                (last,),
+            ).fetchall()
+            if not rows:
+                break
+            for r in rows:
+                cur = self._conn.execute(
+                    "INSERT INTO observations_fts(id, session_id, kind, tool_name, content) VALUES (?, ?, ?, ?, ?)",
+                    (r["id"], r["session_id"], r["kind"], r["tool_name"] or "", r["content"]),
+                )
+                self._conn.execute("UPDATE observations SET fts_rowid=? WHERE rowid=?", (cur.lastrowid, r[0]))
+            last = rows[-1][0]
+
+    def _log_change(
+        self, conn: sqlite3.Connection, op: str, entity: str, entity_id: str, session_id: Optional[str]
+    ) -> None:
+        origin = self._sync_origin
+        conn.execute(
+            "INSERT INTO changes(ts, op, entity, entity_id, session_id, origin) VALUES (?, ?, ?, ?, ?, ?)",
+            (origin[1] if origin else time.time(), op, entity, entity_id, session_id, origin[0] if origin else None),
+        )
+        self._changes_dirty = True
+
+    def _index_tags(self, conn: sqlite3.Connection, obs_id: str, tags: Optional[dict[str, Any]]) -> None:
+        conn.executemany(
+            "INSERT OR IGNORE INTO observation_tags(key, value, observation_id) VALUES (?, ?, ?)",
+            ((key, value, obs_id) for key, value in tag_rows(tags)),
+        )
+
+    def _record_failure(
+        self, conn: sqlite3.Connection, obs_id: str, session_id: str, ts: int, bucket: str, content: str
+    ) -> None:
+        hit = failure_of(content, bucket)
+        if hit is None:
+            return
+        fp, title = hit
+        cur = conn.execute(
+            """
+            INSERT OR IGNORE INTO failure_sessions(fingerprint, session_id, first_seen, last_seen, count, last_observation_id)
+            VALUES (?, ?, ?, ?, 1, ?)
+            """,
+            (fp, session_id, ts, ts, obs_id),
+        )
+        new_session = cur.rowcount == 1
+        if not new_session:
+            conn.execute(
+                """
+                UPDATE failure_sessions SET
+                  count=count+1,
+                  first_seen=MIN(first_seen, ?),
+                  last_seen=MAX(last_seen, ?),
+                  last_observation_id=CASE WHEN ? >= last_seen THEN ? ELSE last_observation_id END
+                WHERE fingerprint=? AND session_id=?
+                """,
+                (ts, ts, ts, obs_id, fp, session_id),
+            )
+        conn.execute(
+            """
+            INSERT INTO failures(fingerprint, title, first_seen, last_seen, count, session_count, last_observation_id)
+            VALUES (?, ?, ?, ?, 1, ?, ?)
+            ON CONFLICT(fingerprint) DO UPDATE SET
+              count=count+1,
+              session_count=session_count+excluded.session_count,
+              first_seen=MIN(first_seen, excluded.first_seen),
+              last_seen=MAX(last_seen, excluded.last_seen),
+              last_observation_id=CASE WHEN excluded.last_seen >= last_seen
+                THEN excluded.last_observation_id ELSE last_observation_id END
+            """,
+            (fp, title, ts, ts, 1 if new_session else 0, obs_id),
+        )
+        inc("trae_mem_failures_total", bucket=bucket)
+
+    def _note_access(self, ids: Iterable[str]) -> None:
+        with self._access_lock:
+            for obs_id in ids:
+                self._access_pending[obs_id] = self._access_pending.get(obs_id, 0) + 1
+            full = len(self._access_pending) >= 256
+        if full:
+            try:
+                with self._write():
+                    pass
+            except sqlite3.Error:
+                pass
+
+    def _flush_access(self, conn: sqlite3.Connection) -> None:
+        with self._access_lock:
+            pending, self._access_pending = self._access_pending, {}
+        now = int(time.time())
+        try:
+            conn.executemany(
+                """
+                INSERT INTO observation_access(observation_id, hits, last_at) VALUES (?, ?, ?)
+                ON CONFLICT(observation_id) DO UPDATE SET hits=hits+excluded.hits, last_at=excluded.last_at
+                """,
+                ((obs_id, n, now) for obs_id, n in pending.items()),
+            )
+            # 访问计数参与排序：每次落盘推进一个代数，排序结果的 ETag 带上它。
+            if pending:
+                conn.execute(
+                    """
+                    INSERT INTO sync_state(key, value) VALUES ('access_generation', '1')
+                    ON CONFLICT(key) DO UPDATE SET value=CAST(value AS INTEGER) + 1
+                    """
+                )
+        except sqlite3.DatabaseError:
+            pass
+
+    def access_counts(self, ids: Iterable[str]) -> dict[str, int]:
+        ids_list = list(ids)
+        if not ids_list:
+            return {}
+        placeholders = ",".join("?" for _ in ids_list)
+        rows = self._reader().execute(
+            f"SELECT observation_id, hits FROM observation_access WHERE observation_id IN ({placeholders})",
+            ids_list,
+        ).fetchall()
+        return {r[0]: int(r[1]) for r in rows}
+
+    def slow_queries(self, limit: int = 50) -> list[SlowQueryRecord]:
+        if self._slowlog is not None:
+            with self._write():
+                pass
+        cur = self._query(
+            SlowQueryRecord,
+            f"SELECT {_columns_of(SlowQueryRecord)} FROM slow_queries ORDER BY id DESC LIMIT ?",
+            (limit,),
+        )
+        return cur.fetchall()
+
+    def clear_slow_queries(self) -> None:
+        with self._write() as conn:
+            conn.execute("DELETE FROM slow_queries")
+
+    @timed("trae_mem_db_seconds", op="new_session")
     def new_session(self, project_path: Optional[str] = None, meta: Optional[dict[str, Any]] = None) -> str:
-        session_id = uuid.uuid4().hex
+        session_id = _new_id()
         started_at = int(time.time())
         meta_json = json.dumps(meta or {}, ensure_ascii=False)
-        self._conn.execute(
-            "INSERT INTO sessions(id, started_at, project_path, meta_json) VALUES (?, ?, ?, ?)",
-            (session_id, started_at, project_path, meta_json),
-        )
-        self._conn.commit()
+        with self._write() as conn:
+            conn.execute(
+                "INSERT INTO sessions(id, started_at, project_path, meta_json) VALUES (?, ?, ?, ?)",
+                (session_id, started_at, project_path, meta_json),
+            )
+            self._log_change(conn, "insert", "session", session_id, session_id)
         return session_id
 
+    @timed("trae_mem_db_seconds", op="end_session")
     def end_session(self, session_id: str) -> None:
         ended_at = int(time.time())
-        self._conn.execute("UPDATE sessions SET ended_at=? WHERE id=?", (ended_at, session_id))
-        self._conn.commit()
+        with self._write() as conn:
+            conn.execute("UPDATE sessions SET ended_at=? WHERE id=?", (ended_at, session_id))
+            self._log_change(conn, "update", "session", session_id, session_id)
 
-    def add_observation(
+    def _insert_observation(
         self,
+        conn: sqlite3.Connection,
         session_id: str,
         kind: str,
         content: str,
-        tool_name: Optional[str] = None,
-        tags: Optional[dict[str, Any]] = None,
-        private: bool = False,
-        ts: Optional[int] = None,
+        tool_name: Optional[str],
+        tags: Optional[dict[str, Any]],
+        private: bool,
+        ts: Optional[int],
+        pending: bool = False,
     ) -> str:
-        obs_id = uuid.uuid4().hex
+        # pending：PreToolUse 阶段只有输入的占位内容，去重与失败聚合推迟到 complete_tool_call。
+        obs_id = _new_id()
         ts_i = int(ts or time.time())
         tags_json = json.dumps(tags or {}, ensure_ascii=False)
         private_i = 1 if private else 0
-        self._conn.execute(
-            """
-            INSERT INTO observations(id, session_id, ts, kind, tool_name, content, private, tags_json)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            """,
-            (obs_id, session_id, ts_i, kind, tool_name, content, private_i, tags_json),
-        )
+        fts_rowid = None
+        sim = canonical = None
+        if not pending and self._dedupable(kind, private):
+            sim = simhash(content)
+            canonical = self._find_canonical(conn, session_id, kind, tool_name, sim)
         if not private:
-            self._conn.execute(
+            cur = conn.execute(
                 """
                 INSERT INTO observations_fts(id, session_id, kind, tool_name, content)
                 VALUES (?, ?, ?, ?, ?)
                 """,
                 (obs_id, session_id, kind, tool_name or "", content),
             )
-        self._conn.commit()
+            fts_rowid = cur.lastrowid
+        conn.execute(
+            """
+            INSERT INTO observations(
+              id, session_id, ts, kind, tool_name, content, private, tags_json, fts_rowid, preview, bucket,
+              simhash, canonical_id, seq
+            )
+            VALUES (
+              ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?,
+              (SELECT COALESCE(MAX(seq), 0) + 1 FROM observations WHERE session_id=?)
+            )
+            """,
+            (
+                obs_id,
+                session_id,
+                ts_i,
+                kind,
+                tool_name,
+                content,
+                private_i,
+                tags_json,
+                fts_rowid,
+                one_line_preview(content),
+                kind_bucket(kind),
+                None if sim is None else to_signed(sim),
+                canonical,
+                session_id,
+            ),
+        )
+        self._log_change(conn, "insert", "observation", obs_id, session_id)
+        if canonical is not None:
+            self._link_duplicate(conn, canonical, kind)
+        elif sim is not None:
+            self._add_lsh_buckets(conn, session_id, obs_id, sim)
+        if tags:
+            self._index_tags(conn, obs_id, tags)
+        if canonical is None and not private and kind_bucket(kind) in ENTITY_BUCKETS:
+            self._index_entities(conn, obs_id, session_id, ts_i, content)
+        # 近重复同样计入失败次数：折叠只影响展示，不影响"出现过几次"。
+        if not pending and not private and kind_bucket(kind) in FAILURE_BUCKETS:
+            self._record_failure(conn, obs_id, session_id, ts_i, kind_bucket(kind), content)
         return obs_id
 
+    def _dedupable(self, kind: str, private: bool) -> bool:
+        return self.dedup and not private and kind_bucket(kind) in DEDUP_BUCKETS
+
+    def _find_canonical(
+        self,
+        conn: sqlite3.Connection,
+        session_id: str,
+        kind: str,
+        tool_name: Optional[str],
+        sim: int,
+        exclude: Optional[str] = None,
+    ) -> Optional[str]:
+        keys = band_keys(sim)
+        rows = conn.execute(
+            f"""
+            SELECT DISTINCT o.id, o.simhash, o.seq FROM lsh_buckets b
+            JOIN observations o ON o.id = b.observation_id
+            WHERE b.session_id=? AND b.bucket IN ({",".join("?" for _ in keys)})
+              AND o.kind=? AND o.tool_name IS ? AND o.canonical_id IS NULL
+            """,
+            (session_id, *keys, kind, tool_name),
+        ).fetchall()
+        best = None
+        for r in rows:
+            if r[0] == exclude or r[1] is None:
+                continue
+            d = distance(sim, int(r[1]))
+            if d <= MAX_DISTANCE and (best is None or (d, r[2]) < best[:2]):
+                best = (d, r[2], r[0])
+        return None if best is None else str(best[2])
+
+    def _link_duplicate(self, conn: sqlite3.Connection, canonical: str, kind: str) -> None:
+        conn.execute("UPDATE observations SET repeat_count=repeat_count+1 WHERE id=?", (canonical,))
+        row = conn.execute("SELECT session_id FROM observations WHERE id=?", (canonical,)).fetchone()
+        if row:
+            self._log_change(conn, "update", "observation", canonical, row[0])
+        inc("trae_mem_dedup_total", bucket=kind_bucket(kind))
+
+    def _add_lsh_buckets(self, conn: sqlite3.Connection, session_id: str, obs_id: str, sim: int) -> None:
+        conn.executemany(
+            "INSERT OR IGNORE INTO lsh_buckets(session_id, bucket, observation_id) VALUES (?, ?, ?)",
+            ((session_id, key, obs_id) for key in band_keys(sim)),
+        )
+
+    def _dedup_completed(self, conn: sqlite3.Connection, obs_id: str) -> None:
+        # 工具调用在 PreToolUse 时只有输入，去重推迟到 PostToolUse 拿到完整输出之后。
+        row = conn.execute(
+            "SELECT session_id, kind, tool_name, content, private FROM observations WHERE id=?",
+            (obs_id,),
+        ).fetchone()
+        if not row or not self._dedupable(row["kind"], bool(row["private"])):
+            return
+        sim = simhash(row["content"])
+        canonical = self._find_canonical(conn, row["session_id"], row["kind"], row["tool_name"], sim, exclude=obs_id)
+        if canonical is None:
+            conn.execute("UPDATE observations SET simhash=? WHERE id=?", (to_signed(sim), obs_id))
+            self._add_lsh_buckets(conn, row["session_id"], obs_id, sim)
+            return
+        conn.execute(
+            "UPDATE observations SET simhash=?, canonical_id=? WHERE id=?", (to_signed(sim), canonical, obs_id)
+        )
+        self._link_duplicate(conn, canonical, row["kind"])
+
+    def _reindex_entities(self, conn: sqlite3.Connection, obs_id: str) -> None:
+        # 内容改写后重建该条的实体；被折叠为近重复的记录不进索引，查询只返回 canonical。
+        conn.execute("DELETE FROM entities WHERE observation_id=?", (obs_id,))
+        row = conn.execute(
+            "SELECT session_id, ts, content, private, bucket, canonical_id FROM observations WHERE id=?",
+            (obs_id,),
+        ).fetchone()
+        if row and not row["private"] and row["canonical_id"] is None and row["bucket"] in ENTITY_BUCKETS:
+            self._index_entities(conn, obs_id, row["session_id"], row["ts"], row["content"] or "")
+
+    def _update_observation(
+        self, conn: sqlite3.Connection, obs_id: str, content: str, tags: dict[str, Any]
+    ) -> None:
+        row = conn.execute("SELECT fts_rowid, session_id FROM observations WHERE id=?", (obs_id,)).fetchone()
+        if not row:
+            return
+        conn.execute(
+            "UPDATE observations SET content=?, tags_json=?, preview=? WHERE id=?",
+            (content, json.dumps(tags, ensure_ascii=False), one_line_preview(content), obs_id),
+        )
+        conn.execute("DELETE FROM observation_tags WHERE observation_id=?", (obs_id,))
+        self._index_tags(conn, obs_id, tags)
+        if row["fts_rowid"] is not None:
+            conn.execute("UPDATE observations_fts SET content=? WHERE rowid=?", (content, row["fts_rowid"]))
+        self._log_change(conn, "update", "observation", obs_id, row["session_id"])
+
+    @timed("trae_mem_db_seconds", op="add_observation")
+    def add_observation(
+        self,
+        session_id: str,
+        kind: str,
+        content: str,
+        tool_name: Optional[str] = None,
+        tags: Optional[dict[str, Any]] = None,
+        private: bool = False,
+        ts: Optional[int] = None,
+    ) -> str:
+        with self._write() as conn:
+            return self._insert_observation(conn, session_id, kind, content, tool_name, tags, private, ts)
+
+    @timed("trae_mem_db_seconds", op="open_tool_call")
+    def open_tool_call(
+        self,
+        session_id: str,
+        call_key: str,
+        tool_name: Optional[str],
+        content: str,
+        tags: Optional[dict[str, Any]] = None,
+    ) -> str:
+        with self._write() as conn:
+            obs_id = self._insert_observation(
+                conn,
+                session_id,
+                "tool",
+                content,
+                tool_name,
+                {**(tags or {}), "status": "pending"},
+                False,
+                None,
+                pending=True,
+            )
+            # 没有 tool_use_id 时同一会话里相同输入的调用共用一个键（h:...）；键已被未完成的调用占用时
+            # 存成 <键>#<观测 id>，完成时按开始顺序先进先出，前一条不会丢掉映射而一直停在 pending。
+            if conn.execute("SELECT 1 FROM tool_calls WHERE call_key=?", (call_key,)).fetchone():
+                call_key = f"{call_key}#{obs_id}"
+            conn.execute(
+                "INSERT INTO tool_calls(call_key, observation_id, session_id, started_at) VALUES (?, ?, ?, ?)",
+                (call_key, obs_id, session_id, time.time()),
+            )
+        return obs_id
+
+    @timed("trae_mem_db_seconds", op="complete_tool_call")
+    def complete_tool_call(
+        self, call_key: str, content: str, tags: Optional[dict[str, Any]] = None
+    ) -> Optional[str]:
+        with self._write() as conn:
+            return self._complete_tool_call(conn, call_key, content, tags)
+
+    def _complete_tool_call(
+        self,
+        conn: sqlite3.Connection,
+        call_key: str,
+        content: str,
+        tags: Optional[dict[str, Any]],
+        finished_at: Optional[float] = None,
+    ) -> Optional[str]:
+        row = conn.execute(
+            """
+            SELECT c.call_key AS call_key, c.observation_id AS observation_id, c.started_at AS started_at,
+                   o.tags_json AS tags_json
+            FROM tool_calls c
+            JOIN observations o ON o.id = c.observation_id
+            WHERE c.call_key=? OR (c.call_key > ? AND c.call_key < ?)
+            ORDER BY c.started_at, c.rowid
+            LIMIT 1
+            """,
+            (call_key, call_key + "#", call_key + "$"),
+        ).fetchone()
+        if not row:
+            return None
+        merged = json.loads(row["tags_json"] or "{}")
+        merged.update(tags or {})
+        merged["status"] = "done"
+        end = time.time() if finished_at is None else finished_at
+        merged["duration_ms"] = max(int((end - float(row["started_at"])) * 1000), 0)
+        self._update_observation(conn, row["observation_id"], content, merged)
+        self._dedup_completed(conn, row["observation_id"])
+        self._reindex_entities(conn, row["observation_id"])
+        obs = conn.execute(
+            "SELECT session_id, ts, private FROM observations WHERE id=?", (row["observation_id"],)
+        ).fetchone()
+        if obs and not obs["private"]:
+            self._record_failure(conn, row["observation_id"], obs["session_id"], obs["ts"], "tool", content)
+        conn.execute("DELETE FROM tool_calls WHERE call_key=?", (row["call_key"],))
+        return str(row["observation_id"])
+
+    def reconcile_keys(self, session_id: str) -> tuple[dict[tuple[str, str, str], int], dict[tuple[str, str, str], list[str]]]:
+        # 会话里已有记录的对账键及出现次数：工具调用用 hook 记下的输入哈希（tags.input.sha1），
+        # 用户输入用内容哈希。第二项是仍在等待 PostToolUse 的调用（键 -> call_key，按开始顺序）。
+        import hashlib
+
+        seen: dict[tuple[str, str, str], int] = {}
+        pending: dict[tuple[str, str, str], list[str]] = {}
+        rows = self._reader().execute(
+            """
+            SELECT o.kind, o.tool_name, o.tags_json, o.content, c.call_key FROM observations o
+            LEFT JOIN tool_calls c ON c.observation_id = o.id
+            WHERE o.session_id=? AND o.kind IN ('tool', 'user')
+            ORDER BY o.seq
+            """,
+            (session_id,),
+        ).fetchall()
+        for r in rows:
+            if r[0] == "user":
+                key = ("user", "", hashlib.sha1((r[3] or "").encode("utf-8")).hexdigest())
+            else:
+                try:
+                    sha1 = (json.loads(r[2] or "{}").get("input") or {}).get("sha1")
+                except (ValueError, AttributeError):
+                    sha1 = None
+                if not sha1:
+                    continue
+                key = ("tool", r[1] or "", str(sha1))
+            if r[4]:
+                pending.setdefault(key, []).append(str(r[4]))
+            else:
+                seen[key] = seen.get(key, 0) + 1
+        return seen, pending
+
+    def transcript_offset(self, session_id: str, path: str) -> tuple[int, int]:
+        row = self._reader().execute(
+            "SELECT offset, line FROM transcript_offsets WHERE session_id=? AND path=?", (session_id, path)
+        ).fetchone()
+        return (int(row[0]), int(row[1])) if row else (0, 0)
+
+    @timed("trae_mem_db_seconds", op="bulk_ingest")
+    def bulk_ingest(
+        self,
+        session_id: str,
+        rows: Iterable[tuple[str, str, Optional[str], Optional[dict[str, Any]], bool, Optional[int]]],
+        completions: Iterable[tuple[str, str, Optional[dict[str, Any]], Optional[float]]] = (),
+        transcript: Optional[tuple[str, int, int]] = None,
+    ) -> int:
+        # 一个写事务内：补完缺失的 PostToolUse、插入缺失的记录 (kind, content, tool_name, tags, private, ts)，
+        # 并推进 transcript 读取位置 (path, offset, line)；中途失败整体回滚，下次从旧位置重来。
+        n = 0
+        with self._write() as conn:
+            for call_key, content, tags, finished_at in completions:
+                if self._complete_tool_call(conn, call_key, content, tags, finished_at) is not None:
+                    n += 1
+            for kind, content, tool_name, tags, private, ts in rows:
+                self._insert_observation(conn, session_id, kind, content, tool_name, tags, private, ts)
+                n += 1
+            if transcript is not None:
+                conn.execute(
+                    """
+                    INSERT INTO transcript_offsets(session_id, path, offset, line) VALUES (?, ?, ?, ?)
+                    ON CONFLICT(session_id, path) DO UPDATE SET offset=excluded.offset, line=excluded.line
+                    """,
+                    (session_id, *transcript),
+                )
+        return n
+
+    @timed("trae_mem_db_seconds", op="expire_tool_calls")
+    def expire_tool_calls(self, timeout_s: float) -> int:
+        # 每次 PreToolUse 都会调用：先用只读连接看最早的挂起调用（started_at 索引），没有超时的就不开写事务。
+        cutoff = time.time() - timeout_s
+        oldest = self._reader().execute("SELECT MIN(started_at) FROM tool_calls").fetchone()[0]
+        if oldest is None or oldest >= cutoff:
+            return 0
+        with self._write() as conn:
+            rows = conn.execute(
+                """
+                SELECT c.call_key AS call_key, o.id AS observation_id, o.content AS content, o.tags_json AS tags_json
+                FROM tool_calls c
+                JOIN observations o ON o.id = c.observation_id
+                WHERE c.started_at < ?
+                """,
+                (cutoff,),
+            ).fetchall()
+            for r in rows:
+                tags = json.loads(r["tags_json"] or "{}")
+                tags["status"] = "timeout"
+                self._update_observation(conn, r["observation_id"], r["content"], tags)
+            conn.execute("DELETE FROM tool_calls WHERE started_at < ?", (cutoff,))
+        return len(rows)
+
+    @timed("trae_mem_db_seconds", op="add_summary")
     def add_summary(self, session_id: str, level: str, content: str) -> str:
-        summary_id = uuid.uuid4().hex
+        summary_id = _new_id()
         created_at = int(time.time())
-        self._conn.execute(
-            "INSERT INTO summaries(id, session_id, created_at, level, content) VALUES (?, ?, ?, ?, ?)",
-            (summary_id, session_id, created_at, level, content),
-        )
-        self._conn.commit()
+        with self._write() as conn:
+            conn.execute(
+                "INSERT INTO summaries(id, session_id, created_at, level, content) VALUES (?, ?, ?, ?, ?)",
+                (summary_id, session_id, created_at, level, content),
+            )
+            self._log_change(conn, "insert", "summary", summary_id, session_id)
         return summary_id
 
-    def get_session(self, session_id: str) -> Optional[sqlite3.Row]:
-        cur = self._conn.execute("SELECT * FROM sessions WHERE id=?", (session_id,))
+    def _query(self, cls: type[_R], sql: str, params: Iterable[Any] = ()) -> sqlite3.Cursor:
+        cur = self._reader().cursor()
+        cur.row_factory = _record_factory(cls)
+        return cur.execute(sql, tuple(params))
+
+    @timed("trae_mem_db_seconds", op="get_session")
+    def get_session(self, session_id: str) -> Optional[SessionRecord]:
+        cur = self._query(SessionRecord, f"SELECT {_SESSION_COLS} FROM sessions WHERE id=?", (session_id,))
         return cur.fetchone()
 
-    def get_recent_sessions(self, project_path: Optional[str], limit: int = 10) -> list[sqlite3.Row]:
+    @timed("trae_mem_db_seconds", op="get_recent_sessions")
+    def get_recent_sessions(self, project_path: Optional[str], limit: int = 10) -> list[SessionRecord]:
         if project_path:
-            cur = self._conn.execute(
-                """
-                SELECT * FROM sessions
+            cur = self._query(
+                SessionRecord,
+                f"""
+                SELECT {_SESSION_COLS} FROM sessions
                 WHERE project_path=?
                 ORDER BY started_at DESC
                 LIMIT ?
@@ -210,16 +1493,19 @@ class TraeMemDB:
                 (project_path, limit),
             )
         else:
-            cur = self._conn.execute(
-                "SELECT * FROM sessions ORDER BY started_at DESC LIMIT ?",
+            cur = self._query(
+                SessionRecord,
+                f"SELECT {_SESSION_COLS} FROM sessions ORDER BY started_at DESC LIMIT ?",
                 (limit,),
             )
-        return list(cur.fetchall())
+        return cur.fetchall()
 
-    def get_latest_summary(self, session_id: str, level: str = "brief") -> Optional[sqlite3.Row]:
-        cur = self._conn.execute(
-            """
-            SELECT * FROM summaries
+    @timed("trae_mem_db_seconds", op="get_latest_summary")
+    def get_latest_summary(self, session_id: str, level: str = "brief") -> Optional[SummaryRecord]:
+        cur = self._query(
+            SummaryRecord,
+            f"""
+            SELECT {_SUMMARY_COLS} FROM summaries
             WHERE session_id=? AND level=?
             ORDER BY created_at DESC
             LIMIT 1
@@ -228,121 +1514,725 @@ class TraeMemDB:
         )
         return cur.fetchone()
 
+    @timed("trae_mem_db_seconds", op="get_observations")
     def get_observations(
         self, ids: Iterable[str]
-    ) -> list[sqlite3.Row]:
+    ) -> list[ObservationRecord]:
         ids_list = list(ids)
         if not ids_list:
             return []
         placeholders = ",".join("?" for _ in ids_list)
-        cur = self._conn.execute(
-            f"SELECT * FROM observations WHERE id IN ({placeholders})",
+        cur = self._query(
+            ObservationRecord,
+            f"SELECT {_OBS_COLS} FROM observations WHERE id IN ({placeholders})",
             ids_list,
         )
-        rows = list(cur.fetchall())
-        rows.sort(key=lambda r: r["ts"])
+        rows = cur.fetchall()
+        rows.sort(key=lambda r: r.ts)
+        self._note_access(r.id for r in rows)
         return rows
 
+    @timed("trae_mem_db_seconds", op="get_observations_by_session")
     def get_observations_by_session(
-        self, session_id: str, limit: int = 500
-    ) -> list[sqlite3.Row]:
-        cur = self._conn.execute(
-            """
-            SELECT * FROM observations
-            WHERE session_id=?
-            ORDER BY ts ASC
+        self,
+        session_id: str,
+        limit: int = 500,
+        after_seq: Optional[int] = None,
+        tags: Optional[dict[str, str]] = None,
+    ) -> list[ObservationRecord]:
+        # keyset 分页：下一页传入上一页最后一条的 seq，走 (session_id, seq) 索引，深翻页也只读一页。
+        pred, params = _observation_filters("observations", tags=tags)
+        cur = self._query(
+            ObservationRecord,
+            f"""
+            SELECT {_OBS_COLS} FROM observations
+            WHERE session_id=? AND seq > ?{pred}
+            ORDER BY seq ASC
             LIMIT ?
             """,
-            (session_id, limit),
+            (session_id, int(after_seq or 0), *params, limit),
+        )
+        return cur.fetchall()
+
+    def iter_session_observations(
+        self,
+        session_id: str,
+        include_private: bool = False,
+        batch_size: int = 500,
+        include_duplicates: bool = False,
+    ) -> Iterator[ObservationLike]:
+        # 默认跳过近重复（canonical_id 非空）的行，摘要里每类重复输出只出现一次。
+        cur = self._reader().execute(
+            """
+            SELECT ts, kind, tool_name, content, preview, bucket FROM observations
+            WHERE session_id=? AND (? OR private=0) AND (? OR canonical_id IS NULL)
+            ORDER BY seq ASC
+            """,
+            (session_id, 1 if include_private else 0, 1 if include_duplicates else 0),
+        )
+        try:
+            while True:
+                rows = cur.fetchmany(batch_size)
+                if not rows:
+                    return
+                for r in rows:
+                    yield ObservationLike(
+                        ts=int(r["ts"]),
+                        kind=str(r["kind"]),
+                        tool_name=str(r["tool_name"]) if r["tool_name"] else None,
+                        content=str(r["content"]),
+                        preview=r["preview"],
+                        bucket=r["bucket"],
+                    )
+        finally:
+            cur.close()
+
+    def search(
+        self,
+        query: str,
+        limit: int = 20,
+        project: Optional[str] = None,
+        kinds: Optional[Iterable[str]] = None,
+        tool_name: Optional[str] = None,
+        session_id: Optional[str] = None,
+        since: Optional[int] = None,
+        until: Optional[int] = None,
+        advanced: bool = False,
+        tags: Optional[dict[str, str]] = None,
+        now: Optional[float] = None,
+    ) -> list[SearchHit]:
+        hits, _ = self.search_page(
+            query,
+            limit=limit,
+            project=project,
+            kinds=kinds,
+            tool_name=tool_name,
+            session_id=session_id,
+            since=since,
+            until=until,
+            advanced=advanced,
+            tags=tags,
+            now=now,
         )
-        return list(cur.fetchall())
+        return hits
+
+    def _fts_tokenizer(self) -> str:
+        if self._tokenizer is None:
+            row = self._reader().execute(
+                "SELECT sql FROM sqlite_master WHERE type='table' AND name='observations_fts'"
+            ).fetchone()
+            self._tokenizer = "trigram" if row and "trigram" in (row[0] or "") else "unicode61"
+        return self._tokenizer
 
-    def search(self, query: str, limit: int = 20) -> list[SearchHit]:
+    @timed("trae_mem_db_seconds", op="search")
+    def search_page(
+        self,
+        query: str,
+        limit: int = 20,
+        cursor: Optional[str] = None,
+        project: Optional[str] = None,
+        kinds: Optional[Iterable[str]] = None,
+        tool_name: Optional[str] = None,
+        session_id: Optional[str] = None,
+        since: Optional[int] = None,
+        until: Optional[int] = None,
+        advanced: bool = False,
+        tags: Optional[dict[str, str]] = None,
+        now: Optional[float] = None,
+    ) -> tuple[list[SearchHit], Optional[str]]:
+        # 返回 (本页结果, 下一页游标)。游标记录第一页走的路径（f=FTS / l=LIKE 兜底），翻页时不会换路径。
+        # 开启排序（self.rank）时两条路径都按原生顺序切成 pool 条一组的候选窗口，窗口内按 trae_rank() 重排（见 _SearchCursor）；
+        # 关闭时 FTS 按 bm25、LIKE 按 ts DESC。now 固定时间衰减的基准（默认当前时间，翻页时沿用游标里的值）。
+        # advanced=True 时原样作为 FTS5 表达式执行，语法错误抛 ValueError，不回退 LIKE。
         q = query.strip()
         if not q:
-            return []
+            return [], None
+        page = _parse_search_cursor(cursor)
+        path = page.path if page is not None else None
+        if advanced:
+            compiled = FtsQuery(q, [], True)
+        else:
+            compiled = compile_query(q, self._fts_tokenizer())
+        filters = dict(
+            project=project,
+            kinds=kinds,
+            tool_name=tool_name,
+            session_id=session_id,
+            since=since,
+            until=until,
+            tags=tags,
+        )
+        ranked = self.rank.enabled
         hits: list[SearchHit] = []
-        try:
-            cur = self._conn.execute(
-                """
+        fallback = "unindexable"
+        if path in (None, "f") and compiled.match is not None:
+            pred, params = _observation_filters("o", **filters)
+            if not compiled.exact:
+                like_pred, like_params = compiled.like_sql("o.content")
+                pred += " AND " + like_pred
+                params = [*params, *like_params]
+            source = f"""
                 SELECT
                   o.id AS id,
                   o.ts AS ts,
                   o.kind AS kind,
-                  o.tool_name AS tool_name,
+                  NULLIF(o.tool_name, '') AS tool_name,
                   o.session_id AS session_id,
-                  snippet(observations_fts, 4, '[', ']', '…', 12) AS snip,
-                  bm25(observations_fts) AS score
+                  observations_fts.rowid AS snippet,
+                  bm25(observations_fts) AS score,
+                  o.repeat_count AS repeat_count,
+                  COALESCE(o.canonical_id, o.id) AS grp,
+                  o.canonical_id IS NOT NULL AS dup
                 FROM observations_fts
                 JOIN observations o ON o.id = observations_fts.id
-                WHERE observations_fts MATCH ?
-                ORDER BY score
-                LIMIT ?
-                """,
-                (q, limit),
-            )
-            for r in cur.fetchall():
-                hits.append(
-                    SearchHit(
-                        id=r["id"],
-                        ts=r["ts"],
-                        kind=r["kind"],
-                        tool_name=r["tool_name"] if r["tool_name"] else None,
-                        session_id=r["session_id"],
-                        snippet=r["snip"],
-                        score=float(r["score"]),
-                    )
+                WHERE observations_fts MATCH ?{pred}
+            """
+            # snippet 列先放 FTS rowid，只对最终返回的一页回查一次（见 _search_hits）。
+            try:
+                hits, next_cursor = self._search_run(
+                    "f", source, [compiled.match, *params], page, limit, now, compiled.match
                 )
-        except sqlite3.OperationalError:
-            hits = []
+                fallback = "no_hits"
+            except sqlite3.OperationalError as e:
+                if advanced:
+                    raise ValueError(f"invalid FTS5 query: {e}") from e
+                hits = []
+                fallback = "fts_error"
+            # trigram 是子串索引：精确编译的查询在 FTS 里没命中，LIKE 也不会命中，不必再全表扫描。
+            if hits or path == "f" or advanced or (compiled.exact and self._fts_tokenizer() == "trigram"):
+                inc("trae_mem_search_path_total", path="fts")
+                return hits, next_cursor
+        elif advanced:
+            return [], None
 
-        if hits:
-            return hits
+        if path is None:
+            inc("trae_mem_search_fallback_total", reason=fallback)
+        inc("trae_mem_search_path_total", path="like")
+        pred, params = _observation_filters("o", **filters)
+        if compiled.groups:
+            like_pred, like_params = compiled.like_sql("o.content")
+        else:
+            like_pred, like_params = "o.content LIKE ? ESCAPE '\\'", ["%" + like_escape(q) + "%"]
+        source = f"""
+            SELECT
+              o.id AS id,
+              o.ts AS ts,
+              o.kind AS kind,
+              NULLIF(o.tool_name, '') AS tool_name,
+              o.session_id AS session_id,
+              CASE WHEN length(o.content) <= 120 THEN o.content ELSE substr(o.content, 1, 119) || '…' END AS snippet,
+              {"-1.0" if ranked else "0.0"} AS score,
+              o.repeat_count AS repeat_count,
+              COALESCE(o.canonical_id, o.id) AS grp,
+              o.canonical_id IS NOT NULL AS dup
+            FROM observations o
+            WHERE o.private=0 AND {like_pred}{pred}
+        """
+        return self._search_run("l", source, [*like_params, *params], page, limit, now)
 
-        like = f"%{q}%"
-        cur2 = self._conn.execute(
-            """
-            SELECT id, ts, kind, tool_name, session_id, content
-            FROM observations
-            WHERE private=0 AND content LIKE ?
-            ORDER BY ts DESC
+    def _search_run(
+        self,
+        path: str,
+        source: str,
+        params: list[Any],
+        page: Optional[_SearchCursor],
+        limit: int,
+        now: Optional[float] = None,
+        match: Optional[str] = None,
+    ) -> tuple[list[SearchHit], Optional[str]]:
+        # 原生顺序：FTS 为 score(bm25), id 升序；LIKE 为 ts, id 降序。折叠与重排都只在当前窗口内进行，
+        # 不会对整个匹配集做分组或排序。
+        native_order, native_key = ("score, id", "score") if path == "f" else ("ts DESC, id DESC", "ts")
+        boundary = page.boundary if page is not None else None
+        ranked = self.rank.enabled
+        if not ranked:
+            now = None
+        elif page is not None and page.now is not None:
+            now = page.now
+        elif now is None:
+            now = time.time()
+        if page is not None and page.window:
+            window = page.window
+        else:
+            window = max(self.rank.pool, limit) if ranked else limit
+        mask = page.mask if page is not None else 0
+        if ranked:
+            rank_sql, rank_params = "trae_rank(c.score, c.ts, c.kind, COALESCE(a.hits, 0), ?)", (now,)
+            access_join = "LEFT JOIN observation_access a ON a.observation_id = c.id"
+        else:
+            rank_sql, rank_params, access_join = "c.score", (), ""
+        hits: list[tuple] = []
+        while True:
+            after, after_params = _native_after(path, boundary)
+            rows = self._reader().execute(
+                f"""
+                SELECT
+                  c.id, c.ts, c.kind, c.tool_name, c.session_id, c.snippet, {rank_sql} AS rank,
+                  c.repeat_count, c.{native_key} AS native, c.grp, c.dup
+                FROM (
+                  SELECT *, row_number() OVER (ORDER BY {native_order}) AS pos FROM (
+                    SELECT * FROM ({source}) {after} ORDER BY {native_order} LIMIT ?
+                  )
+                ) c
+                {access_join}
+                ORDER BY c.pos
+                """,
+                (*rank_params, *params, *after_params, window),
+            ).fetchall()
+            kept = _collapse_window(rows, 9, 10)
+            todo = [i for i in kept if not mask >> i & 1]
+            if ranked:
+                todo.sort(key=lambda i: (rows[i][6], rows[i][0]))
+            for i in todo[: limit - len(hits)]:
+                mask |= 1 << i
+                hits.append(tuple(rows[i])[:8])
+            if any(not mask >> i & 1 for i in kept):
+                break
+            # 本窗口已取完：不满一个窗口说明到底了，否则从窗口最后一行之后开下一个窗口。
+            if len(rows) < window:
+                return self._search_hits(path, hits, match), None
+            boundary, mask = (float(rows[-1][8]), str(rows[-1][0])), 0
+            if len(hits) >= limit:
+                break
+        return self._search_hits(path, hits, match), str(_SearchCursor(path, boundary, now, window, mask))
+
+    def _search_hits(self, path: str, rows: list[tuple], match: Optional[str]) -> list[SearchHit]:
+        if path == "f" and rows:
+            # 一次 MATCH 扫描，只对本页的 FTS rowid 生成 snippet。+rowid 让 IN 只做过滤：交给 FTS5 按 rowid
+            # 逐个定位时，每个值都要重新读取查询词的 doclist。
+            rowids = [row[5] for row in rows]
+            snippets = dict(
+                self._reader().execute(
+                    "SELECT rowid, snippet(observations_fts, 4, '[', ']', '…', 12) FROM observations_fts"
+                    f" WHERE observations_fts MATCH ? AND +rowid IN ({','.join('?' for _ in rowids)})",
+                    (match, *rowids),
+                )
+            )
+            rows = [(*row[:5], snippets.get(row[5], ""), *row[6:]) for row in rows]
+        return [SearchHit(*row) for row in rows]
+
+    @timed("trae_mem_db_seconds", op="lookup_entity")
+    def lookup_entity(
+        self,
+        entity: str,
+        kind: Optional[str] = None,
+        project: Optional[str] = None,
+        limit: int = 50,
+    ) -> list[EntityHit]:
+        # 精确点查：走 entities 主键 / (entity, ts) 索引，不经过 FTS。路径可按任意后缀查（d.py、c/d.py）。
+        key = normalize_entity(entity, kind)
+        if not key:
+            return []
+        where = ["e.entity=?"]
+        params: list[Any] = [key]
+        if kind:
+            where.append("e.kind=?")
+            params.append(kind)
+        join = ""
+        if project:
+            join = "JOIN sessions s ON s.id = e.session_id"
+            where.append("s.project_path=?")
+            params.append(project)
+        params.append(limit)
+        cur = self._query(
+            EntityHit,
+            f"""
+            SELECT o.id, o.ts, o.kind, o.tool_name, o.session_id, o.preview, o.repeat_count, e.entity, e.kind
+            FROM entities e
+            JOIN observations o ON o.id = e.observation_id
+            {join}
+            WHERE {" AND ".join(where)}
+            ORDER BY e.ts DESC, e.observation_id DESC
             LIMIT ?
             """,
-            (like, limit),
-        )
-        for r in cur2.fetchall():
-            content = r["content"] or ""
-            snip = content if len(content) <= 120 else content[:119] + "…"
-            hits.append(
-                SearchHit(
-                    id=r["id"],
-                    ts=r["ts"],
-                    kind=r["kind"],
-                    tool_name=r["tool_name"] if r["tool_name"] else None,
-                    session_id=r["session_id"],
-                    snippet=snip,
-                    score=0.0,
+            params,
+        )
+        hits = cur.fetchall()
+        self._note_access(h.id for h in hits)
+        return hits
+
+    @timed("trae_mem_db_seconds", op="recurring_failures")
+    def recurring_failures(
+        self, project: Optional[str] = None, limit: int = 10, min_count: int = 2
+    ) -> list[FailureRecord]:
+        # count / session_count 是全局累计；project 只用来筛选在该项目里出现过的指纹。
+        if project:
+            cur = self._query(
+                FailureRecord,
+                f"""
+                SELECT {_FAILURE_COLS} FROM failures
+                WHERE count >= ? AND fingerprint IN (
+                  SELECT fs.fingerprint FROM failure_sessions fs
+                  JOIN sessions s ON s.id = fs.session_id
+                  WHERE s.project_path=?
                 )
+                ORDER BY last_seen DESC
+                LIMIT ?
+                """,
+                (min_count, project, limit),
             )
-        return hits
+        else:
+            cur = self._query(
+                FailureRecord,
+                f"SELECT {_FAILURE_COLS} FROM failures WHERE count >= ? ORDER BY last_seen DESC LIMIT ?",
+                (min_count, limit),
+            )
+        return cur.fetchall()
 
-    def timeline(self, observation_id: str, window: int = 10) -> list[sqlite3.Row]:
-        cur = self._conn.execute(
-            "SELECT session_id, ts FROM observations WHERE id=?",
-            (observation_id,),
+    def lookup_failure(self, fingerprint: Optional[str] = None, error: Optional[str] = None) -> Optional[FailureRecord]:
+        # 按指纹点查；也可以直接贴一段报错文本，按同样的归一化规则算出指纹再查。
+        if not fingerprint and error:
+            hit = failure_of(error, "error")
+            fingerprint = hit[0] if hit else None
+        if not fingerprint:
+            return None
+        cur = self._query(FailureRecord, f"SELECT {_FAILURE_COLS} FROM failures WHERE fingerprint=?", (fingerprint,))
+        return cur.fetchone()
+
+    def failure_sessions(self, fingerprint: str, limit: int = 20) -> list[FailureSessionRecord]:
+        cur = self._query(
+            FailureSessionRecord,
+            f"""
+            SELECT {_columns_of(FailureSessionRecord)} FROM failure_sessions
+            WHERE fingerprint=?
+            ORDER BY last_seen DESC
+            LIMIT ?
+            """,
+            (fingerprint, limit),
         )
-        row = cur.fetchone()
+        return cur.fetchall()
+
+    def failure_followups(self, fingerprint: str, limit: int = 10) -> list[ObservationRecord]:
+        # "上次怎么修的"：各会话里该失败最后一次出现之后记录的结论 / 笔记。
+        cur = self._query(
+            ObservationRecord,
+            f"""
+            SELECT {_columns_of(ObservationRecord, "o")} FROM failure_sessions fs
+            JOIN observations lo ON lo.id = fs.last_observation_id
+            JOIN observations o ON o.session_id = fs.session_id AND o.seq > lo.seq
+            WHERE fs.fingerprint=? AND o.bucket='decision' AND o.private=0
+            ORDER BY o.ts DESC, o.seq DESC
+            LIMIT ?
+            """,
+            (fingerprint, limit),
+        )
+        return cur.fetchall()
+
+    @timed("trae_mem_db_seconds", op="timeline")
+    def timeline(
+        self,
+        observation_id: str,
+        window: int = 10,
+        limit: int = 200,
+        after_seq: Optional[int] = None,
+        before_seq: Optional[int] = None,
+        tags: Optional[dict[str, str]] = None,
+    ) -> list[ObservationRecord]:
+        # 以锚点为中心、±window 分钟内按 (ts, seq) 排序的一页；首页锚点前后各取约一半。
+        # 向后翻页传 after_seq=本页最后一条 seq，向前翻页传 before_seq=本页第一条 seq。
+        # 选取与排序用同一个键：transcript 补录的行 seq 在末尾、ts 却更早，只按 seq 排会与 ts 窗口错位。
+        row = self._reader().execute(
+            "SELECT session_id, ts, seq FROM observations WHERE id=?",
+            (observation_id,),
+        ).fetchone()
         if not row:
             return []
+        self._note_access([observation_id])
         session_id = row["session_id"]
-        ts = row["ts"]
-        cur2 = self._conn.execute(
+        lo, hi = row["ts"] - window * 60, row["ts"] + window * 60
+        pred, params = _observation_filters("observations", tags=tags)
+
+        def key_of(seq: int) -> tuple[int, int]:
+            found = self._reader().execute(
+                "SELECT ts FROM observations WHERE session_id=? AND seq=?", (session_id, seq)
+            ).fetchone()
+            return (int(found[0]) if found else lo - 1, seq)
+
+        if before_seq is not None:
+            k_ts, k_seq = key_of(int(before_seq))
+            cur = self._query(
+                ObservationRecord,
+                f"""
+                SELECT {_OBS_COLS} FROM observations
+                WHERE session_id=? AND ts BETWEEN ? AND ? AND (ts < ? OR (ts = ? AND seq < ?)){pred}
+                ORDER BY ts DESC, seq DESC
+                LIMIT ?
+                """,
+                (session_id, lo, hi, k_ts, k_ts, k_seq, *params, limit),
+            )
+            return cur.fetchall()[::-1]
+        if after_seq is not None:
+            k_ts, k_seq = key_of(int(after_seq))
+        else:
+            head = self._reader().execute(
+                f"""
+                SELECT ts, seq FROM observations
+                WHERE session_id=? AND ts BETWEEN ? AND ? AND (ts < ? OR (ts = ? AND seq < ?)){pred}
+                ORDER BY ts DESC, seq DESC
+                LIMIT ?
+                """,
+                (session_id, lo, hi, row["ts"], row["ts"], row["seq"], *params, limit // 2),
+            ).fetchall()
+            k_ts, k_seq = (head[-1][0], head[-1][1] - 1) if head else (row["ts"], row["seq"] - 1)
+        cur2 = self._query(
+            ObservationRecord,
+            f"""
+            SELECT {_OBS_COLS} FROM observations
+            WHERE session_id=? AND ts BETWEEN ? AND ? AND (ts > ? OR (ts = ? AND seq > ?)){pred}
+            ORDER BY ts ASC, seq ASC
+            LIMIT ?
+            """,
+            (session_id, lo, hi, k_ts, k_ts, k_seq, *params, limit),
+        )
+        return cur2.fetchall()
+
+    def changes(
+        self, since: int = 0, limit: int = 100, entity: Optional[str] = None, session_id: Optional[str] = None
+    ) -> list[ChangeRecord]:
+        # seq > since 的变更，按 seq 升序；调用方把最后一条的 seq 作为下次的 since。
+        clauses, params = ["seq > ?"], [int(since)]
+        if entity:
+            clauses.append("entity = ?")
+            params.append(entity)
+        if session_id:
+            clauses.append("session_id = ?")
+            params.append(session_id)
+        cur = self._query(
+            ChangeRecord,
+            f"SELECT {_columns_of(ChangeRecord)} FROM changes WHERE {' AND '.join(clauses)} ORDER BY seq LIMIT ?",
+            (*params, limit),
+        )
+        return cur.fetchall()
+
+    def write_generation(self) -> str:
+        # 写入代数：最近一条变更的 (seq, ts)。带上 ts，库被恢复到旧备份后再写入时 seq 重复也不会撞上旧值。
+        row = self._reader().execute("SELECT seq, ts FROM changes ORDER BY seq DESC LIMIT 1").fetchone()
+        return f"{row[0]}-{int(float(row[1]) * 1e6):x}" if row else "0"
+
+    def access_generation(self) -> str:
+        return self.sync_state("access_generation") or "0"
+
+    def latest_change(self) -> int:
+        row = self._reader().execute("SELECT MAX(seq) FROM changes").fetchone()
+        return int(row[0] or 0)
+
+    def wait_changes(
+        self,
+        since: int = 0,
+        timeout: float = 0.0,
+        limit: int = 100,
+        entity: Optional[str] = None,
+        session_id: Optional[str] = None,
+        poll_interval: float = 0.25,
+    ) -> list[ChangeRecord]:
+        # 长轮询：有新变更立即返回，否则最多等 timeout 秒后返回空列表。
+        # 本进程写入提交时直接唤醒；hook 等其他进程的写入最迟 poll_interval 秒后被发现（一次主键范围探测）。
+        deadline = time.monotonic() + max(timeout, 0.0)
+        while True:
+            rows = self.changes(since, limit=limit, entity=entity, session_id=session_id)
+            remaining = deadline - time.monotonic()
+            if rows or remaining <= 0:
+                return rows
+            with self._changes_cond:
+                self._changes_cond.wait(min(poll_interval, remaining))
+
+    def replica_id(self) -> str:
+        row = self._reader().execute("SELECT value FROM sync_state WHERE key='replica_id'").fetchone()
+        if row:
+            return str(row[0])
+        # 首次参与同步时才建 (entity_id, ts) 索引，用来取记录的当前版本做冲突裁决；不同步的库不付这份写入开销。
+        with self._write() as conn:
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_changes_entity ON changes(entity_id, ts)")
+            conn.execute("INSERT OR IGNORE INTO sync_state(key, value) VALUES ('replica_id', ?)", (_new_id(),))
+            return str(conn.execute("SELECT value FROM sync_state WHERE key='replica_id'").fetchone()[0])
+
+    def sync_state(self, key: str) -> Optional[str]:
+        row = self._reader().execute("SELECT value FROM sync_state WHERE key=?", (key,)).fetchone()
+        return None if row is None else str(row[0])
+
+    def set_sync_state(self, key: str, value: str) -> None:
+        with self._write() as conn:
+            conn.execute(
+                "INSERT INTO sync_state(key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value=excluded.value",
+                (key, value),
+            )
+
+    def changed_keys(self, since: int, limit: int = 2000) -> tuple[list[tuple[str, str]], int]:
+        # 按 seq 扫描一段变更日志，返回其中本机写入的 (entity, id)（去重、保持首次出现顺序）与扫到的最大 seq。
+        rows = self._reader().execute(
+            "SELECT seq, entity, entity_id, origin FROM changes WHERE seq > ? ORDER BY seq LIMIT ?",
+            (int(since), limit),
+        ).fetchall()
+        keys: dict[tuple[str, str], None] = {}
+        for r in rows:
+            if r[3] is None:
+                keys.setdefault((str(r[1]), str(r[2])), None)
+        return list(keys), int(rows[-1][0]) if rows else int(since)
+
+    def sync_keys(self, entity: str, after_rowid: int = 0, limit: int = 2000) -> tuple[list[tuple[str, str]], int]:
+        # 全量推送：按 rowid 分批列出某张表的全部记录，用于变更日志之前的存量数据。
+        table, _ = _SYNC_TABLES[entity]
+        extra = " AND private=0" if entity == "observation" else ""
+        rows = self._reader().execute(
+            f"SELECT rowid, id FROM {table} WHERE rowid > ?{extra} ORDER BY rowid LIMIT ?", (after_rowid, limit)
+        ).fetchall()
+        return [(entity, str(r[1])) for r in rows], int(rows[-1][0]) if rows else after_rowid
+
+    def _sync_row(self, conn: sqlite3.Connection, entity: str, entity_id: str) -> Optional[dict[str, Any]]:
+        table, cols = _SYNC_TABLES[entity]
+        extra = " AND private=0" if entity == "observation" else ""
+        row = conn.execute(f"SELECT {', '.join(cols)} FROM {table} WHERE id=?{extra}", (entity_id,)).fetchone()
+        return None if row is None else dict(zip(cols, tuple(row)))
+
+    def _row_version(self, conn: sqlite3.Connection, entity_id: str, replica: str) -> tuple[float, str]:
+        # 当前版本 = 最近一次变更的 (时间, 来源副本)；变更日志之前的存量记录视为最旧。
+        row = conn.execute(
+            "SELECT ts, origin FROM changes WHERE entity_id=? ORDER BY ts DESC LIMIT 1", (entity_id,)
+        ).fetchone()
+        return (float(row[0]), str(row[1] or replica)) if row else (0.0, "")
+
+    def export_sync(self, keys: Iterable[tuple[str, str]]) -> list[dict[str, Any]]:
+        # 每条记录导出当前状态及其版本与内容哈希；观测 / 摘要所属的会话排在前面一并导出，
+        # 保证接收端插入时外键成立（会话没变时对端按哈希跳过）。
+        conn = self._reader()
+        replica = self.replica_id()
+        out: list[dict[str, Any]] = []
+        done: set[tuple[str, str]] = set()
+
+        def add(entity: str, entity_id: str) -> None:
+            if (entity, entity_id) in done:
+                return
+            done.add((entity, entity_id))
+            row = self._sync_row(conn, entity, entity_id)
+            if row is None:
+                return
+            if entity != "session":
+                add("session", row["session_id"])
+            mtime, origin = self._row_version(conn, entity_id, replica)
+            out.append(
+                {"entity": entity, "id": entity_id, "mtime": mtime, "replica": origin, "hash": row_hash(row), "row": row}
+            )
+
+        for entity, entity_id in keys:
+            add(entity, entity_id)
+        return out
+
+    @timed("trae_mem_db_seconds", op="apply_sync")
+    def apply_sync(self, records: Iterable[dict[str, Any]], state_key: str, state_value: str) -> tuple[int, int]:
+        # 一个写事务内应用一个分段并推进该对端的拉取游标，中途失败整体回滚。
+        # 冲突裁决：内容哈希相同直接跳过；否则 (修改时间, 副本 id) 较大的一方胜出，与应用顺序无关。
+        replica = self.replica_id()
+        applied = skipped = 0
+        with self._write() as conn:
+            for rec in records:
+                entity, row = str(rec["entity"]), rec["row"]
+                table, _ = _SYNC_TABLES[entity]
+                existing = conn.execute(f"SELECT 1 FROM {table} WHERE id=?", (row["id"],)).fetchone()
+                if existing is not None:
+                    local = self._sync_row(conn, entity, row["id"])
+                    if local is None or row_hash(local) == rec["hash"]:
+                        skipped += 1
+                        continue
+                    if (float(rec["mtime"]), str(rec["replica"])) <= self._row_version(conn, row["id"], replica):
+                        inc("trae_mem_sync_conflicts_total", winner="local")
+                        skipped += 1
+                        continue
+                    inc("trae_mem_sync_conflicts_total", winner="remote")
+                self._sync_origin = (str(rec["replica"]), float(rec["mtime"]))
+                try:
+                    if entity == "observation":
+                        self._apply_synced_observation(conn, row, existing is not None)
+                    else:
+                        self._apply_synced_row(conn, entity, row, existing is not None)
+                finally:
+                    self._sync_origin = None
+                applied += 1
+            conn.execute(
+                "INSERT INTO sync_state(key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value=excluded.value",
+                (state_key, state_value),
+            )
+        return applied, skipped
+
+    def _apply_synced_row(self, conn: sqlite3.Connection, entity: str, row: dict[str, Any], existing: bool) -> None:
+        table, cols = _SYNC_TABLES[entity]
+        conn.execute(
+            f"""
+            INSERT INTO {table}({", ".join(cols)}) VALUES ({", ".join("?" for _ in cols)})
+            ON CONFLICT(id) DO UPDATE SET {", ".join(f"{c}=excluded.{c}" for c in cols[1:])}
+            """,
+            tuple(row[c] for c in cols),
+        )
+        session_id = row["id"] if entity == "session" else row["session_id"]
+        self._log_change(conn, "update" if existing else "insert", entity, row["id"], session_id)
+
+    def _apply_synced_observation(self, conn: sqlite3.Connection, row: dict[str, Any], existing: bool) -> None:
+        # 与本地写入走同一套派生索引（FTS、标签、实体、失败聚合、LSH 分段），只是 id / seq / 折叠关系沿用来源。
+        obs_id, session_id, kind = row["id"], row["session_id"], row["kind"]
+        try:
+            tags = json.loads(row["tags_json"] or "{}")
+        except ValueError:
+            tags = {}
+        pending = tags.get("status") == "pending"
+        bucket = kind_bucket(kind)
+        canonical = row["canonical_id"]
+        if canonical and not conn.execute("SELECT 1 FROM observations WHERE id=?", (canonical,)).fetchone():
+            canonical = None
+        if existing:
+            old = conn.execute("SELECT tags_json FROM observations WHERE id=?", (obs_id,)).fetchone()
+            was_pending = json.loads(old["tags_json"] or "{}").get("status") == "pending"
+            self._update_observation(conn, obs_id, row["content"], tags)
+            conn.execute(
+                "UPDATE observations SET simhash=?, canonical_id=?, repeat_count=? WHERE id=?",
+                (row["simhash"], canonical, row["repeat_count"], obs_id),
+            )
+            self._reindex_entities(conn, obs_id)
+            if was_pending and not pending and bucket in FAILURE_BUCKETS:
+                self._record_failure(conn, obs_id, session_id, row["ts"], bucket, row["content"])
+            return
+        cur = conn.execute(
+            "INSERT INTO observations_fts(id, session_id, kind, tool_name, content) VALUES (?, ?, ?, ?, ?)",
+            (obs_id, session_id, kind, row["tool_name"] or "", row["content"]),
+        )
+        fts_rowid = cur.lastrowid
+        # 会话内 seq 沿用来源；本机已往同一会话写过同号记录时退回追加到末尾。
+        seq = row["seq"]
+        if seq is None or conn.execute(
+            "SELECT 1 FROM observations WHERE session_id=? AND seq=?", (session_id, seq)
+        ).fetchone():
+            seq = conn.execute(
+                "SELECT COALESCE(MAX(seq), 0) + 1 FROM observations WHERE session_id=?", (session_id,)
+            ).fetchone()[0]
+        conn.execute(
             """
-            SELECT * FROM observations
-            WHERE session_id=?
-              AND ts BETWEEN ? AND ?
-            ORDER BY ts ASC
+            INSERT INTO observations(
+              id, session_id, ts, kind, tool_name, content, private, tags_json, fts_rowid, preview, bucket,
+              simhash, canonical_id, repeat_count, seq
+            )
+            VALUES (?, ?, ?, ?, ?, ?, 0, ?, ?, ?, ?, ?, ?, ?, ?)
             """,
-            (session_id, ts - window * 60, ts + window * 60),
+            (
+                obs_id,
+                session_id,
+                row["ts"],
+                kind,
+                row["tool_name"],
+                row["content"],
+                row["tags_json"],
+                fts_rowid,
+                one_line_preview(row["content"]),
+                bucket,
+                row["simhash"],
+                canonical,
+                row["repeat_count"] or 1,
+                seq,
+            ),
         )
-        return list(cur2.fetchall())
+        self._log_change(conn, "insert", "observation", obs_id, session_id)
+        if canonical is None and row["simhash"] is not None:
+            self._add_lsh_buckets(conn, session_id, obs_id, int(row["simhash"]))
+        if tags:
+            self._index_tags(conn, obs_id, tags)
+        if canonical is None and bucket in ENTITY_BUCKETS:
+            self._index_entities(conn, obs_id, session_id, row["ts"], row["content"])
+        if not pending and bucket in FAILURE_BUCKETS:
+            self._record_failure(conn, obs_id, session_id, row["ts"], bucket, row["content"])
@@ -0,0 +1,97 @@
+import os
+import re
+from itertools import repeat
+from typing import Any, Iterable, Optional, TypeVar
+
+# 近重复检测：64 位 SimHash（相邻三词为特征，按出现次数加权）+ 4×16 位分段 LSH。
+# 汉明距离 ≤ 3 的两条记录至少有一段完全相同（鸽巢原理），因此按分段桶取候选不会漏召回。
+BITS = 64
+BANDS = 4
+BAND_BITS = BITS // BANDS
+MAX_DISTANCE = 3
+# 只对工具输出与报错去重；用户输入、笔记与决策是有意为之的记录，保持原样。
+DEDUP_BUCKETS = ("tool", "error")
+
+_MAX_CHARS = 4000
+_TOKEN_RE = re.compile(r"[a-z_]+|\d+|[^\sa-z_\d]")
+_MASK = (1 << BITS) - 1
+# _BIT[i] 把字节映射为其第 i 位（0/1），配合 bytes.translate().count() 在 C 层统计逐位计数。
+_BIT = [bytes((b >> i) & 1 for b in range(256)) for i in range(8)]
+
+_T = TypeVar("_T")
+
+
+def dedup_enabled_from_env() -> bool:
+    return (os.environ.get("TRAE_MEM_DEDUP") or "1").strip().lower() not in ("0", "false", "off", "no")
+
+
+def _rotl(h: int, r: int) -> int:
+    return ((h << r) | (h >> (BITS - r))) & _MASK
+
+
+def _features(text: str) -> list[int]:
+    import hashlib
+
+    if len(text) > _MAX_CHARS:
+        text = text[: _MAX_CHARS // 2] + text[-_MAX_CHARS // 2 :]
+    tokens = _TOKEN_RE.findall(text.lower())
+    # 词只哈希一次；数字统一成 "0"，行号、耗时、时间戳不同的重复输出仍算近重复。
+    hashed = {
+        t: int.from_bytes(
+            hashlib.blake2b(("0" if t[0].isdigit() else t).encode("utf-8"), digest_size=8).digest(), "little"
+        )
+        for t in set(tokens)
+    }
+    h0 = list(map(hashed.__getitem__, tokens))
+    if len(h0) < 3:
+        return [sum(h0) & _MASK]
+    # 特征为相邻三词：rotl(h[i], 2) ^ rotl(h[i+1], 1) ^ h[i+2]，保留顺序信息；全程 map 在 C 层完成。
+    rot1 = {h: _rotl(h, 1) for h in hashed.values()}
+    rot2 = {h: _rotl(h, 2) for h in hashed.values()}
+    h1 = map(rot1.__getitem__, h0[1:])
+    h2 = map(rot2.__getitem__, h0)
+    return list(map(int.__xor__, map(int.__xor__, h2, h1), h0[2:]))
+
+
+def simhash(text: str) -> int:
+    feats = _features(text)
+    raw = b"".join(map(int.to_bytes, feats, repeat(8), repeat("little")))
+    half = len(feats) / 2
+    out = 0
+    for j in range(8):
+        col = raw[j::8]
+        for i in range(8):
+            if col.translate(_BIT[i]).count(1) > half:
+                out |= 1 << (8 * j + i)
+    return out
+
+
+def to_signed(h: int) -> int:
+    # SQLite INTEGER 是有符号 64 位。
+    return h - (1 << BITS) if h >= 1 << (BITS - 1) else h
+
+
+def distance(a: int, b: int) -> int:
+    return bin((a ^ b) & _MASK).count("1")
+
+
+def band_keys(h: int) -> list[int]:
+    mask = (1 << BAND_BITS) - 1
+    h &= _MASK
+    return [(i << BAND_BITS) | ((h >> (i * BAND_BITS)) & mask) for i in range(BANDS)]
+
+
+def collapse_repeats(rows: Iterable[_T]) -> list[_T]:
+    # 页内折叠：同一 canonical 的近重复只保留首次出现的一条，repeat_count 改为页内出现次数。
+    out: list[Any] = []
+    seen: dict[str, Any] = {}
+    for r in rows:
+        key: Optional[str] = getattr(r, "canonical_id", None) or getattr(r, "id")
+        first = seen.get(key)
+        if first is not None:
+            first.repeat_count += 1
+            continue
+        r.repeat_count = 1
+        seen[key] = r
+        out.append(r)
+    return out
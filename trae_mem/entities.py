@@ -0,0 +1,155 @@
+import json
+import re
+from typing import Optional
+
+# 从工具输入/输出中抽取实体，写入 entities(entity, kind) -> observation 倒排索引。
+# kind: file / symbol / command / url。全部基于正则，入库路径上不做任何解析器级别的工作。
+ENTITY_KINDS = ("file", "symbol", "command", "url")
+# 只索引工具调用与报错；用户输入和笔记里的"实体"多是随口提及，噪声大于价值。
+ENTITY_BUCKETS = ("tool", "error")
+MAX_PER_OBSERVATION = 64
+_MAX_CHARS = 12000
+
+_FILE_EXTS = frozenset(
+    """
+    py pyi kt kts java scala groovy gradle ts tsx js jsx mjs cjs vue svelte go rs c h cc cpp cxx hpp hh m mm swift
+    rb php cs fs lua dart r sh bash zsh fish ps1 bat sql proto thrift graphql md rst txt json jsonl yaml yml toml ini
+    cfg conf env xml html htm css scss less lock properties pro mk cmake dockerfile sqlite sqlite3 db log csv ipynb
+    """.split()
+)
+_JSON_STR_KEYS = {
+    "command": "command",
+    "cmd": "command",
+    "file_path": "file",
+    "path": "file",
+    "notebook_path": "file",
+    "url": "url",
+}
+
+_ESCAPE_RE = re.compile(r"\\[nrt\"\\/]")
+_JSON_KEY_RE = re.compile(r'"[A-Za-z_][\w-]*"\s*:')
+_JSON_STR_RE = re.compile(r'"(command|cmd|file_path|path|notebook_path|url)"\s*:\s*"((?:[^"\\]|\\.)*)"')
+_URL_RE = re.compile(r"\bhttps?://[^\s\"'<>()\[\]{}\\]+")
+# 候选路径：含 "/" 或 "." 的连续路径字符块，起点锚定在块首（线性扫描，无回溯）；是否像路径交给 _norm_path 判定。
+_PATH_RE = re.compile(r"(?<![\w./~-])[\w~.-]*[./][\w./~-]*")
+_LINE_SUFFIX_RE = re.compile(r"(?::\d+)+$")
+_DEF_RE = re.compile(r"\b(?:def|class|fun|function|func|interface|struct|enum|object|trait)\s+([A-Za-z_]\w{2,})")
+_SYMBOL_RE = re.compile(
+    r"\b[A-Z][A-Za-z0-9]*\.[a-z_][A-Za-z0-9_]{2,}\b"  # Class.member
+    r"|\b[A-Z][a-z0-9]+(?:[A-Z][a-z0-9]*)+\b"  # CamelCase
+    r"|\b[a-z][a-z0-9]*(?:[A-Z][a-z0-9]+)+\b"  # lowerCamel
+    r"|\b[a-z][a-z0-9]*(?:_[a-z0-9]+)+\b"  # snake_case
+)
+_CMD_SPLIT_RE = re.compile(r"\s*(?:&&|\|\||;|\|)\s*")
+_ENV_ASSIGN_RE = re.compile(r"^[A-Za-z_]\w*=")
+_SUBCOMMAND_RE = re.compile(r"^[a-z][\w-]*$")
+
+
+def _norm_path(p: str) -> Optional[str]:
+    p = _LINE_SUFFIX_RE.sub("", p.strip().rstrip(".,;:"))
+    while p.startswith("./"):
+        p = p[2:]
+    if not p or p.endswith("/") or "//" in p:
+        return None
+    base = p.rsplit("/", 1)[-1]
+    ext = base.rsplit(".", 1)[-1].lower() if "." in base else ""
+    if "/" not in p and ext not in _FILE_EXTS:
+        return None
+    if "/" in p and "." not in base and p.count("/") < 2:
+        return None
+    return p
+
+
+def path_keys(path: str) -> list[str]:
+    # 完整路径 + 末尾最多 3 段后缀（b/c/d.py、c/d.py、d.py），按任意后缀查询都是点查。
+    parts = [x for x in path.split("/") if x]
+    keys = [path]
+    # 没有扩展名的单段（多半是目录名，如 player、bin）太泛，不单独入索引。
+    last = 1 if "." in parts[-1] else 2
+    for n in range(min(3, len(parts)), last - 1, -1):
+        suffix = "/".join(parts[-n:])
+        if suffix not in keys:
+            keys.append(suffix)
+    return keys
+
+
+def _command_keys(command: str) -> list[str]:
+    out: list[str] = []
+    for segment in _CMD_SPLIT_RE.split(command)[:5]:
+        tokens = [t for t in segment.split() if not _ENV_ASSIGN_RE.match(t)]
+        if not tokens:
+            continue
+        full = " ".join(tokens)[:200]
+        head = tokens[0].rsplit("/", 1)[-1]
+        if len(tokens) > 2 and tokens[1] == "-m":
+            head = f"{head} -m {tokens[2]}"
+        elif len(tokens) > 1 and _SUBCOMMAND_RE.match(tokens[1]):
+            head = f"{head} {tokens[1]}"
+        for key in (full, head):
+            if key not in out:
+                out.append(key)
+    return out
+
+
+def _unescape(raw: str) -> str:
+    try:
+        return str(json.loads(f'"{raw}"'))
+    except ValueError:
+        return raw
+
+
+def normalize_entity(entity: str, kind: Optional[str] = None) -> str:
+    e = " ".join(entity.split())
+    if kind in (None, "file") and ("/" in e or "." in e):
+        p = _norm_path(e)
+        if p:
+            return p
+    return e
+
+
+def extract_entities(content: str) -> list[tuple[str, str]]:
+    text = content[:_MAX_CHARS]
+    found: dict[tuple[str, str], None] = {}
+
+    def add(entity: str, kind: str) -> None:
+        if entity and len(entity) <= 300 and len(found) < MAX_PER_OBSERVATION:
+            found.setdefault((entity, kind), None)
+
+    # 结构化字段（command / file_path / url）最可靠，先收。
+    for key, raw in _JSON_STR_RE.findall(text):
+        value = _unescape(raw)
+        kind = _JSON_STR_KEYS[key]
+        if kind == "command":
+            for c in _command_keys(value):
+                add(c, "command")
+        elif kind == "file":
+            p = _norm_path(value)
+            for k in path_keys(p) if p else ():
+                add(k, "file")
+        else:
+            add(value, "url")
+
+    plain = _JSON_KEY_RE.sub(" ", _ESCAPE_RE.sub(" ", text))
+    for url in _URL_RE.findall(plain):
+        add(url.rstrip(".,;:"), "url")
+    plain = _URL_RE.sub(" ", plain)
+
+    def take_path(m: "re.Match[str]") -> str:
+        p = _norm_path(m.group(0))
+        if not p:
+            return m.group(0)
+        for k in path_keys(p):
+            add(k, "file")
+        return " "
+
+    plain = _PATH_RE.sub(take_path, plain)
+    for name in _DEF_RE.findall(plain):
+        add(name, "symbol")
+    for name in _SYMBOL_RE.findall(plain):
+        add(name, "symbol")
+        if "." in name:
+            # Class.member 同时按类名与成员名入索引。
+            owner, _, member = name.partition(".")
+            add(owner, "symbol")
+            add(member, "symbol")
+    return list(found)
@@ -0,0 +1,97 @@
+import re
+from typing import Optional
+
+# 错误指纹：把报错 / 带栈的工具输出归一化（去掉行号、地址、目录、时间戳、各类 id 与数字）后哈希，
+# 同一种失败在不同行号、不同机器路径、不同时间出现时得到同一个指纹，入库时增量聚合到 failures 表。
+FAILURE_BUCKETS = ("tool", "error")
+_MAX_CHARS = 8000
+_MAX_FRAMES = 5
+_TITLE_CHARS = 240
+
+# 工具输出里只认行首的结构化标记，避免把源码里出现的 "ValueError" 之类当成失败。
+_MARKER_RE = re.compile(
+    r"^\s*(?:Traceback \(most recent call last\)"
+    r"|(?:[\w$]+\.)*\w*(?:Error|Exception|Failure)\b[:\s]"
+    r"|FAILED\b|ERROR\b|FATAL\b|panic:|fatal:|error(?:\[\w+\])?:|[EF]/\w+)",
+    re.M,
+)
+_TITLE_RE = re.compile(
+    r"^\s*(?:(?:[\w$]+\.)*\w*(?:Error|Exception|Failure)\b.*"
+    r"|FAILED\b.*|FATAL\b.*|panic:.*|fatal:.*|error(?:\[\w+\])?:.*|[EF]/\w+.*)$"
+)
+_FRAME_RE = re.compile(r'^\s*(?:File "[^"]*", line \d+, in (\S+)|at ([\w$.<>]+)\s*\()')
+_JSON_PREFIX_RE = re.compile(r'^\s*\{?\s*"\w+"\s*:\s*"')
+_JSON_SUFFIX_RE = re.compile(r'"\s*(?:,\s*"\w+"\s*:.*|\}+)\s*$')
+
+_TS_RE = re.compile(r"\b\d{4}-\d{2}-\d{2}(?:[T ]\d{2}:\d{2}(?::\d{2})?(?:[.,]\d+)?(?:Z|[+-]\d{2}:?\d{2})?)?\b|\b\d{2}:\d{2}:\d{2}(?:[.,]\d+)?\b")
+_UUID_RE = re.compile(r"\b[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}\b")
+_HEX_RE = re.compile(r"\b0x[0-9a-fA-F]+\b|\b(?=[0-9a-fA-F]*\d)(?=[0-9a-fA-F]*[a-fA-F])[0-9a-fA-F]{8,}\b")
+_DIR_RE = re.compile(r"(?:[\w.~-]*[/\\])+(?=[\w-]+\.\w+)")
+_LINE_NO_RE = re.compile(r"(\.\w+):\d+(?::\d+)?|\bline \d+")
+# 只替换独立数字；sqlite3、utf8、fts5 这类标识符里的数字保留。
+_NUM_RE = re.compile(r"(?<![A-Za-z])\d+")
+_SPACE_RE = re.compile(r"\s+")
+
+
+def normalize_line(line: str) -> str:
+    s = _TS_RE.sub("<ts>", line)
+    s = _UUID_RE.sub("<id>", s)
+    s = _HEX_RE.sub("<hex>", s)
+    s = _DIR_RE.sub("", s)
+    s = _LINE_NO_RE.sub(lambda m: m.group(1) or "line", s)
+    s = _NUM_RE.sub("N", s)
+    return _SPACE_RE.sub(" ", s).strip()[:_TITLE_CHARS]
+
+
+def _output_lines(content: str, bucket: str) -> list[str]:
+    text = content[:_MAX_CHARS]
+    if bucket == "tool":
+        # 只看输出部分；输入里的 grep 关键字、文件内容不算失败。输出通常是 JSON，先还原转义的换行与引号。
+        _, sep, out = text.partition("输出=")
+        if not sep:
+            return []
+        text = out.replace("\\n", "\n").replace('\\"', '"').replace("\\t", " ")
+        return [_JSON_SUFFIX_RE.sub("", _JSON_PREFIX_RE.sub("", ln)) for ln in text.splitlines() if ln.strip()]
+    return [ln for ln in text.splitlines() if ln.strip()]
+
+
+def failure_signature(content: str, bucket: str) -> Optional[tuple[str, str]]:
+    # 返回 (标题, 归一化签名)；不像失败的内容返回 None。
+    # 标题取第一行异常 / 失败行（Python 栈的 Traceback 头不算），签名 = 标题 + 前几个栈帧的函数名。
+    lines = _output_lines(content, bucket)
+    if not lines:
+        return None
+    if bucket == "tool" and not _MARKER_RE.search("\n".join(lines)):
+        return None
+    title = None
+    frames: list[str] = []
+    for ln in lines:
+        m = _FRAME_RE.match(ln)
+        if m:
+            if len(frames) < _MAX_FRAMES:
+                frames.append(m.group(1) or m.group(2))
+            continue
+        if title is None and _TITLE_RE.match(ln):
+            title = ln
+    if title is None:
+        if bucket == "tool":
+            return None
+        title = lines[0]
+    title = normalize_line(title)
+    if not title:
+        return None
+    return title, "\n".join([title, *frames])
+
+
+def fingerprint(signature: str) -> str:
+    import hashlib
+
+    return hashlib.blake2b(signature.encode("utf-8"), digest_size=12).hexdigest()
+
+
+def failure_of(content: str, bucket: str) -> Optional[tuple[str, str]]:
+    # (指纹, 标题)
+    sig = failure_signature(content, bucket)
+    if sig is None:
+        return None
+    return fingerprint(sig[1]), sig[0]
@@ -0,0 +1,102 @@
+import re
+from typing import Optional
+
+# 用户输入 -> FTS5 MATCH 表达式。
+# 简单模式语法："短语"、前缀*、OR（或 |）分隔的多组；组内各词为 AND。
+# 其余字符（: - ( ) 路径、NEAR 等）一律按字面量加引号，不会触发 FTS5 语法错误。
+_TOKEN_RE = re.compile(r'"([^"]*)"?|(\S+)')
+_WORD_RE = re.compile(r"\w")
+_TRIGRAM_MIN = 3
+
+
+class Term:
+    __slots__ = ("text", "prefix", "phrase")
+
+    def __init__(self, text: str, prefix: bool = False, phrase: bool = False) -> None:
+        self.text = text
+        self.prefix = prefix
+        self.phrase = phrase
+
+
+class FtsQuery:
+    __slots__ = ("match", "groups", "exact")
+
+    def __init__(self, match: Optional[str], groups: list[list[Term]], exact: bool) -> None:
+        # match 为 None 表示没有可走索引的词（如 trigram 下全是不足 3 字符的词），只能 LIKE。
+        # exact 为 False 表示 match 只是候选集，还需用 like_sql() 做一次精确过滤。
+        self.match = match
+        self.groups = groups
+        self.exact = exact
+
+    def like_sql(self, column: str) -> tuple[str, list[str]]:
+        parts: list[str] = []
+        params: list[str] = []
+        for group in self.groups:
+            conds = []
+            for t in group:
+                conds.append(f"{column} LIKE ? ESCAPE '\\'")
+                params.append("%" + like_escape(t.text) + "%")
+            parts.append("(" + " AND ".join(conds) + ")")
+        return "(" + " OR ".join(parts) + ")", params
+
+
+def like_escape(s: str) -> str:
+    return s.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def _quote(s: str) -> str:
+    return '"' + s.replace('"', '""') + '"'
+
+
+def parse(text: str) -> list[list[Term]]:
+    groups: list[list[Term]] = [[]]
+    for m in _TOKEN_RE.finditer(text):
+        phrase, word = m.group(1), m.group(2)
+        if phrase is not None:
+            phrase = " ".join(phrase.split())
+            if phrase:
+                groups[-1].append(Term(phrase, phrase=True))
+            continue
+        if word in ("OR", "|"):
+            if groups[-1]:
+                groups.append([])
+            continue
+        prefix = len(word) > 1 and word.endswith("*")
+        if prefix:
+            word = word.rstrip("*")
+        groups[-1].append(Term(word, prefix=prefix))
+    return [g for g in groups if g]
+
+
+def _indexable(term: Term, tokenizer: str) -> bool:
+    if tokenizer == "trigram":
+        return len(term.text) >= _TRIGRAM_MIN
+    return bool(_WORD_RE.search(term.text))
+
+
+def _fts_term(term: Term, tokenizer: str) -> str:
+    # trigram 本身就是子串匹配，前缀查询是多余的（且短于 3 字符的前缀无法命中），直接去掉 *。
+    if term.prefix and tokenizer != "trigram":
+        return _quote(term.text) + "*"
+    return _quote(term.text)
+
+
+def compile_query(text: str, tokenizer: str = "trigram") -> FtsQuery:
+    groups = parse(text)
+    exact = True
+    compiled: list[str] = []
+    for group in groups:
+        terms = [t for t in group if _indexable(t, tokenizer)]
+        if len(terms) != len(group):
+            exact = False
+        if not terms:
+            # OR 中任何一组无法走索引，整条查询都只能 LIKE。
+            return FtsQuery(None, groups, False)
+        compiled.append(" ".join(_fts_term(t, tokenizer) for t in terms))
+    if not compiled:
+        return FtsQuery(None, groups, False)
+    if len(compiled) == 1:
+        match = compiled[0]
+    else:
+        match = " OR ".join(f"({c})" for c in compiled)
+    return FtsQuery(match, groups, exact)
@@ -4,8 +4,10 @@ import sys
 from pathlib import Path
 from typing import Any, Optional
 
-from .compress import ObservationLike, summarize_session, contains_private, remove_private
+from .compress import bounded_json, redact_for_ingest, summarize_session_levels
 from .db import TraeMemDB
+from .metrics import inc, timer
+from .profiling import profiled
 
 
 def _default_map_path() -> Path:
@@ -18,21 +20,20 @@ def _default_map_path() -> Path:
     return Path.cwd() / ".trae-mem" / "session_map.json"
 
 
-_MAP_PATH = _default_map_path()
-
-
 def _load_map() -> dict[str, Any]:
-    if _MAP_PATH.exists():
+    path = _default_map_path()
+    if path.exists():
         try:
-            return json.loads(_MAP_PATH.read_text(encoding="utf-8"))
+            return json.loads(path.read_text(encoding="utf-8"))
         except Exception:
             return {}
     return {}
 
 
 def _save_map(data: dict[str, Any]) -> None:
-    _MAP_PATH.parent.mkdir(parents=True, exist_ok=True)
-    _MAP_PATH.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
+    path = _default_map_path()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
 
 
 def _ensure_session(db: TraeMemDB, trae_session_id: str, project_path: Optional[str], meta: Optional[dict[str, Any]] = None) -> str:
@@ -74,31 +75,12 @@ def _truncate(s: str, n: int) -> str:
     return s[: max(0, n - 1)] + "…"
 
 
-def _norm_text_for_log(text: str) -> tuple[str, bool]:
-    if contains_private(text):
-        cleaned = remove_private(text)
-        if cleaned:
-            return cleaned, False
-        return "[PRIVATE]", True
-    return text, False
-
-
 def _summarize_session(db: TraeMemDB, session_id: str) -> None:
-    rows = db.get_observations_by_session(session_id, limit=5000)
-    obs = [
-        ObservationLike(
-            ts=int(r["ts"]),
-            kind=str(r["kind"]),
-            tool_name=str(r["tool_name"]) if r["tool_name"] else None,
-            content=str(r["content"]),
-        )
-        for r in rows
-        if int(r["private"]) == 0
-    ]
-    brief = summarize_session(obs, max_chars=900)
-    detailed = summarize_session(obs, max_chars=3200)
-    db.add_summary(session_id=session_id, level="brief", content=brief)
-    db.add_summary(session_id=session_id, level="detailed", content=detailed)
+    summaries = summarize_session_levels(
+        db.iter_session_observations(session_id), {"brief": 900, "detailed": 3200}
+    )
+    for level, content in summaries.items():
+        db.add_summary(session_id=session_id, level=level, content=content)
 
 
 def handle_session_start(payload: dict[str, Any]) -> int:
@@ -117,7 +99,7 @@ def handle_user_prompt_submit(payload: dict[str, Any]) -> int:
     trae_session_id = str(payload.get("session_id") or "")
     cwd = str(payload.get("cwd") or "")
     prompt = str(payload.get("prompt") or "")
-    text, private = _norm_text_for_log(prompt.strip())
+    text, private = redact_for_ingest(prompt.strip())
     db = TraeMemDB()
     try:
         db.init_schema()
@@ -127,17 +109,35 @@ def handle_user_prompt_submit(payload: dict[str, Any]) -> int:
     finally:
         db.close()
 
+def _tool_call_timeout() -> float:
+    try:
+        return float(os.environ.get("TRAE_MEM_TOOL_CALL_TIMEOUT") or 1800)
+    except ValueError:
+        return 1800.0
+
+
+def _tool_call_key(payload: dict[str, Any], sid: str, tool_name: str, input_sha1: str) -> str:
+    tool_use_id = payload.get("tool_use_id") or payload.get("tool_call_id")
+    if tool_use_id:
+        return f"id:{tool_use_id}"
+    import hashlib
+
+    return "h:" + hashlib.sha1(f"{sid}\0{tool_name}\0{input_sha1}".encode("utf-8")).hexdigest()
+
+
 def handle_pre_tool_use(payload: dict[str, Any]) -> int:
     trae_session_id = str(payload.get("session_id") or "")
     cwd = str(payload.get("cwd") or "")
     tool_name = str(payload.get("tool_name") or "")
-    tool_input = json.dumps(payload.get("tool_input") or {}, ensure_ascii=False)
-    txt = _truncate(f"准备执行 {tool_name} 输入={tool_input}", 1800)
+    text_in, in_meta = bounded_json(payload.get("tool_input") or {}, 2000)
+    txt = f"输入={text_in}\n输出=（执行中）"
     db = TraeMemDB()
     try:
         db.init_schema()
+        db.expire_tool_calls(_tool_call_timeout())
         sid = _ensure_session(db, trae_session_id, cwd or None, meta=None)
-        db.add_observation(session_id=sid, kind="note", tool_name=tool_name, content=txt)
+        key = _tool_call_key(payload, sid, tool_name, in_meta["sha1"])
+        db.open_tool_call(sid, key, tool_name=tool_name, content=txt, tags={"input": in_meta})
         return 0
     finally:
         db.close()
@@ -146,16 +146,17 @@ def handle_post_tool_use(payload: dict[str, Any]) -> int:
     trae_session_id = str(payload.get("session_id") or "")
     cwd = str(payload.get("cwd") or "")
     tool_name = str(payload.get("tool_name") or "")
-    tool_input = payload.get("tool_input")
-    tool_resp = payload.get("tool_response")
-    text_in = _truncate(json.dumps(tool_input, ensure_ascii=False), 2000)
-    text_out = _truncate(json.dumps(tool_resp, ensure_ascii=False), 4000)
+    text_in, in_meta = bounded_json(payload.get("tool_input") or {}, 2000)
+    text_out, out_meta = bounded_json(payload.get("tool_response"), 4000)
     txt = f"输入={text_in}\n输出={text_out}"
+    tags = {"input": in_meta, "output": out_meta}
     db = TraeMemDB()
     try:
         db.init_schema()
         sid = _ensure_session(db, trae_session_id, cwd or None, meta=None)
-        db.add_observation(session_id=sid, kind="tool", tool_name=tool_name, content=txt)
+        key = _tool_call_key(payload, sid, tool_name, in_meta["sha1"])
+        if db.complete_tool_call(key, content=txt, tags=tags) is None:
+            db.add_observation(session_id=sid, kind="tool", tool_name=tool_name, content=txt, tags=tags)
         return 0
     finally:
         db.close()
@@ -174,6 +175,18 @@ def handle_stop(payload: dict[str, Any]) -> int:
     finally:
         db.close()
 
+def _ingest_transcript(db: TraeMemDB, session_id: str, transcript_path: str) -> None:
+    # 在摘要之前补录 hook 漏掉的事件；transcript 读不了或格式不对不影响结束流程。
+    from .transcript import ingest_transcript, transcript_enabled_from_env
+
+    if not transcript_enabled_from_env():
+        return
+    try:
+        ingest_transcript(db, session_id, transcript_path)
+    except (OSError, ValueError) as e:
+        inc("trae_mem_transcript_errors_total", error=type(e).__name__)
+
+
 def handle_session_end(payload: dict[str, Any]) -> int:
     trae_session_id = str(payload.get("session_id") or "")
     cwd = str(payload.get("cwd") or "")
@@ -185,6 +198,8 @@ def handle_session_end(payload: dict[str, Any]) -> int:
         sid = _lookup_session(db, trae_session_id, cwd or None)
         if not sid:
             sid = _ensure_session(db, trae_session_id, cwd or None, meta=None)
+        if transcript_path:
+            _ingest_transcript(db, sid, transcript_path)
         db.add_observation(session_id=sid, kind="note", content=_truncate(f"结束，原因={reason} transcript={transcript_path}", 1200))
         db.end_session(sid)
         _summarize_session(db, sid)
@@ -203,14 +218,28 @@ _HANDLERS = {
 }
 
 
+def _parse_event(argv: list[str]) -> Optional[str]:
+    if len(argv) == 2 and argv[0] == "--event":
+        return argv[1]
+    if len(argv) == 1 and argv[0].startswith("--event="):
+        return argv[0].split("=", 1)[1]
+    return None
+
+
 def main(argv: Optional[list[str]] = None) -> int:
-    import argparse
-    p = argparse.ArgumentParser()
-    p.add_argument("--event", required=True, choices=list(_HANDLERS.keys()))
-    args = p.parse_args(argv)
+    args = sys.argv[1:] if argv is None else argv
+    event = _parse_event(args)
+    if event not in _HANDLERS:
+        # 快路径只认 `--event X`；其它情况交给 argparse 输出标准的用法/错误信息。
+        import argparse
+
+        p = argparse.ArgumentParser()
+        p.add_argument("--event", required=True, choices=list(_HANDLERS.keys()))
+        event = p.parse_args(args).event
     payload = _read_stdin_json()
-    fn = _HANDLERS[args.event]
-    return int(fn(payload))
+    fn = _HANDLERS[event]
+    with profiled(f"hook-{event}"), timer("trae_mem_hook_seconds", event=event):
+        return int(fn(payload))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,60 @@
+from typing import Optional
+
+from .db import TraeMemDB
+from .metrics import timed
+
+
+@timed("trae_mem_inject_seconds")
+def build_injection_block(
+    db: TraeMemDB, query: str, limit: int = 12, project_path: Optional[str] = None, now: Optional[float] = None
+) -> str:
+    hits = db.search(query, limit=limit, project=project_path, now=now) if query.strip() else []
+    ids = [h.id for h in hits]
+    obs_rows = db.get_observations(ids)
+    sessions = db.get_recent_sessions(project_path=project_path, limit=5)
+
+    lines: list[str] = []
+    lines.append("【trae-mem 注入上下文】")
+
+    if query.strip():
+        lines.append(f"查询：{query.strip()}")
+
+    if sessions:
+        lines.append("")
+        lines.append("最近会话：")
+        for s in sessions[:5]:
+            lines.append(f"- session={s.id} started_at={s.started_at} ended_at={s.ended_at}")
+            summary = db.get_latest_summary(session_id=s.id, level="brief")
+            if summary and summary.content:
+                content = summary.content.strip()
+                if len(content) > 800:
+                    content = content[:799] + "…"
+                lines.append(f"  摘要：{content}")
+
+    recurring = db.recurring_failures(project=project_path, limit=5)
+    if recurring:
+        lines.append("")
+        lines.append("反复出现的错误：")
+        for f in recurring:
+            lines.append(f"- [×{f.count}，{f.session_count} 个会话] {f.title} (fingerprint={f.fingerprint})")
+
+    if hits:
+        lines.append("")
+        lines.append("相关观测（索引级）：")
+        for h in hits:
+            tn = f"/{h.tool_name}" if h.tool_name else ""
+            rep = f" (×{h.repeat_count})" if h.repeat_count > 1 else ""
+            lines.append(f"- {h.id} [{h.kind}{tn}]{rep} {h.snippet}")
+
+    if obs_rows:
+        lines.append("")
+        lines.append("相关观测（细节级，截断）：")
+        for r in obs_rows[: min(len(obs_rows), 20)]:
+            tool = f"/{r.tool_name}" if r.tool_name else ""
+            content = (r.content or "").strip()
+            if len(content) > 500:
+                content = content[:499] + "…"
+            rep = f" (×{r.repeat_count})" if r.repeat_count > 1 else ""
+            lines.append(f"- {r.id} [{r.kind}{tool}]{rep} {content}")
+
+    return "\n".join(lines).strip()
@@ -1,17 +1,18 @@
 import json
 import os
 import sys
-import traceback
 from typing import Any, Optional
 
-from .api import build_injection_block
-from .compress import ObservationLike, summarize_session
-from .hooks_bridge import main as hooks_bridge_main
-from .db import TraeMemDB
+from .compress import summarize_session_levels
+from .db import TraeMemDB, to_json
+from .dedup import collapse_repeats
+from .metrics import REGISTRY
+from .profiling import profiled
+from .tags import parse_tag_filter
 
 
 def _write(obj: dict[str, Any]) -> None:
-    sys.stdout.write(json.dumps(obj, ensure_ascii=False) + "\n")
+    sys.stdout.write(to_json(obj) + "\n")
     sys.stdout.flush()
 
 
@@ -30,6 +31,25 @@ def _tool_text_result(text: str, is_error: bool = False, structured: Optional[di
     return out
 
 
+def _mcp_text_mode() -> str:
+    # 工具结果的文本部分：json（缩进，默认）/ compact（紧凑、省略空字段）/ none（只留 structuredContent）。
+    mode = (os.environ.get("TRAE_MEM_MCP_TEXT") or "json").strip().lower()
+    return mode if mode in ("json", "compact", "none") else "json"
+
+
+def _tool_json_result(structured: dict[str, Any], payload: Any = None) -> dict[str, Any]:
+    # 同一份数据在 text 与 structuredContent 里各出现一次；客户端能读结构化结果时可以关掉文本那份。
+    payload = structured if payload is None else payload
+    mode = _mcp_text_mode()
+    if mode == "none":
+        text = "结果见 structuredContent"
+    elif mode == "compact":
+        text = to_json(payload, compact=True)
+    else:
+        text = to_json(payload, indent=2)
+    return _tool_text_result(text, structured=structured)
+
+
 def _tools() -> list[dict[str, Any]]:
     return [
         {
@@ -40,22 +60,104 @@ def _tools() -> list[dict[str, Any]]:
                 "properties": {
                     "query": {"type": "string"},
                     "limit": {"type": "integer", "default": 20},
+                    "project": {"type": "string"},
+                    "kind": {"type": "array", "items": {"type": "string"}},
+                    "tool_name": {"type": "string"},
+                    "session_id": {"type": "string"},
+                    "since": {"type": "integer", "description": "unix 秒，含"},
+                    "until": {"type": "integer", "description": "unix 秒，含"},
+                    "cursor": {"type": "string", "description": "上一页返回的 next_cursor"},
+                    "advanced": {"type": "boolean", "description": "按 FTS5 原生语法解析 query，语法错误直接报错"},
+                    "tags": {
+                        "type": "object",
+                        "additionalProperties": {"type": ["string", "number", "boolean"]},
+                        "description": "按标签等值过滤，多个键为 AND，如 {\"branch\": \"main\"}",
+                    },
                 },
                 "required": ["query"],
             },
         },
         {
             "name": "trae_mem_timeline",
-            "description": "给定 observation_id，返回同一会话的时间窗口上下文。",
+            "description": "给定 observation_id，返回同一会话的时间窗口上下文（按 seq 排序、分页）。",
             "inputSchema": {
                 "type": "object",
                 "properties": {
                     "observation_id": {"type": "string"},
                     "window": {"type": "integer", "default": 10},
+                    "limit": {"type": "integer", "default": 200},
+                    "after": {"type": "integer", "description": "向后翻页：上一页的 next_cursor"},
+                    "before": {"type": "integer", "description": "向前翻页：上一页的 prev_cursor"},
+                    "collapse": {"type": "boolean", "default": True, "description": "折叠页内近重复，附 repeat_count"},
+                    "tags": {
+                        "type": "object",
+                        "additionalProperties": {"type": ["string", "number", "boolean"]},
+                        "description": "按标签等值过滤，多个键为 AND，如 {\"branch\": \"main\"}",
+                    },
                 },
                 "required": ["observation_id"],
             },
         },
+        {
+            "name": "trae_mem_session_observations",
+            "description": "按 seq 顺序分页读取某个会话的全部 observations。",
+            "inputSchema": {
+                "type": "object",
+                "properties": {
+                    "session_id": {"type": "string"},
+                    "limit": {"type": "integer", "default": 500},
+                    "after": {"type": "integer", "description": "上一页的 next_cursor"},
+                    "tags": {
+                        "type": "object",
+                        "additionalProperties": {"type": ["string", "number", "boolean"]},
+                        "description": "按标签等值过滤，多个键为 AND，如 {\"branch\": \"main\"}",
+                    },
+                },
+                "required": ["session_id"],
+            },
+        },
+        {
+            "name": "trae_mem_entity",
+            "description": "按文件 / 符号 / 命令 / URL 精确查找相关 observations（实体倒排索引点查，按时间倒序）。",
+            "inputSchema": {
+                "type": "object",
+                "properties": {
+                    "name": {"type": "string", "description": "如 db.py、trae_mem/db.py、TraeMemDB、git status"},
+                    "kind": {"type": "string", "enum": ["file", "symbol", "command", "url"]},
+                    "project": {"type": "string"},
+                    "limit": {"type": "integer", "default": 50},
+                },
+                "required": ["name"],
+            },
+        },
+        {
+            "name": "trae_mem_failures",
+            "description": "错误指纹聚合：列出反复出现的失败；传 error（报错文本）或 fingerprint 时返回该失败出现过的会话及之后记录的结论（上次怎么修的）。",
+            "inputSchema": {
+                "type": "object",
+                "properties": {
+                    "error": {"type": "string"},
+                    "fingerprint": {"type": "string"},
+                    "project": {"type": "string"},
+                    "limit": {"type": "integer", "default": 10},
+                    "min_count": {"type": "integer", "default": 2},
+                },
+            },
+        },
+        {
+            "name": "trae_mem_changes",
+            "description": "变更订阅：返回游标 since 之后新增 / 更新的 observations、会话与摘要（只含 id，详情用 trae_mem_get_observations 取）。把返回的 cursor 作为下次的 since；wait>0 时没有新变更会等待最多 wait 秒（长轮询）。",
+            "inputSchema": {
+                "type": "object",
+                "properties": {
+                    "since": {"type": ["integer", "string"], "default": 0, "description": "上次返回的 cursor；\"now\" 表示从当前开始"},
+                    "wait": {"type": "number", "default": 0, "maximum": 30},
+                    "limit": {"type": "integer", "default": 100},
+                    "entity": {"type": "string", "enum": ["observation", "session", "summary"]},
+                    "session_id": {"type": "string"},
+                },
+            },
+        },
         {
             "name": "trae_mem_get_observations",
             "description": "按 ID 批量获取 observations 详情。",
@@ -110,6 +212,11 @@ def _tools() -> list[dict[str, Any]]:
             "description": "结束会话并生成 brief/detailed 两层摘要。",
             "inputSchema": {"type": "object", "properties": {"session": {"type": "string"}}, "required": ["session"]},
         },
+        {
+            "name": "trae_mem_stats",
+            "description": "返回进程内指标快照（计数器与延迟直方图），text 为 Prometheus 文本格式。",
+            "inputSchema": {"type": "object", "properties": {}, "required": []},
+        },
         {
             "name": "trae_mem_hook_event",
             "description": "适配“生命周期事件”输入（stdin JSON 同构），写入记忆。event 支持 SessionStart/UserPromptSubmit/PreToolUse/PostToolUse/Stop/SessionEnd。",
@@ -129,44 +236,138 @@ def _tools() -> list[dict[str, Any]]:
 
 
 def _handle_tool_call(name: str, args: dict[str, Any]) -> dict[str, Any]:
+    if name == "trae_mem_stats":
+        return _tool_text_result(REGISTRY.render_prometheus(), structured=REGISTRY.snapshot())
+    known = name in _TOOL_NAMES
+    label = name if known else "unknown"
+    with profiled(f"mcp-{label}"), REGISTRY.timer("trae_mem_mcp_tool_seconds", tool=label):
+        return _call_tool(name, args)
+
+
+def _call_tool(name: str, args: dict[str, Any]) -> dict[str, Any]:
     db = TraeMemDB()
     try:
         db.init_schema()
         if name == "trae_mem_search":
-            hits = db.search(str(args.get("query") or ""), limit=int(args.get("limit") or 20))
-            payload = [
-                {
-                    "id": h.id,
-                    "ts": h.ts,
-                    "kind": h.kind,
-                    "tool_name": h.tool_name,
-                    "session_id": h.session_id,
-                    "snippet": h.snippet,
-                    "score": h.score,
-                }
-                for h in hits
-            ]
-            return _tool_text_result(json.dumps(payload, ensure_ascii=False, indent=2), structured={"results": payload})
+            kinds = args.get("kind")
+            if isinstance(kinds, str):
+                kinds = [kinds]
+            limit = int(args.get("limit") or 20)
+            try:
+                hits, next_cursor = db.search_page(
+                    str(args.get("query") or ""),
+                    limit=limit,
+                    cursor=str(args["cursor"]) if args.get("cursor") else None,
+                    advanced=bool(args.get("advanced")),
+                    project=str(args["project"]) if args.get("project") else None,
+                    kinds=[str(k) for k in kinds] if isinstance(kinds, list) and kinds else None,
+                    tool_name=str(args["tool_name"]) if args.get("tool_name") else None,
+                    session_id=str(args["session_id"]) if args.get("session_id") else None,
+                    since=int(args["since"]) if args.get("since") is not None else None,
+                    until=int(args["until"]) if args.get("until") is not None else None,
+                    tags=parse_tag_filter(args.get("tags")),
+                )
+            except ValueError as e:
+                return _tool_text_result(str(e), is_error=True)
+            return _tool_json_result({"results": hits, "next_cursor": next_cursor}, hits)
 
         if name == "trae_mem_timeline":
             obs_id = str(args.get("observation_id") or "")
             window = int(args.get("window") or 10)
-            rows = db.timeline(obs_id, window=window)
-            items = [{k: r[k] for k in r.keys()} for r in rows]
-            return _tool_text_result(json.dumps(items, ensure_ascii=False, indent=2), structured={"items": items})
+            limit = int(args.get("limit") or 200)
+            try:
+                tags = parse_tag_filter(args.get("tags"))
+            except ValueError as e:
+                return _tool_text_result(str(e), is_error=True)
+            rows = db.timeline(
+                obs_id,
+                window=window,
+                limit=limit,
+                after_seq=int(args["after"]) if args.get("after") is not None else None,
+                before_seq=int(args["before"]) if args.get("before") is not None else None,
+                tags=tags,
+            )
+            structured = {
+                "prev_cursor": rows[0].seq if rows else None,
+                "next_cursor": rows[-1].seq if len(rows) >= limit else None,
+            }
+            if args.get("collapse", True):
+                rows = collapse_repeats(rows)
+            structured["items"] = rows
+            return _tool_json_result(structured, rows)
+
+        if name == "trae_mem_session_observations":
+            sid = str(args.get("session_id") or "")
+            limit = int(args.get("limit") or 500)
+            after = int(args["after"]) if args.get("after") is not None else None
+            try:
+                tags = parse_tag_filter(args.get("tags"))
+            except ValueError as e:
+                return _tool_text_result(str(e), is_error=True)
+            rows = db.get_observations_by_session(sid, limit=limit, after_seq=after, tags=tags)
+            structured = {"items": rows, "next_cursor": rows[-1].seq if len(rows) >= limit else None}
+            return _tool_json_result(structured, rows)
+
+        if name == "trae_mem_entity":
+            entity = str(args.get("name") or "")
+            kind = args.get("kind")
+            project = args.get("project")
+            limit = int(args.get("limit") or 50)
+            hits = db.lookup_entity(
+                entity, kind=str(kind) if kind else None, project=str(project) if project else None, limit=limit
+            )
+            return _tool_json_result({"results": hits}, hits)
+
+        if name == "trae_mem_failures":
+            limit = int(args.get("limit") or 10)
+            fingerprint = args.get("fingerprint")
+            error = args.get("error")
+            if fingerprint or error:
+                failure = db.lookup_failure(
+                    fingerprint=str(fingerprint) if fingerprint else None, error=str(error) if error else None
+                )
+                if failure is None:
+                    return _tool_text_result("未找到该错误的记录", structured={"failure": None})
+                structured = {
+                    "failure": failure,
+                    "sessions": db.failure_sessions(failure.fingerprint, limit=limit),
+                    "followups": db.failure_followups(failure.fingerprint, limit=limit),
+                }
+                return _tool_json_result(structured)
+            project = args.get("project")
+            rows = db.recurring_failures(
+                project=str(project) if project else None, limit=limit, min_count=int(args.get("min_count") or 2)
+            )
+            return _tool_json_result({"results": rows}, rows)
+
+        if name == "trae_mem_changes":
+            raw = args.get("since")
+            since = db.latest_change() if raw == "now" else int(raw or 0)
+            entity = args.get("entity")
+            session_id = args.get("session_id")
+            rows = db.wait_changes(
+                since,
+                timeout=min(float(args.get("wait") or 0), 30.0),
+                limit=min(int(args.get("limit") or 100), 1000),
+                entity=str(entity) if entity else None,
+                session_id=str(session_id) if session_id else None,
+            )
+            structured = {"changes": rows, "cursor": rows[-1].seq if rows else since}
+            return _tool_json_result(structured)
 
         if name == "trae_mem_get_observations":
             ids = args.get("ids") or []
             if not isinstance(ids, list):
                 return _tool_text_result("ids 必须是数组", is_error=True)
             rows = db.get_observations([str(i) for i in ids])
-            items = [{k: r[k] for k in r.keys()} for r in rows]
-            return _tool_text_result(json.dumps(items, ensure_ascii=False, indent=2), structured={"items": items})
+            return _tool_json_result({"items": rows}, rows)
 
         if name == "trae_mem_inject":
             query = str(args.get("query") or "")
             limit = int(args.get("limit") or 12)
             project = args.get("project")
+            from .inject import build_injection_block
+
             text = build_injection_block(db, query=query, limit=limit, project_path=str(project) if project else None)
             return _tool_text_result(text, structured={"context": text})
 
@@ -186,16 +387,9 @@ def _handle_tool_call(name: str, args: dict[str, Any]) -> dict[str, Any]:
             tags = args.get("tags")
             if tags is not None and not isinstance(tags, dict):
                 tags = {}
-            from .compress import contains_private, remove_private
-
-            private = False
-            if contains_private(text):
-                cleaned = remove_private(text)
-                if cleaned:
-                    text = cleaned
-                else:
-                    text = "[PRIVATE]"
-                    private = True
+            from .compress import redact_for_ingest
+
+            text, private = redact_for_ingest(text)
             obs_id = db.add_observation(
                 session_id=session,
                 kind=kind,
@@ -209,21 +403,11 @@ def _handle_tool_call(name: str, args: dict[str, Any]) -> dict[str, Any]:
         if name == "trae_mem_end_session":
             session = str(args.get("session") or "")
             db.end_session(session)
-            rows = db.get_observations_by_session(session, limit=5000)
-            obs = [
-                ObservationLike(
-                    ts=int(r["ts"]),
-                    kind=str(r["kind"]),
-                    tool_name=str(r["tool_name"]) if r["tool_name"] else None,
-                    content=str(r["content"]),
-                )
-                for r in rows
-                if int(r["private"]) == 0
-            ]
-            brief = summarize_session(obs, max_chars=900)
-            detailed = summarize_session(obs, max_chars=3200)
-            db.add_summary(session_id=session, level="brief", content=brief)
-            db.add_summary(session_id=session, level="detailed", content=detailed)
+            summaries = summarize_session_levels(
+                db.iter_session_observations(session), {"brief": 900, "detailed": 3200}
+            )
+            for level, content in summaries.items():
+                db.add_summary(session_id=session, level=level, content=content)
             return _tool_text_result(session, structured={"session_id": session})
 
         if name == "trae_mem_hook_event":
@@ -231,6 +415,8 @@ def _handle_tool_call(name: str, args: dict[str, Any]) -> dict[str, Any]:
             payload = args.get("payload") or {}
             if not isinstance(payload, dict):
                 payload = {}
+            from .hooks_bridge import main as hooks_bridge_main
+
             buf = json.dumps(payload, ensure_ascii=False)
             proc_argv = ["--event", event]
             stdin_backup = sys.stdin
@@ -248,6 +434,9 @@ def _handle_tool_call(name: str, args: dict[str, Any]) -> dict[str, Any]:
         db.close()
 
 
+_TOOL_NAMES = frozenset(t["name"] for t in _tools())
+
+
 def serve_stdio() -> None:
     initialized = False
     server_info = {"name": "trae-mem", "version": "0.1.0"}
@@ -306,6 +495,8 @@ def serve_stdio() -> None:
             _write(_error(id_value, -32601, f"method_not_found: {method}"))
         except Exception as e:
             if os.environ.get("TRAE_MEM_MCP_DEBUG") == "1":
+                import traceback
+
                 traceback.print_exc()
             _write(_error(id_value, -32000, f"server_error: {e}"))
 
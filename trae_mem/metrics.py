@@ -0,0 +1,162 @@
+import functools
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator, Optional, TypeVar
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_F = TypeVar("_F", bound=Callable[..., Any])
+_LabelKey = tuple[tuple[str, str], ...]
+
+
+def _enabled_from_env() -> bool:
+    return (os.environ.get("TRAE_MEM_METRICS") or "1").strip().lower() not in ("0", "false", "off", "no")
+
+
+def _label_key(labels: dict[str, Any]) -> _LabelKey:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _escape(v: str) -> str:
+    return v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _fmt_labels(key: _LabelKey, extra: Optional[tuple[str, str]] = None) -> str:
+    items = list(key) + ([extra] if extra else [])
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in items) + "}"
+
+
+def _fmt_num(v: float) -> str:
+    if v == int(v):
+        return str(int(v))
+    return repr(v)
+
+
+class _Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self, n_buckets: int) -> None:
+        self.counts = [0] * (n_buckets + 1)
+        self.sum = 0.0
+        self.count = 0
+
+
+class Registry:
+    # 进程内指标：计数器 + 固定分桶的延迟直方图，单锁保护，渲染为 Prometheus 文本格式。
+    def __init__(self, buckets: tuple[float, ...] = DEFAULT_BUCKETS, enabled: Optional[bool] = None) -> None:
+        self.buckets = buckets
+        self.enabled = _enabled_from_env() if enabled is None else enabled
+        self._lock = threading.Lock()
+        self._counters: dict[str, dict[_LabelKey, float]] = {}
+        self._hists: dict[str, dict[_LabelKey, _Histogram]] = {}
+
+    def inc(self, name: str, value: float = 1.0, **labels: Any) -> None:
+        if not self.enabled:
+            return
+        key = _label_key(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0.0) + value
+
+    def observe(self, name: str, seconds: float, **labels: Any) -> None:
+        if not self.enabled:
+            return
+        key = _label_key(labels)
+        idx = bisect_left(self.buckets, seconds)
+        with self._lock:
+            series = self._hists.setdefault(name, {})
+            h = series.get(key)
+            if h is None:
+                h = series[key] = _Histogram(len(self.buckets))
+            h.counts[idx] += 1
+            h.sum += seconds
+            h.count += 1
+
+    @contextmanager
+    def timer(self, name: str, **labels: Any) -> Iterator[dict[str, Any]]:
+        # 产出标签字典：调用方可以在块内改写（如请求处理中途才确定的租户），结束时按最终的标签记录。
+        if not self.enabled:
+            yield labels
+            return
+        t0 = time.perf_counter()
+        try:
+            yield labels
+        except BaseException:
+            self.inc("trae_mem_errors_total", metric=name, **labels)
+            raise
+        finally:
+            self.observe(name, time.perf_counter() - t0, **labels)
+
+    def timed(self, name: str, **labels: Any) -> Callable[[_F], _F]:
+        def deco(fn: _F) -> _F:
+            @functools.wraps(fn)
+            def wrapper(*args: Any, **kwargs: Any) -> Any:
+                if not self.enabled:
+                    return fn(*args, **kwargs)
+                with self.timer(name, **labels):
+                    return fn(*args, **kwargs)
+
+            return wrapper  # type: ignore[return-value]
+
+        return deco
+
+    def reset(self) -> None:
+        with self._lock:
+            self._counters.clear()
+            self._hists.clear()
+
+    def snapshot(self) -> dict[str, Any]:
+        with self._lock:
+            counters = [
+                {"name": name, "labels": dict(key), "value": value}
+                for name, series in sorted(self._counters.items())
+                for key, value in sorted(series.items())
+            ]
+            histograms = []
+            for name, series in sorted(self._hists.items()):
+                for key, h in sorted(series.items()):
+                    cum = 0
+                    buckets: dict[str, int] = {}
+                    for le, c in zip(self.buckets, h.counts):
+                        cum += c
+                        buckets[_fmt_num(le)] = cum
+                    buckets["+Inf"] = h.count
+                    histograms.append(
+                        {"name": name, "labels": dict(key), "count": h.count, "sum": h.sum, "buckets": buckets}
+                    )
+        return {"counters": counters, "histograms": histograms}
+
+    def render_prometheus(self) -> str:
+        snap = self.snapshot()
+        lines: list[str] = []
+        last = None
+        for c in snap["counters"]:
+            if c["name"] != last:
+                lines.append(f"# TYPE {c['name']} counter")
+                last = c["name"]
+            lines.append(f"{c['name']}{_fmt_labels(_label_key(c['labels']))} {_fmt_num(c['value'])}")
+        last = None
+        for h in snap["histograms"]:
+            name = h["name"]
+            key = _label_key(h["labels"])
+            if name != last:
+                lines.append(f"# TYPE {name} histogram")
+                last = name
+            for le, cum in h["buckets"].items():
+                lines.append(f"{name}_bucket{_fmt_labels(key, ('le', le))} {cum}")
+            lines.append(f"{name}_sum{_fmt_labels(key)} {repr(h['sum'])}")
+            lines.append(f"{name}_count{_fmt_labels(key)} {h['count']}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+inc = REGISTRY.inc
+observe = REGISTRY.observe
+timer = REGISTRY.timer
+timed = REGISTRY.timed
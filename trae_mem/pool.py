@@ -0,0 +1,184 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, Optional
+
+from .db import TraeMemDB
+from .metrics import inc
+
+# 多租户 HTTP 服务的库句柄池：按租户名打开 TraeMemDB，LRU 限制同时打开的库数量，空闲超时关闭，
+# 每个租户有独立的并发上限。句柄被请求占用（pins > 0）时不会被关闭，池满且全被占用时允许暂时超出上限。
+DEFAULT_TENANT = "default"
+TENANT_RE = re.compile(r"^[A-Za-z0-9_][A-Za-z0-9_.-]{0,63}$")
+
+
+class TenantBusy(RuntimeError):
+    pass
+
+
+class UnknownTenant(LookupError):
+    pass
+
+
+class _Tenant:
+    __slots__ = ("name", "db", "slots", "pins", "last_used")
+
+    def __init__(self, name: str, db: TraeMemDB, max_concurrency: int) -> None:
+        self.name = name
+        self.db = db
+        self.slots = threading.BoundedSemaphore(max_concurrency)
+        self.pins = 0
+        self.last_used = time.monotonic()
+
+
+class Lease:
+    # 一次请求对租户库的占用。release_slot() 可提前归还并发名额（长轮询 / SSE 等待期间不占名额），
+    # 句柄本身直到 close() 才解除占用。
+    __slots__ = ("pool", "tenant", "_slot")
+
+    def __init__(self, pool: "DBPool", tenant: _Tenant) -> None:
+        self.pool = pool
+        self.tenant = tenant
+        self._slot = True
+
+    @property
+    def db(self) -> TraeMemDB:
+        return self.tenant.db
+
+    def release_slot(self) -> None:
+        if self._slot:
+            self._slot = False
+            self.tenant.slots.release()
+
+    def close(self) -> None:
+        self.release_slot()
+        self.tenant.db.release_reader()
+        self.pool._unpin(self.tenant)
+
+
+def tenants_path_resolver(tenants_dir: Optional[Path]) -> Callable[[str], Path]:
+    # 租户 <name> -> <tenants_dir>/<name>/trae_mem.sqlite3；只服务已存在的库，不按请求建库。
+    def resolve(name: str) -> Path:
+        if tenants_dir is None or not TENANT_RE.match(name):
+            raise UnknownTenant(name)
+        path = tenants_dir / name / "trae_mem.sqlite3"
+        if not path.is_file():
+            raise UnknownTenant(name)
+        return path
+
+    return resolve
+
+
+class DBPool:
+    def __init__(
+        self,
+        resolve: Callable[[str], Path],
+        max_open: int = 16,
+        idle_s: float = 300.0,
+        max_concurrency: int = 4,
+        queue_s: float = 5.0,
+    ) -> None:
+        self.resolve = resolve
+        self.max_open = max(max_open, 1)
+        self.idle_s = idle_s
+        self.max_concurrency = max(max_concurrency, 1)
+        self.queue_s = queue_s
+        self._tenants: "OrderedDict[str, _Tenant]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._janitor: Optional[threading.Thread] = None
+
+    def register(self, name: str, db: TraeMemDB) -> None:
+        # 常驻句柄（服务启动时的 --db 库）：永久占用，不参与淘汰，但同样受并发上限约束。
+        with self._lock:
+            tenant = _Tenant(name, db, self.max_concurrency)
+            tenant.pins = 1
+            self._tenants[name] = tenant
+
+    def acquire(self, name: str) -> Lease:
+        tenant = self._pin(name)
+        # 名额等待在池锁之外，一个租户排队不影响其他租户。
+        if not tenant.slots.acquire(timeout=self.queue_s):
+            self._unpin(tenant)
+            inc("trae_mem_tenant_rejected_total", tenant=name)
+            raise TenantBusy(name)
+        return Lease(self, tenant)
+
+    def _pin(self, name: str) -> _Tenant:
+        with self._lock:
+            tenant = self._tenants.get(name)
+            if tenant is not None:
+                self._tenants.move_to_end(name)
+                tenant.pins += 1
+                return tenant
+        # 打开与建表在锁外完成；并发打开同一租户时后到的一方丢弃自己的句柄。
+        db = TraeMemDB(self.resolve(name))
+        db.init_schema()
+        spare: Optional[TraeMemDB] = None
+        evicted: list[_Tenant] = []
+        with self._lock:
+            tenant = self._tenants.get(name)
+            if tenant is None:
+                tenant = _Tenant(name, db, self.max_concurrency)
+                self._tenants[name] = tenant
+                tenant.pins += 1
+                inc("trae_mem_pool_opens_total", tenant=name)
+                evicted = self._evict_locked(lambda t: len(self._tenants) > self.max_open)
+            else:
+                self._tenants.move_to_end(name)
+                tenant.pins += 1
+                spare = db
+        if spare is not None:
+            spare.close()
+        self._close(evicted, "lru")
+        return tenant
+
+    def _unpin(self, tenant: _Tenant) -> None:
+        with self._lock:
+            tenant.pins -= 1
+            tenant.last_used = time.monotonic()
+
+    def _evict_locked(self, should_evict: Callable[[_Tenant], bool]) -> list[_Tenant]:
+        # 从最久未用的一端开始，跳过正在被占用的句柄。
+        out: list[_Tenant] = []
+        for tenant in list(self._tenants.values()):
+            if tenant.pins == 0 and should_evict(tenant):
+                del self._tenants[tenant.name]
+                out.append(tenant)
+        return out
+
+    def _close(self, tenants: list[_Tenant], reason: str) -> None:
+        for tenant in tenants:
+            tenant.db.close()
+            inc("trae_mem_pool_evictions_total", tenant=tenant.name, reason=reason)
+
+    def evict_idle(self) -> int:
+        cutoff = time.monotonic() - self.idle_s
+        with self._lock:
+            evicted = self._evict_locked(lambda t: t.last_used < cutoff)
+        self._close(evicted, "idle")
+        return len(evicted)
+
+    def open_tenants(self) -> list[str]:
+        with self._lock:
+            return list(self._tenants)
+
+    def start_janitor(self) -> None:
+        interval = min(max(self.idle_s / 2, 1.0), 60.0)
+
+        def loop() -> None:
+            while not self._stop.wait(interval):
+                self.evict_idle()
+
+        self._janitor = threading.Thread(target=loop, name="trae-mem-pool", daemon=True)
+        self._janitor.start()
+
+    def close(self) -> None:
+        self._stop.set()
+        with self._lock:
+            tenants, self._tenants = list(self._tenants.values()), OrderedDict()
+        for tenant in tenants:
+            tenant.db.close()
+
@@ -0,0 +1,90 @@
+import io
+import itertools
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, Optional
+
+_local = threading.local()
+_seq = itertools.count()
+
+
+def profile_dir() -> Optional[Path]:
+    raw = (os.environ.get("TRAE_MEM_PROFILE") or "").strip()
+    if not raw or raw.lower() in ("0", "false", "off", "no"):
+        return None
+    if raw.lower() in ("1", "true", "on", "yes"):
+        return default_profile_dir()
+    return Path(raw).expanduser()
+
+
+def default_profile_dir() -> Path:
+    base = os.environ.get("TRAE_MEM_HOME")
+    if base:
+        return Path(base).expanduser() / "profiles"
+    return Path.home() / ".trae-mem" / "profiles"
+
+
+def _safe_label(label: str) -> str:
+    return re.sub(r"[^A-Za-z0-9_.-]+", "_", label).strip("_") or "run"
+
+
+@contextmanager
+def profiled(label: str) -> Iterator[None]:
+    # 每次调用写一个 .prof 文件（label-时间戳-pid-序号），由 `trae-mem profile report` 汇总。
+    # 同一线程内的嵌套调用（如 MCP 工具里再走 hooks_bridge.main）只由最外层记录。
+    out_dir = profile_dir()
+    if out_dir is None or getattr(_local, "active", False):
+        yield
+        return
+
+    import cProfile
+
+    prof = cProfile.Profile()
+    try:
+        prof.enable()
+    except ValueError:
+        yield
+        return
+    _local.active = True
+    try:
+        yield
+    finally:
+        prof.disable()
+        _local.active = False
+        try:
+            out_dir.mkdir(parents=True, exist_ok=True)
+            name = f"{_safe_label(label)}-{int(time.time() * 1000)}-{os.getpid()}-{next(_seq)}.prof"
+            prof.dump_stats(str(out_dir / name))
+        except OSError:
+            pass
+
+
+def profile_files(directory: Path, match: Optional[str] = None) -> list[Path]:
+    pattern = f"{_safe_label(match)}*.prof" if match else "*.prof"
+    return sorted(directory.glob(pattern))
+
+
+def report(directory: Path, top: int = 30, sort: str = "cumulative", match: Optional[str] = None) -> str:
+    import pstats
+
+    files = profile_files(directory, match)
+    if not files:
+        return f"no profiles in {directory}"
+    buf = io.StringIO()
+    stats = pstats.Stats(str(files[0]), stream=buf)
+    for f in files[1:]:
+        stats.add(str(f))
+    buf.write(f"merged {len(files)} profile(s) from {directory}\n")
+    stats.strip_dirs().sort_stats(sort).print_stats(top)
+    return buf.getvalue()
+
+
+def clear(directory: Path, match: Optional[str] = None) -> int:
+    files = profile_files(directory, match)
+    for f in files:
+        f.unlink(missing_ok=True)
+    return len(files)
@@ -0,0 +1,74 @@
+import math
+import os
+from typing import Optional
+
+DEFAULT_KIND_WEIGHTS = {"decision": 1.5, "error": 1.4, "user": 1.1, "tool": 1.0, "note": 0.8}
+
+
+def _float_env(name: str, default: float) -> float:
+    raw = (os.environ.get(name) or "").strip()
+    try:
+        return float(raw) if raw else default
+    except ValueError:
+        return default
+
+
+def _kind_weights_env() -> dict[str, float]:
+    # TRAE_MEM_RANK_KIND_WEIGHTS="decision=2,note=0.5"，在默认权重上覆盖。
+    weights = dict(DEFAULT_KIND_WEIGHTS)
+    for part in (os.environ.get("TRAE_MEM_RANK_KIND_WEIGHTS") or "").split(","):
+        k, sep, v = part.partition("=")
+        if not sep or not k.strip():
+            continue
+        try:
+            weights[k.strip()] = float(v)
+        except ValueError:
+            continue
+    return weights
+
+
+class RankConfig:
+    # 排序分 = 相关度(-bm25) × kind 权重 × (1 + recency_weight × 0.5^(天数/半衰期)) × (1 + access_weight × ln(1+访问次数))。
+    # 按原生顺序每 pool 条候选为一个窗口，窗口内重排（SQL 内通过 trae_rank() 计算），翻页时窗口随游标后移。
+    # 取负号后与 bm25 同向：越小越相关。
+    __slots__ = ("enabled", "half_life_days", "recency_weight", "access_weight", "kind_weights", "pool")
+
+    def __init__(
+        self,
+        enabled: bool = True,
+        half_life_days: float = 14.0,
+        recency_weight: float = 1.0,
+        access_weight: float = 0.25,
+        kind_weights: Optional[dict[str, float]] = None,
+        pool: int = 100,
+    ) -> None:
+        self.enabled = enabled
+        self.half_life_days = half_life_days
+        self.recency_weight = recency_weight
+        self.access_weight = access_weight
+        self.kind_weights = dict(DEFAULT_KIND_WEIGHTS if kind_weights is None else kind_weights)
+        self.pool = pool
+
+    @classmethod
+    def from_env(cls) -> "RankConfig":
+        enabled = (os.environ.get("TRAE_MEM_RANK") or "1").strip().lower() not in ("0", "false", "off", "no")
+        return cls(
+            enabled=enabled,
+            half_life_days=_float_env("TRAE_MEM_RANK_HALF_LIFE_DAYS", 14.0),
+            recency_weight=_float_env("TRAE_MEM_RANK_RECENCY_WEIGHT", 1.0),
+            access_weight=_float_env("TRAE_MEM_RANK_ACCESS_WEIGHT", 0.25),
+            kind_weights=_kind_weights_env(),
+            pool=int(_float_env("TRAE_MEM_RANK_POOL", 100)),
+        )
+
+    def score(self, bm25: float, ts: int, kind: str, hits: int, now: float) -> float:
+        relevance = max(-float(bm25), 1e-9)
+        age_days = max(float(now) - float(ts), 0.0) / 86400.0
+        recency = 0.5 ** (age_days / self.half_life_days) if self.half_life_days > 0 else 0.0
+        blended = (
+            relevance
+            * self.kind_weights.get(kind, 1.0)
+            * (1.0 + self.recency_weight * recency)
+            * (1.0 + self.access_weight * math.log1p(max(int(hits or 0), 0)))
+        )
+        return -blended
@@ -0,0 +1,159 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+from typing import Any, Iterable, Optional
+
+
+def slow_query_threshold_from_env() -> Optional[float]:
+    raw = (os.environ.get("TRAE_MEM_SLOW_QUERY_MS") or "").strip()
+    if not raw:
+        return None
+    try:
+        return float(raw)
+    except ValueError:
+        return None
+
+
+def param_shape(value: Any) -> Any:
+    # 只记录参数“形状”：字符串/二进制只保留长度，避免把 observation 内容（含隐私片段）写进日志。
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    if isinstance(value, str):
+        return f"str[{len(value)}]"
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return f"bytes[{len(value)}]"
+    return type(value).__name__
+
+
+def params_shape(params: Any) -> Any:
+    if isinstance(params, dict):
+        return {str(k): param_shape(v) for k, v in params.items()}
+    if isinstance(params, (list, tuple)):
+        return [param_shape(v) for v in params]
+    return param_shape(params)
+
+
+class SlowQueryLog:
+    def __init__(self, threshold_ms: float, keep: int = 500) -> None:
+        self.threshold_s = threshold_ms / 1000.0
+        self.keep = keep
+        self._pending: deque[tuple[float, float, str, str, str]] = deque(maxlen=keep)
+        self._lock = threading.Lock()
+
+    def record(self, conn: sqlite3.Connection, sql: str, params: Any, elapsed: float, many: bool = False) -> None:
+        plan = ""
+        if not many:
+            try:
+                rows = sqlite3.Connection.execute(conn, "EXPLAIN QUERY PLAN " + sql, params).fetchall()
+                plan = "\n".join(str(r[-1]) for r in rows)
+            except sqlite3.Error:
+                plan = ""
+        shape = {"executemany": True} if many else params_shape(params)
+        self._pending.append(
+            (
+                time.time(),
+                round(elapsed * 1000, 3),
+                " ".join(sql.split()),
+                json.dumps(shape, ensure_ascii=False),
+                plan,
+            )
+        )
+
+    def flush(self, conn: sqlite3.Connection) -> None:
+        with self._lock:
+            if not self._pending:
+                return
+            items = list(self._pending)
+            self._pending.clear()
+        sqlite3.Connection.executemany(
+            conn,
+            "INSERT INTO slow_queries(ts, duration_ms, sql, params_json, plan) VALUES (?, ?, ?, ?, ?)",
+            items,
+        )
+        sqlite3.Connection.execute(
+            conn,
+            "DELETE FROM slow_queries WHERE id <= (SELECT MAX(id) FROM slow_queries) - ?",
+            (self.keep,),
+        )
+
+
+class TracedCursor(sqlite3.Cursor):
+    # 计时覆盖 execute + 取数全过程；语句结束（DML 执行完 / 结果集取尽）时与阈值比较。
+    _sql: Optional[str] = None
+    _params: Any = ()
+    _elapsed = 0.0
+
+    def _slowlog(self) -> Optional[SlowQueryLog]:
+        return getattr(self.connection, "slowlog", None)
+
+    def _finish(self) -> None:
+        sql, self._sql = self._sql, None
+        log = self._slowlog()
+        if sql is not None and log is not None and self._elapsed >= log.threshold_s:
+            log.record(self.connection, sql, self._params, self._elapsed)
+
+    def execute(self, sql: str, parameters: Any = (), /) -> "TracedCursor":  # type: ignore[override]
+        t0 = time.perf_counter()
+        super().execute(sql, parameters)
+        self._sql, self._params, self._elapsed = sql, parameters, time.perf_counter() - t0
+        if self.description is None:
+            self._finish()
+        return self
+
+    def executemany(self, sql: str, seq_of_parameters: Iterable[Any], /) -> "TracedCursor":  # type: ignore[override]
+        t0 = time.perf_counter()
+        super().executemany(sql, seq_of_parameters)
+        elapsed = time.perf_counter() - t0
+        log = self._slowlog()
+        if log is not None and elapsed >= log.threshold_s:
+            log.record(self.connection, sql, (), elapsed, many=True)
+        return self
+
+    def fetchone(self) -> Any:
+        t0 = time.perf_counter()
+        row = super().fetchone()
+        self._elapsed += time.perf_counter() - t0
+        self._finish()
+        return row
+
+    def fetchmany(self, size: int = 1) -> list[Any]:  # type: ignore[override]
+        t0 = time.perf_counter()
+        rows = super().fetchmany(size)
+        self._elapsed += time.perf_counter() - t0
+        if len(rows) < size:
+            self._finish()
+        return rows
+
+    def fetchall(self) -> list[Any]:
+        t0 = time.perf_counter()
+        rows = super().fetchall()
+        self._elapsed += time.perf_counter() - t0
+        self._finish()
+        return rows
+
+    def __next__(self) -> Any:
+        t0 = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self._elapsed += time.perf_counter() - t0
+            self._finish()
+            raise
+        self._elapsed += time.perf_counter() - t0
+        return row
+
+
+class TracedConnection(sqlite3.Connection):
+    slowlog: Optional[SlowQueryLog] = None
+
+    def cursor(self, factory: Any = None) -> sqlite3.Cursor:  # type: ignore[override]
+        return super().cursor(factory or TracedCursor)
+
+    def execute(self, sql: str, parameters: Any = (), /) -> sqlite3.Cursor:  # type: ignore[override]
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql: str, seq_of_parameters: Iterable[Any], /) -> sqlite3.Cursor:  # type: ignore[override]
+        return self.cursor().executemany(sql, seq_of_parameters)
@@ -0,0 +1,114 @@
+import gzip
+import json
+import os
+from pathlib import Path
+from typing import Any, Optional
+
+from .db import TraeMemDB, row_hash, to_json
+from .metrics import inc
+
+# 多台机器之间经共享目录（NFS / SMB 挂载、同步盘，或本机目录充当中转）增量同步。
+# 每个副本只往 <dir>/<replica_id>/ 下追加按序编号的分段文件（gzip 压缩的 JSONL），内容是自上次推送以来
+# 本机变更过的会话 / 观测 / 摘要的当前状态；拉取时按各对端已应用到的分段号续读。
+# 传输量只与新增活动有关，与库的总大小无关；由同步导入的记录不会再被推送，副本之间不会来回转发。
+FORMAT_VERSION = 1
+SEGMENT_ROWS = 2000
+_SEGMENT_SUFFIX = ".jsonl.gz"
+
+
+def sync_dir_from_env() -> Optional[str]:
+    return (os.environ.get("TRAE_MEM_SYNC_DIR") or "").strip() or None
+
+
+def _segments(peer_dir: Path) -> list[tuple[int, Path]]:
+    out: list[tuple[int, Path]] = []
+    for p in peer_dir.iterdir():
+        name = p.name
+        if name.endswith(_SEGMENT_SUFFIX) and name[: -len(_SEGMENT_SUFFIX)].isdigit():
+            out.append((int(name[: -len(_SEGMENT_SUFFIX)]), p))
+    return sorted(out)
+
+
+def _write_segment(out_dir: Path, replica: str, records: list[dict[str, Any]]) -> Path:
+    # 先写临时文件再改名，对端不会读到写了一半的分段。
+    out_dir.mkdir(parents=True, exist_ok=True)
+    existing = _segments(out_dir)
+    n = existing[-1][0] + 1 if existing else 1
+    path = out_dir / f"{n:010d}{_SEGMENT_SUFFIX}"
+    tmp = out_dir / f".{n:010d}.tmp"
+    header = {"format": FORMAT_VERSION, "replica": replica, "segment": n, "count": len(records)}
+    with gzip.open(tmp, "wt", encoding="utf-8") as f:
+        f.write(to_json(header) + "\n")
+        for rec in records:
+            f.write(to_json(rec) + "\n")
+    os.replace(tmp, path)
+    return path
+
+
+def _read_segment(path: Path) -> list[dict[str, Any]]:
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        header = json.loads(f.readline() or "{}")
+        if header.get("format") != FORMAT_VERSION:
+            raise ValueError(f"不支持的同步分段格式：{path}")
+        records = [json.loads(line) for line in f if line.strip()]
+    if len(records) != header.get("count") or any(row_hash(r["row"]) != r["hash"] for r in records):
+        raise ValueError(f"同步分段已损坏：{path}")
+    return records
+
+
+def push(db: TraeMemDB, directory: str, full: bool = False) -> dict[str, int]:
+    # 推送游标按共享目录分别记录；写完分段后才推进，中途失败下次会重发同一批（对端按哈希跳过）。
+    root = Path(directory).expanduser().resolve()
+    replica = db.replica_id()
+    out_dir = root / replica
+    key = f"push:{root}"
+    since = int(db.sync_state(key) or 0)
+    rows = segments = 0
+    if full:
+        since = db.latest_change()
+        for entity in ("session", "observation", "summary"):
+            after = 0
+            while True:
+                keys, after = db.sync_keys(entity, after, SEGMENT_ROWS)
+                if not keys:
+                    break
+                records = db.export_sync(keys)
+                _write_segment(out_dir, replica, records)
+                rows += len(records)
+                segments += 1
+        db.set_sync_state(key, str(since))
+    while True:
+        keys, cursor = db.changed_keys(since, SEGMENT_ROWS)
+        if cursor == since:
+            break
+        records = db.export_sync(keys)
+        if records:
+            _write_segment(out_dir, replica, records)
+            rows += len(records)
+            segments += 1
+        db.set_sync_state(key, str(cursor))
+        since = cursor
+    inc("trae_mem_sync_rows_total", value=rows, direction="push")
+    return {"rows": rows, "segments": segments}
+
+
+def pull(db: TraeMemDB, directory: str) -> dict[str, int]:
+    root = Path(directory).expanduser().resolve()
+    if not root.is_dir():
+        return {"applied": 0, "skipped": 0, "segments": 0}
+    replica = db.replica_id()
+    applied = skipped = segments = 0
+    for peer_dir in sorted(p for p in root.iterdir() if p.is_dir()):
+        if peer_dir.name == replica:
+            continue
+        key = f"pull:{root}:{peer_dir.name}"
+        done = int(db.sync_state(key) or 0)
+        for n, path in _segments(peer_dir):
+            if n <= done:
+                continue
+            a, s = db.apply_sync(_read_segment(path), key, str(n))
+            applied += a
+            skipped += s
+            segments += 1
+    inc("trae_mem_sync_rows_total", value=applied, direction="pull")
+    return {"applied": applied, "skipped": skipped, "segments": segments}
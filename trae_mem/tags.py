@@ -0,0 +1,50 @@
+from typing import Any, Iterable, Optional, Union
+
+# tags_json 里的顶层标量（及标量数组）拆成 (key, value) 行写入 observation_tags，按标签过滤走索引。
+# 嵌套对象（如 hook 写入的 input / output 元信息）不展开。
+MAX_TAGS_PER_OBSERVATION = 32
+_MAX_VALUE_CHARS = 200
+
+
+def tag_value(v: Any) -> Optional[str]:
+    # 统一成文本比较：布尔写成 true/false，数字按 Python 的 str()。
+    if isinstance(v, bool):
+        return "true" if v else "false"
+    if isinstance(v, (str, int, float)):
+        s = str(v)
+        return s if len(s) <= _MAX_VALUE_CHARS else None
+    return None
+
+
+def tag_rows(tags: Optional[dict[str, Any]]) -> list[tuple[str, str]]:
+    out: list[tuple[str, str]] = []
+    for key, raw in (tags or {}).items():
+        values = raw if isinstance(raw, list) else [raw]
+        for v in values:
+            s = tag_value(v)
+            if s is not None and (key, s) not in out:
+                out.append((str(key), s))
+            if len(out) >= MAX_TAGS_PER_OBSERVATION:
+                return out
+    return out
+
+
+def parse_tag_filter(raw: Union[None, str, Iterable[str], dict[str, Any]]) -> Optional[dict[str, str]]:
+    # 接受 {"branch": "main"}、"branch=main,task=T-12" 或其列表（HTTP 的重复参数、CLI 的 --tag）。
+    if not raw:
+        return None
+    out: dict[str, str] = {}
+    if isinstance(raw, dict):
+        for k, v in raw.items():
+            s = tag_value(v)
+            if s is not None:
+                out[str(k)] = s
+        return out or None
+    items = [raw] if isinstance(raw, str) else list(raw)
+    for item in items:
+        for part in item.split(","):
+            key, sep, value = part.partition("=")
+            if not sep or not key.strip():
+                raise ValueError(f"标签过滤格式应为 key=value：{part!r}")
+            out[key.strip()] = value.strip()
+    return out or None
@@ -0,0 +1,172 @@
+import json
+import os
+from pathlib import Path
+from typing import Any, Iterator, Optional
+
+from .compress import bounded_json, redact_for_ingest
+from .db import TraeMemDB
+from .metrics import inc
+
+# SessionEnd 时补录 transcript（逐行 JSON）里 hook 漏掉的用户输入与工具调用。
+# 从上次记录的字节偏移开始逐行流式解析，内存只与单行大小和未配对的 tool_use 数量有关。
+
+
+def transcript_enabled_from_env() -> bool:
+    return (os.environ.get("TRAE_MEM_TRANSCRIPT") or "1").strip().lower() not in ("0", "false", "off", "no")
+
+
+class TranscriptEntry:
+    __slots__ = ("kind", "tool_name", "content", "private", "ts", "line", "input_sha1", "tags")
+
+    def __init__(
+        self,
+        kind: str,
+        tool_name: Optional[str],
+        content: str,
+        private: bool,
+        ts: Optional[float],
+        line: int,
+        input_sha1: Optional[str] = None,
+        tags: Optional[dict[str, Any]] = None,
+    ) -> None:
+        self.kind = kind
+        self.tool_name = tool_name
+        self.content = content
+        self.private = private
+        self.ts = ts
+        self.line = line
+        self.input_sha1 = input_sha1
+        self.tags = tags
+
+
+def _parse_ts(raw: Any) -> Optional[float]:
+    if isinstance(raw, (int, float)):
+        return float(raw) / 1000.0 if raw > 1e11 else float(raw)
+    if not isinstance(raw, str) or not raw:
+        return None
+    from datetime import datetime
+
+    try:
+        return datetime.fromisoformat(raw.replace("Z", "+00:00")).timestamp()
+    except ValueError:
+        return None
+
+
+def _blocks(content: Any) -> list[dict[str, Any]]:
+    if isinstance(content, str):
+        return [{"type": "text", "text": content}]
+    if isinstance(content, list):
+        return [b for b in content if isinstance(b, dict)]
+    return []
+
+
+def iter_lines(path: Path, offset: int = 0, line: int = 0) -> Iterator[tuple[dict[str, Any], int, int, int]]:
+    # 逐行产出 (对象, 行首偏移, 行尾偏移, 行号)。末尾没有换行且解析失败的半行视为仍在写入，不前进。
+    with path.open("rb") as f:
+        f.seek(offset)
+        for raw in f:
+            line += 1
+            start, offset = offset, offset + len(raw)
+            try:
+                obj = json.loads(raw)
+            except ValueError:
+                if not raw.endswith(b"\n"):
+                    return
+                continue
+            if isinstance(obj, dict):
+                yield obj, start, offset, line
+
+
+def iter_entries(path: Path, offset: int = 0, line: int = 0) -> Iterator[tuple[Optional[TranscriptEntry], int, int]]:
+    # tool_use 与之后的 tool_result 按 id 配对成一条工具记录，格式与 PostToolUse hook 写入的一致。
+    # 产出 (记录或 None, 可续读的偏移, 行号)；还有未配对的 tool_use 时，续读位置停在最早那条所在行之前，
+    # 下次从那里重读（已写入的条目会在对账时抵消）。None 只用于推进位置。
+    open_calls: dict[str, tuple[str, Any, Optional[float], int, int]] = {}
+
+    def resume(end: int, n: int) -> tuple[int, int]:
+        if not open_calls:
+            return end, n
+        first = min(open_calls.values(), key=lambda c: c[4])
+        return first[4], first[3] - 1
+
+    for obj, line_start, end, n in iter_lines(path, offset, line):
+        if obj.get("isMeta") or obj.get("isSidechain"):
+            yield (None, *resume(end, n))
+            continue
+        msg = obj.get("message") if isinstance(obj.get("message"), dict) else obj
+        role = msg.get("role") or obj.get("type")
+        ts = _parse_ts(obj.get("timestamp") or msg.get("timestamp"))
+        blocks = _blocks(msg.get("content"))
+        texts: list[str] = []
+        for b in blocks:
+            t = b.get("type")
+            if t == "tool_use" and b.get("id"):
+                open_calls[str(b["id"])] = (str(b.get("name") or ""), b.get("input") or {}, ts, n, line_start)
+            elif t == "tool_result":
+                call = open_calls.pop(str(b.get("tool_use_id") or ""), None)
+                if call is None:
+                    continue
+                name, tool_input, started, first_line, _ = call
+                text_in, in_meta = bounded_json(tool_input, 2000)
+                text_out, out_meta = bounded_json(b.get("content"), 4000)
+                tags: dict[str, Any] = {"input": in_meta, "output": out_meta, "source": "transcript"}
+                if b.get("is_error"):
+                    tags["error"] = True
+                entry = TranscriptEntry(
+                    "tool",
+                    name,
+                    f"输入={text_in}\n输出={text_out}",
+                    False,
+                    started if started is not None else ts,
+                    first_line,
+                    input_sha1=in_meta["sha1"],
+                    tags=tags,
+                )
+                yield (entry, *resume(end, n))
+            elif t == "text" and role == "user":
+                texts.append(str(b.get("text") or ""))
+        prompt = "\n".join(t for t in texts if t).strip()
+        if prompt:
+            content, private = redact_for_ingest(prompt)
+            yield (TranscriptEntry("user", None, content, private, ts, n, tags={"source": "transcript"}), *resume(end, n))
+        else:
+            yield (None, *resume(end, n))
+
+
+def ingest_transcript(db: TraeMemDB, session_id: str, path: str) -> int:
+    # 与会话里已有的记录按哈希对账（同一哈希按出现次数逐个抵消），只批量写入缺失的条目；
+    # 只有 PreToolUse 没有 PostToolUse 的调用直接用 transcript 里的结果补完。返回写入 / 补完的条数。
+    p = Path(path).expanduser()
+    if not path or not p.is_file():
+        return 0
+    import hashlib
+
+    offset, line = db.transcript_offset(session_id, str(p))
+    if offset > p.stat().st_size:
+        offset, line = 0, 0
+    seen, pending = db.reconcile_keys(session_id)
+    rows: list[tuple[str, str, Optional[str], Optional[dict[str, Any]], bool, Optional[int]]] = []
+    completions: list[tuple[str, str, Optional[dict[str, Any]], Optional[float]]] = []
+    end, last = offset, line
+    for entry, end, last in iter_entries(p, offset, line):
+        if entry is None:
+            continue
+        if entry.kind == "user":
+            key = ("user", "", hashlib.sha1(entry.content.encode("utf-8")).hexdigest())
+        else:
+            key = ("tool", entry.tool_name or "", entry.input_sha1 or "")
+        waiting = pending.get(key)
+        if waiting:
+            completions.append((waiting.pop(0), entry.content, entry.tags, entry.ts))
+            continue
+        if seen.get(key, 0) > 0:
+            seen[key] -= 1
+            continue
+        tags = dict(entry.tags or {}, transcript_line=entry.line)
+        ts = int(entry.ts) if entry.ts is not None else None
+        rows.append((entry.kind, entry.content, entry.tool_name, tags, entry.private, ts))
+    if end == offset and not rows and not completions:
+        return 0
+    n = db.bulk_ingest(session_id, rows, completions, transcript=(str(p), end, last))
+    inc("trae_mem_transcript_ingested_total", value=n)
+    return n